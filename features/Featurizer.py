@@ -1,15 +1,86 @@
-from tqdm import tqdm
 import numpy as np
 
 # For featurizer
 import itertools
-from matplotlib import pyplot as plt
-from sklearn import decomposition
+import json
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from time import time
-from sklearn.preprocessing import StandardScaler
+
+import instrumentation as inst
+from ImageTransforms import UnkeyableError
+from transform_cache import fingerprint
+
+# Version of the on-disk format written by save(), bumped on incompatible changes
+FORMAT_VERSION = 1
+
+
+def blas_threads(n_jobs):
+    '''
+    Number of BLAS/OpenMP threads each of n_jobs concurrent jobs may use without
+    oversubscribing the cores
+    '''
+    return max(1, (os.cpu_count() or 1)//n_jobs)
+
+
+def threadpool_limits(limits):
+    # threadpoolctl is only needed when fitting, so it is imported then
+    from threadpoolctl import threadpool_limits
+    return threadpool_limits(limits=limits)
+
+
+def _limit_threads(n_threads):
+    threadpool_limits(limits=n_threads)
+
+
+def _fit_estimator(estimator, data):
+    t0 = time()
+    estimator.fit(data)
+    return estimator, time() - t0
+
+
+def affine_map(estimator):
+    '''
+    Returns (W, mean) such that estimator.transform(X) == (X - mean) @ W
+    for a fitted PCA, IncrementalPCA, FastICA or FactorAnalysis
+    '''
+    from sklearn import decomposition
+    # PCA and IncrementalPCA also have a noise_variance_, so FactorAnalysis is matched by type
+    if isinstance(estimator, decomposition.FactorAnalysis):
+        # Posterior mean of the latent variables, as FactorAnalysis.transform
+        Wpsi = estimator.components_/estimator.noise_variance_
+        cov_z = np.linalg.inv(np.eye(len(estimator.components_)) + np.matmul(Wpsi, estimator.components_.T))
+        return np.matmul(Wpsi.T, cov_z), estimator.mean_
+    
+    W = estimator.components_.T
+    if getattr(estimator, 'whiten', False) is True and hasattr(estimator, 'explained_variance_'):
+        W = W/np.sqrt(estimator.explained_variance_)
+    return W, estimator.mean_
+
+
+def compute_dtype(dtype):
+    '''
+    Floating point type the data is processed in: float64 data stays float64,
+    everything else (float32 and integer MRC modes) is processed in float32
+    '''
+    return np.float64 if np.dtype(dtype)==np.float64 else np.float32
+
+
+def _describe(transform):
+    '''
+    Transform parameters recorded in ensembler.json, only the class name for transforms
+    whose functions can't be identified (the transforms themselves are pickled)
+    '''
+    try:
+        return transform.params()
+    except UnkeyableError:
+        return {'class': type(transform).__module__+'.'+type(transform).__qualname__, 'params': None}
+
 
 class Featurizer():
-    def __init__(self, data, n_components=9):
+    def __init__(self, data, n_components=9, n_jobs=1, shared_svd=True, n_subspace=None,
+                 random_state=0):
         '''
         Takes a length-N list (data) of equally-sized numpy arrays with M elements,        
         Calculates features on the flattened data (where each entry in the list is 
@@ -23,9 +94,25 @@ class Featurizer():
         F.features: length 3*n_components list of features
         F.feature_coeffs: [N, 3*n_components] array of feature coefficients for each sample
         F.feature_labels: length 3*n_components list of feature labels
+        
+        With shared_svd, a single randomized SVD of n_subspace components (default
+        5*n_components) is computed: the PCA features are its leading n_components, and
+        FastICA and FactorAnalysis are fitted on the [N, n_subspace] projection of the data,
+        with their components mapped back to the space of the flattened data. Otherwise
+        each estimator is fitted on the full data.
+        
+        float32 data is processed in float32 throughout.
+        
+        With n_jobs>1 the estimators are fitted concurrently on a thread pool, each
+        with its share of the BLAS threads
         '''
         self._raw_data = data
         self.n_components = n_components
+        self.n_jobs = n_jobs
+        self.shared_svd = shared_svd
+        self.n_subspace = n_subspace if n_subspace is not None else 5*n_components
+        self.random_state = random_state
+        self._subspace = None
         
         self._preprocessed = False
         self._estimators_estimated = False
@@ -33,29 +120,31 @@ class Featurizer():
         
     def fit(self):
         # Flatten and Normalise data into contiguous array
-        print("Preprocessing data . . .")
-        self.preprocessData()
+        with inst.timer('featurizer.preprocess'):
+            self.preprocessData()
+        inst.count('featurizer.particles', self._raw_data_shape[0])
         
         # Fit estimators to data
-        print("Fitting estimators . . .")
-        self.getEstimators()
+        with inst.timer('featurizer.estimators'):
+            self.getEstimators()
         
         # Calculate features
-        print("Calculating features . . .")
-        self.getFeatures()
-        
-        print("Done!")
+        with inst.timer('featurizer.features'):
+            self.getFeatures()
     
     def preprocessData(self):
-        # Stack into contiguous array
+        # Stack into contiguous array, the only copy of the data
         data = np.stack(self._raw_data, axis=0)
+        data = data.astype(compute_dtype(data.dtype), copy=False)
+        self._dtype = data.dtype
         
         # Flatten
         self._raw_data_shape = data.shape
         data = data.reshape(self._raw_data_shape[0], -1)
         
-        # Zero-mean and unit-variance rescaling
-        self._scaler = StandardScaler()
+        # Zero-mean and unit-variance rescaling, in place
+        from sklearn.preprocessing import StandardScaler
+        self._scaler = StandardScaler(copy=False)
         self._scaler.fit(data)
         self.data = self._scaler.transform(data)
         
@@ -69,28 +158,79 @@ class Featurizer():
         '''
         if not self._preprocessed:
             raise ValueError("Data must be preprocessed and estimators constructed")
+        from sklearn import decomposition
+        
+        if self.shared_svd:
+            n_subspace = min(self.n_subspace, self.data.shape[1], self.data.shape[0])
+            inst.log('featurizer.fit', "Calculating %d subspace components using a randomized SVD..." % n_subspace)
+            with inst.timer('featurizer.fit.SVD', n_components=n_subspace):
+                self._subspace = decomposition.PCA(n_components=n_subspace, svd_solver='randomized',
+                                                   random_state=self.random_state)
+                reduced = self._subspace.fit_transform(self.data)
+            self._estimators = self._subspaceEstimators()
+            self._fitEstimators(reduced)
+            self._estimators_estimated = True
+            return
             
         self._estimators = [
             ('PCA',
              decomposition.PCA(n_components=self.n_components, svd_solver='randomized',
                                whiten=True)),
             ('FastICA',
-             decomposition.FastICA(n_components=self.n_components, whiten=True)),
+             decomposition.FastICA(n_components=self.n_components, whiten='unit-variance')),
 
             ('FactorAnalysis',
              decomposition.FactorAnalysis(n_components=self.n_components, max_iter=20))
         ]
-            
-        for name, estimator in self._estimators:
-            print("Calculating %d features using %s..." % (self.n_components, name))
-            t0 = time()
-            estimator.fit(self.data)
-            train_time = (time() - t0)
-            print("\tTime taken = %0.3fs" % train_time)
-            
-            
+        self._fitEstimators(self.data)
+        
         self._estimators_estimated = True
         
+    def _subspaceEstimators(self):
+        '''
+        ('name', estimator) pairs fitted in the subspace of self._subspace, PCA being the subspace itself
+        '''
+        from sklearn import decomposition
+        return [
+            ('FastICA',
+             decomposition.FastICA(n_components=self.n_components, whiten='unit-variance',
+                                   random_state=self.random_state)),
+            ('FactorAnalysis',
+             decomposition.FactorAnalysis(n_components=self.n_components, max_iter=20,
+                                          random_state=self.random_state))
+        ]
+    
+    def _subspaceCoeffs(self, reduced):
+        '''
+        Feature coefficients of data projected onto the subspace (reduced)
+        '''
+        # Whitened PCA coefficients, as PCA(whiten=True)
+        ev = self._subspace.explained_variance_[:self.n_components]
+        coeffs = [reduced[:, :self.n_components]/np.sqrt(ev).astype(reduced.dtype)]
+        for name, estimator in self._estimators:
+            coeffs.append(estimator.transform(reduced))
+        return np.concatenate(coeffs, axis=1)
+        
+    def _fitEstimators(self, data):
+        '''
+        Fits each of self._estimators to data, one after another or on a thread pool
+        '''
+        if self.n_jobs==1:
+            for name, estimator in self._estimators:
+                inst.log('featurizer.fit', "Calculating %d features using %s..." % (self.n_components, name))
+                _, train_time = _fit_estimator(estimator, data)
+                inst.record('featurizer.fit.'+name, train_time, n_components=self.n_components)
+            return
+        
+        inst.log('featurizer.fit', "Calculating %d features using %s..." % (
+            self.n_components, ', '.join(name for name, _ in self._estimators)))
+        n_jobs = min(self.n_jobs, len(self._estimators))
+        with threadpool_limits(limits=blas_threads(n_jobs)), ThreadPoolExecutor(n_jobs) as executor:
+            futures = [executor.submit(_fit_estimator, estimator, data) for _, estimator in self._estimators]
+            for (name, _), future in zip(self._estimators, futures):
+                _, train_time = future.result()
+                inst.record('featurizer.fit.'+name, train_time, n_components=self.n_components)
+        
         
     def getFeatures(self):
         '''
@@ -98,6 +238,15 @@ class Featurizer():
         '''
         if not self._estimators_estimated:
             raise ValueError("Estimators must be fitted to data firts")
+        
+        if self._subspace is not None:
+            components = self.getComponents()
+            self.features = [c for _, comps in components
+                             for c in comps.reshape(self.n_components, *self._raw_data_shape[1:])]
+            self.feature_coeffs = self._subspaceCoeffs(self._subspace.transform(self.data)).astype(self._dtype, copy=False)
+            self.feature_labels = self._featureLabels()
+            self._features_featurized = True
+            return
             
         #self._coeffs = {}
         features = []
@@ -117,13 +266,164 @@ class Featurizer():
             feature_labels.append(labels)
         
         self.features = list(itertools.chain.from_iterable(features))
-        self.feature_coeffs = np.concatenate(feature_coeffs, axis=1)
+        self.feature_coeffs = np.concatenate(feature_coeffs, axis=1).astype(self._dtype, copy=False)
         self.feature_labels = list(itertools.chain.from_iterable(feature_labels))
         
         self._features_featurized = True
         
         
-    def plot2DComponents(self, n_col = 3, cmap=plt.cm.gray):
+    def getComponents(self):
+        '''
+        Returns a list of ('name', [n_components, M] array) pairs of the
+        components of each estimator in the space of the flattened data
+        '''
+        if getattr(self, '_components', None) is not None:
+            return self._components
+        if self._subspace is None:
+            return [(name, estimator.components_) for name, estimator in self._estimators]
+        
+        V = self._subspace.components_
+        components = [('PCA', V[:self.n_components])]
+        for name, estimator in self._estimators:
+            components.append((name, np.matmul(estimator.components_, V)))
+        return components
+    
+    def getAffineMaps(self):
+        '''
+        Returns a list of (W, mean) pairs, one for each estimator, mapping the
+        scaled data to its coefficients as (X - mean) @ W
+        '''
+        if self._subspace is None:
+            return [affine_map(estimator) for name, estimator in self._estimators]
+        
+        V = self._subspace.components_
+        ev = self._subspace.explained_variance_[:self.n_components]
+        maps = [(V[:self.n_components].T/np.sqrt(ev), self._subspace.mean_)]
+        for name, estimator in self._estimators:
+            # (((X - m_pca) @ V.T) - m) @ W == (X - m_pca - m @ V) @ (V.T @ W), as V has orthonormal rows
+            W, mean = affine_map(estimator)
+            maps.append((np.matmul(V.T, W), self._subspace.mean_ + np.matmul(mean, V)))
+        return maps
+    
+    def getProjection(self):
+        '''
+        Folds the scaler and all estimators into a single [M, 3*n_components] matrix
+        and offset, such that the feature coefficients of flattened data X are X @ A + b
+        '''
+        if getattr(self, '_projection', None) is None:
+            if not self._estimators_estimated:
+                raise ValueError("Estimators must be fitted to data firts")
+            
+            scale = self._scaler.scale_ if self._scaler.scale_ is not None else 1.
+            A = []
+            b = []
+            for W, mean in self.getAffineMaps():
+                # ((X - mu)/sigma - mean) @ W == X @ (W/sigma) - (mu/sigma + mean) @ W
+                A.append(W/np.reshape(scale, (-1, 1)))
+                b.append(-np.matmul(self._scaler.mean_/scale + mean, W))
+            # Kept in the type the data was processed in, so float32 data stays float32
+            dtype = getattr(self, '_dtype', np.float64)
+            self._projection = (np.concatenate(A, axis=1).astype(dtype), np.concatenate(b).astype(dtype))
+        return self._projection
+    
+    def transform(self, new_data):
+        '''
+        Calculates the [N, 3*n_components] feature coefficients of new data with the fitted
+        scaler and estimators, without refitting, as a single matrix multiply
+        new_data: length N list or (N, ...) array of arrays shaped like the fitted data
+        '''
+        A, b = self.getProjection()
+        X = new_data if isinstance(new_data, np.ndarray) else np.stack(new_data, axis=0)
+        X = X.reshape(X.shape[0], -1)
+        dtype = np.float32 if X.dtype==np.float32 else np.float64
+        coeffs = np.matmul(X, A.astype(dtype, copy=False))
+        coeffs += b.astype(dtype, copy=False)
+        return coeffs
+    
+    def save(self, path):
+        '''
+        Saves the fitted featurizer to a directory (path)
+        
+        The projection, offset and components are stored as .npy files that load()
+        memory-maps, the scaler and estimators are pickled for refitting or inspection
+        '''
+        if not self._estimators_estimated:
+            raise ValueError("Estimators must be fitted to data before saving")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        
+        A, b = self.getProjection()
+        np.save(os.path.join(path, 'projection.npy'), A)
+        np.save(os.path.join(path, 'offset.npy'), b)
+        np.save(os.path.join(path, 'components.npy'),
+                np.stack([components for _, components in self.getComponents()]))
+        
+        with open(os.path.join(path, 'estimators.pkl'), 'wb') as f:
+            pickle.dump({'scaler': self._scaler, 'estimators': self._estimators,
+                         'ipca': self._subspace}, f)
+        
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'class': type(self).__name__,
+            'n_components': self.n_components,
+            'frame_shape': list(self._raw_data_shape[1:]),
+            'names': [name for name, _ in self.getComponents()],
+            'feature_labels': self._featureLabels(),
+        }
+        with open(os.path.join(path, 'featurizer.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+    
+    @classmethod
+    def load(cls, path, load_estimators=False):
+        '''
+        Loads a featurizer saved with save() for inference with transform()
+        
+        Arrays are memory-mapped, so loading is quick. The pickled scaler and
+        estimators are only read if load_estimators is True
+        '''
+        with open(os.path.join(path, 'featurizer.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['format_version']!=FORMAT_VERSION:
+            raise ValueError("Featurizer in {} has format version {}, expected {}".format(
+                path, meta['format_version'], FORMAT_VERSION))
+        
+        F = cls.__new__(cls)
+        F._raw_data = None
+        F.n_components = meta['n_components']
+        F.n_jobs = 1
+        F._raw_data_shape = (0,) + tuple(meta['frame_shape'])
+        F._projection = (np.load(os.path.join(path, 'projection.npy'), mmap_mode='r'),
+                         np.load(os.path.join(path, 'offset.npy'), mmap_mode='r'))
+        components = np.load(os.path.join(path, 'components.npy'), mmap_mode='r')
+        F._components = list(zip(meta['names'], components))
+        F.features = list(components.reshape(-1, *meta['frame_shape']))
+        F.feature_labels = meta['feature_labels']
+        
+        F._subspace = None
+        F._preprocessed = False
+        F._estimators_estimated = False
+        F._features_featurized = False
+        if load_estimators:
+            with open(os.path.join(path, 'estimators.pkl'), 'rb') as f:
+                fitted = pickle.load(f)
+            F._scaler = fitted['scaler']
+            F._estimators = fitted['estimators']
+            F._subspace = fitted['ipca']
+            F._estimators_estimated = True
+        return F
+    
+    def _featureLabels(self):
+        return ["{} {}".format(name, i) for name, _ in self.getComponents() for i in range(self.n_components)]
+    
+    def releaseData(self):
+        '''
+        Drops the references to the training data, keeping the fitted model and features
+        '''
+        self._raw_data = None
+        self.data = None
+        
+        
+    def plot2DComponents(self, n_col = 3, cmap='gray'):
         '''
         Makes a figure showing the components identified by each estimator
         Note that this will not work for non-image data
@@ -140,13 +440,15 @@ class Featurizer():
         if not self._estimators_estimated:
             raise ValueError("Estimators need to be fitted to data before plotting")
         
+        from matplotlib import pyplot as plt
+        
         n_row = int(np.ceil(self.n_components/n_col))
         image_shape = (self._raw_data_shape[1], self._raw_data_shape[2])
         
-        for name, estimator in self._estimators:
+        for name, components in self.getComponents():
             plt.figure(figsize=(2. * n_col, 2.26 * n_row))
             plt.suptitle(name, size=16)
-            for i, comp in enumerate(estimator.components_):
+            for i, comp in enumerate(components):
                 plt.subplot(n_row, n_col, i + 1)
                 vmax = max(comp.max(), -comp.min())
                 plt.imshow(comp.reshape(image_shape), cmap=cmap,
@@ -157,39 +459,285 @@ class Featurizer():
             plt.subplots_adjust(0.01, 0.05, 0.99, 0.93, 0.04, 0.)
             
             
+class IncrementalFeaturizer(Featurizer):
+    def __init__(self, data, n_components=9, chunk_size=4096, n_subspace=None,
+                 transform=None, max_fit_samples=None, random_state=0, n_jobs=1):
+        '''
+        Out-of-core version of Featurizer, which never holds the full [N, M] data matrix
+        
+        data: an (N, H, W) array or memory-mapped ParticleStack/ParticleStore, read chunk_size
+              particles at a time, or a function returning a fresh iterator of (n, H, W) chunks
+              (it is called once per pass over the data)
+        transform: optional ImageTransform applied to each chunk as it is read
+        
+        The scaler is fitted with partial_fit and an IncrementalPCA of n_subspace components
+        (default 5*n_components) is fitted chunk by chunk. The PCA features are its leading
+        n_components, and FastICA and FactorAnalysis are fitted on the [N, n_subspace] projection
+        of the data (or a random max_fit_samples rows of it), with their components mapped back
+        to the space of the flattened data. feature_coeffs are computed in a final chunked pass.
+        
+        Example:
+        
+        > F = IncrementalFeaturizer(ParticleStack(paths), n_components=8, transform=RobertsTransform())
+        > F.fit()
+        '''
+        super().__init__(data, n_components=n_components, n_jobs=n_jobs, n_subspace=n_subspace,
+                         random_state=random_state)
+        self.chunk_size = chunk_size
+        self.image_transform = transform
+        self.max_fit_samples = max_fit_samples
+        
+    def iterChunks(self):
+        '''
+        Yields [n, M] flattened chunks of the data, of at least n_subspace rows
+        (except possibly the last), as required by IncrementalPCA
+        '''
+        if callable(self._raw_data):
+            chunks = self._raw_data()
+        elif hasattr(self._raw_data, 'iter_batches'):
+            chunks = (batch for _, batch in self._raw_data.iter_batches(self.chunk_size))
+        else:
+            chunks = (np.asarray(self._raw_data[i:i+self.chunk_size])
+                      for i in range(0, len(self._raw_data), self.chunk_size))
+        
+        pending = []
+        n_pending = 0
+        for chunk in chunks:
+            chunk = np.asarray(chunk)
+            dtype = compute_dtype(chunk.dtype)
+            if self.image_transform is not None:
+                # On the data as read, like ImageTransform.apply, so integer data
+                # gives the same features chunked or not
+                chunk = self.image_transform.transform_batch(chunk)
+            chunk = chunk.astype(dtype, copy=False)
+            self._dtype = chunk.dtype
+            self._frame_shape = chunk.shape[1:]
+            pending.append(chunk.reshape(chunk.shape[0], -1))
+            n_pending += chunk.shape[0]
+            if n_pending>=self.n_subspace:
+                yield pending[0] if len(pending)==1 else np.concatenate(pending)
+                pending = []
+                n_pending = 0
+        if pending:
+            yield np.concatenate(pending)
+        
+    def preprocessData(self):
+        # Fit the scaler one chunk at a time
+        from sklearn.preprocessing import StandardScaler
+        self._scaler = StandardScaler()
+        n = 0
+        for chunk in self.iterChunks():
+            self._scaler.partial_fit(chunk)
+            n += chunk.shape[0]
+            
+        self._raw_data_shape = (n,) + tuple(self._frame_shape)
+        self._preprocessed = True
+        
+    def getEstimators(self):
+        '''
+        Fits an IncrementalPCA over the chunks, then ICA and FA on the PCA-reduced data
+        '''
+        if not self._preprocessed:
+            raise ValueError("Data must be preprocessed and estimators constructed")
+        
+        n_features = int(np.prod(self._raw_data_shape[1:]))
+        n_subspace = min(self.n_subspace, n_features, self._raw_data_shape[0])
+        
+        from sklearn import decomposition
+        inst.log('featurizer.fit', "Calculating %d subspace components using IncrementalPCA..." % n_subspace)
+        with inst.timer('featurizer.fit.IncrementalPCA', n_components=n_subspace):
+            self._subspace = decomposition.IncrementalPCA(n_components=n_subspace)
+            for chunk in self.iterChunks():
+                self._subspace.partial_fit(self._scaler.transform(chunk))
+        
+        # Projection onto the subspace is small enough to hold: [N, n_subspace]
+        reduced = np.concatenate([self._subspace.transform(self._scaler.transform(chunk))
+                                  for chunk in self.iterChunks()])
+        if self.max_fit_samples is not None and reduced.shape[0]>self.max_fit_samples:
+            rng = np.random.RandomState(self.random_state)
+            reduced = reduced[rng.choice(reduced.shape[0], self.max_fit_samples, replace=False)]
+        
+        self._estimators = self._subspaceEstimators()
+        self._fitEstimators(reduced)
+            
+        self._estimators_estimated = True
+        
+    def transformChunk(self, chunk):
+        '''
+        Calculates the [n, 3*n_components] feature coefficients of a flattened chunk
+        '''
+        return self._subspaceCoeffs(self._subspace.transform(self._scaler.transform(chunk)))
+        
+    def getFeatures(self):
+        '''
+        Calculates coefficients of data with respect to each estimator, one chunk at a time
+        '''
+        if not self._estimators_estimated:
+            raise ValueError("Estimators must be fitted to data firts")
+        
+        features = []
+        feature_labels = []
+        for name, components in self.getComponents():
+            features.append(components.reshape(self.n_components, *self._raw_data_shape[1:]))
+            feature_labels.append(["{} {}".format(name, i) for i in range(self.n_components)])
+        
+        self.feature_coeffs = np.empty((self._raw_data_shape[0], 3*self.n_components), dtype=np.float32)
+        start = 0
+        for chunk in self.iterChunks():
+            self.feature_coeffs[start:start+chunk.shape[0]] = self.transformChunk(chunk)
+            start += chunk.shape[0]
+        
+        self.features = list(itertools.chain.from_iterable(features))
+        self.feature_labels = list(itertools.chain.from_iterable(feature_labels))
+        
+        self._features_featurized = True
+            
+            
 class FeatureEnsembler():
-    def __init__(self, data, transforms, n_components=9):
+    def __init__(self, data, transforms, n_components=9, cache=None, chunk_size=None,
+                 n_jobs=1, backend='thread'):
         '''
         Constructs an aggregated set of features of (data) by applying the transforms
         in (transforms)
         
         data: should be a length N list of numpy arrays of identical size
         transforms: should be a length P list of ImageTransform objects
+        cache: optional TransformCache, transformed data is then read from it if the same
+               transform has been applied to the same data before
+        chunk_size: if given, each transform is featurized out-of-core with IncrementalFeaturizer,
+                    chunk_size particles at a time, and data can be a ParticleStack/ParticleStore
+        n_jobs: number of transforms featurized concurrently, on a pool of threads or of
+                processes (backend='process', which pickles data to each worker). BLAS threads
+                are split between the jobs and features keep the order of transforms
         
         '''
         
         self.data = data
         self.transforms = transforms
         self.n_components = n_components
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.backend = backend
         
     def fit(self):
         self.getAllFeatures()
         
     
     def getAllFeatures(self):
-        features = []
-        feature_coeffs = []
-        feature_labels = []
-        for i, transform in enumerate(self.transforms):
-            data_tf = transform.apply(self.data)
-            
-            F = Featurizer(data_tf, n_components=self.n_components)
-            F.fit()
-            features.append(F.features)
-            feature_coeffs.append(F.feature_coeffs)
-            feature_labels.append([transform.name+": "+x for x in F.feature_labels])
-            
-            
+        data_fingerprint = None
+        if self.cache is not None:
+            # Hash the data once for all transforms
+            data_fingerprint = fingerprint(self.data)
+        
+        if self.n_jobs==1:
+            results = [self._fitTransform(transform, data_fingerprint) for transform in self.transforms]
+        else:
+            n_jobs = min(self.n_jobs, len(self.transforms))
+            if self.backend=='process':
+                executor = ProcessPoolExecutor(n_jobs, initializer=_limit_threads,
+                                               initargs=(blas_threads(n_jobs),))
+                limits = None
+            else:
+                executor = ThreadPoolExecutor(n_jobs)
+                limits = threadpool_limits(limits=blas_threads(n_jobs))
+            try:
+                with executor:
+                    futures = [executor.submit(self._fitTransform, transform, data_fingerprint)
+                               for transform in self.transforms]
+                    results = [future.result() for future in futures]
+            finally:
+                if limits is not None:
+                    limits.restore_original_limits()
+        
+        self.featurizers, features, feature_coeffs, feature_labels = (list(x) for x in zip(*results))
         self.features = list(itertools.chain.from_iterable(features))
         self.feature_coeffs = np.concatenate(feature_coeffs, axis=1)
-        self.feature_labels = list(itertools.chain.from_iterable(feature_labels))
\ No newline at end of file
+        self.feature_labels = list(itertools.chain.from_iterable(feature_labels))
+        
+        
+    def _fitTransform(self, transform, data_fingerprint=None):
+        '''
+        Applies a single transform and fits a featurizer to the result,
+        returns (featurizer, features, feature_coeffs, feature_labels)
+        '''
+        if self.cache is not None:
+            data_tf = self.cache.apply(transform, self.data, data_fingerprint)
+            F = self._featurizer(data_tf)
+        elif self.chunk_size is not None:
+            # Transform chunk by chunk while featurizing
+            F = self._featurizer(self.data, transform=transform)
+        else:
+            data_tf = transform.apply(self.data)
+            F = self._featurizer(data_tf)
+        
+        F.fit()
+        F.releaseData()
+        return F, F.features, F.feature_coeffs, [transform.name+": "+x for x in F.feature_labels]
+        
+        
+    def _featurizer(self, data, transform=None):
+        if self.chunk_size is None:
+            return Featurizer(data, n_components=self.n_components)
+        return IncrementalFeaturizer(data, n_components=self.n_components,
+                                     chunk_size=self.chunk_size, transform=transform)
+    
+    def transform(self, new_data, chunk_size=4096):
+        '''
+        Calculates the feature coefficients of new data (a list or (N, H, W) array,
+        ParticleStack or ParticleStore) with the fitted transforms and featurizers,
+        chunk_size particles at a time and without refitting
+        '''
+        n = len(new_data)
+        out = np.empty((n, len(self.feature_labels)), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            chunk = np.asarray(new_data[start:start+chunk_size])
+            col = 0
+            for transform, F in zip(self.transforms, self.featurizers):
+                coeffs = F.transform(transform.transform_batch(chunk))
+                out[start:start+len(chunk), col:col+coeffs.shape[1]] = coeffs
+                col += coeffs.shape[1]
+        return out
+    
+    def save(self, path):
+        '''
+        Saves the transforms and fitted featurizers to a directory (path),
+        one subdirectory per featurizer
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for i, F in enumerate(self.featurizers):
+            F.save(os.path.join(path, 'featurizer_{}'.format(i)))
+        with open(os.path.join(path, 'transforms.pkl'), 'wb') as f:
+            pickle.dump(self.transforms, f)
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'n_components': self.n_components,
+            'transforms': [_describe(t) for t in self.transforms],
+            'featurizers': [type(F).__name__ for F in self.featurizers],
+            'feature_labels': self.feature_labels,
+        }
+        with open(os.path.join(path, 'ensembler.json'), 'w') as f:
+            json.dump(meta, f, indent=1, default=repr)
+    
+    @classmethod
+    def load(cls, path, load_estimators=False):
+        '''
+        Loads an ensembler saved with save() for inference with transform()
+        '''
+        with open(os.path.join(path, 'ensembler.json'), 'r') as f:
+            meta = json.load(f)
+        if meta['format_version']!=FORMAT_VERSION:
+            raise ValueError("Ensembler in {} has format version {}, expected {}".format(
+                path, meta['format_version'], FORMAT_VERSION))
+        with open(os.path.join(path, 'transforms.pkl'), 'rb') as f:
+            transforms = pickle.load(f)
+        
+        E = cls(None, transforms, n_components=meta['n_components'])
+        featurizer_classes = {'Featurizer': Featurizer, 'IncrementalFeaturizer': IncrementalFeaturizer}
+        E.featurizers = [featurizer_classes[name].load(os.path.join(path, 'featurizer_{}'.format(i)),
+                                                       load_estimators=load_estimators)
+                         for i, name in enumerate(meta['featurizers'])]
+        E.features = list(itertools.chain.from_iterable(F.features for F in E.featurizers))
+        E.feature_labels = meta['feature_labels']
+        return E
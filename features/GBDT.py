@@ -1,21 +1,112 @@
 # For GBDT
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from time import perf_counter
 import numpy as np
-from sklearn.metrics import roc_curve
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error,roc_auc_score,precision_score
-from sklearn.preprocessing import StandardScaler
-import pandas as pd
-import lightgbm as lgb
-from matplotlib import pyplot as plt
+
+import instrumentation as inst
+
+
+def _lightgbm():
+    '''
+    Imports lightgbm when first needed rather than with this module
+    '''
+    import lightgbm as lgb
+    lgb.Sequence.register(FeatureChunks)
+    return lgb
+
+
+class FeatureChunks():
+    # Rows LightGBM reads at a time, FeatureChunks is registered as a lightgbm.Sequence
+    batch_size = 4096
+
+    def __init__(self, paths, rows=None, scaler=None, batch_size=4096):
+        '''
+        Rows of a feature matrix stored as a list of .npy files (paths) of consecutive rows,
+        read on demand from memory-mapped files so LightGBM can build a Dataset a batch
+        at a time without the whole matrix in memory
+
+        rows: sorted global indices of the rows to expose (e.g. a train split), default all
+        scaler: fitted scaler applied to the rows as they are read
+        '''
+        self.paths = list(paths)
+        self.scaler = scaler
+        self.batch_size = batch_size
+        self._files = [np.load(p, mmap_mode='r') for p in self.paths]
+        self.offsets = np.concatenate([[0], np.cumsum([len(f) for f in self._files])])
+        self.rows = np.arange(self.offsets[-1]) if rows is None else np.asarray(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def n_features(self):
+        return self._files[0].shape[1]
+
+    def __getitem__(self, idx):
+        rows = self.rows[idx]
+        if np.ndim(rows)==0:
+            return self[[idx]][0]
+        out = np.empty((len(rows), self.n_features), dtype=np.float64)
+        file_idx = np.searchsorted(self.offsets, rows, side='right') - 1
+        for f in np.unique(file_idx):
+            mask = file_idx==f
+            out[mask] = self._files[f][rows[mask] - self.offsets[f]]
+        if self.scaler is not None:
+            out = self.scaler.transform(out)
+        return out
+
+
+def spool_chunks(chunks, path):
+    '''
+    Writes an iterable of (x, y) chunks to .npy files in folder (path), one at a time,
+    returns the list of feature files and the concatenated labels
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    paths = []
+    labels = []
+    for i, (x, y) in enumerate(chunks):
+        fname = os.path.join(path, 'chunk_{:06d}.npy'.format(i))
+        np.save(fname, np.asarray(x))
+        paths.append(fname)
+        labels.append(np.asarray(y))
+    return paths, np.concatenate(labels)
+
+
+def chunks_fingerprint(paths, y, scale, test_size, random_state, dataset_params=None):
+    '''
+    Identifies the inputs a binned Dataset was built from: the path, size and modification
+    time of each feature file, a hash of the labels and the scaling, split and Dataset parameters
+    '''
+    files = []
+    for p in paths:
+        st = os.stat(p)
+        files.append((os.path.abspath(p), st.st_size, st.st_mtime_ns))
+    y = np.ascontiguousarray(y)
+    y_hash = hashlib.blake2b(y.data, digest_size=20).hexdigest()
+    return {'files': files, 'y': (y.shape, y.dtype.str, y_hash), 'scale': bool(scale),
+            'test_size': test_size, 'random_state': random_state,
+            'dataset_params': sorted((dataset_params or {}).items())}
+
 
 class GBDTWrapper():
-    def __init__(self, x, y, x_labels=None, params=None, random_state=0, test_size=0.3):
+    def __init__(self, x, y, x_labels=None, params=None, random_state=0, test_size=0.3, scale=True):
         '''
         A convenience wrapper for training a GBDT
         x: NxM array of N samples of M dependent variables
         y: N array of labels for each of the N samples
+        scale: normalise x first, trees don't need it so False saves a copy of x
         
+        For feature matrices that don't fit in memory use GBDTWrapper.from_chunks
         '''
+        import pandas as pd
+        from sklearn.model_selection import train_test_split
+        from sklearn.preprocessing import StandardScaler
+        lgb = _lightgbm()
         self._trained = False
         
         self.x = x
@@ -26,22 +117,160 @@ class GBDTWrapper():
         self.test_size = test_size
         
         # Normalise x data
-        self._scaler = StandardScaler()
-        if self.x_labels is not None:
-            columns = [x+' normed' for x in self.x_labels]
+        if scale:
+            self._scaler = StandardScaler()
+            if self.x_labels is not None:
+                columns = [x+' normed' for x in self.x_labels]
+            else:
+                columns = None
+            self.X = pd.DataFrame(self._scaler.fit_transform(self.x),
+                                  columns = columns)
         else:
-            columns = None
-        self.X = pd.DataFrame(self._scaler.fit_transform(self.x),
-                              columns = columns)
+            self._scaler = None
+            self.X = pd.DataFrame(self.x, columns=self.x_labels, copy=False)
         
         # Make test/train split
         self.X_train, self.X_test, self.y_train, self.y_test = train_test_split(self.X, self.Y, test_size=self.test_size, random_state=self.random_state)
         
         # Convert to LGB format
         self.lgb_dataset = lgb.Dataset(self.X_train, label=self.y_train)
+        self.lgb_valid = lgb.Dataset(self.X_test, label=self.y_test, reference=self.lgb_dataset)
+    
+    @classmethod
+    def from_chunks(cls, chunks, y=None, x_labels=None, random_state=0, test_size=0.3, scale=False,
+                    dataset_path=None, spool_dir=None, dataset_params=None, batch_size=4096):
+        '''
+        Out-of-core alternative to the constructor, LightGBM's binned Dataset is built
+        directly from chunked feature files, a batch of rows at a time, so peak memory
+        stays near one copy of the (binned) features
+        
+        chunks: list of .npy feature files of consecutive rows, with y the labels of all rows,
+                or an iterable of (x, y) chunks (e.g. a generator), spooled to spool_dir first
+        scale: fit a StandardScaler in one pass over the chunks and apply it as rows are read
+        dataset_path: if given, the binned train/validation Datasets are saved to
+                      dataset_path and dataset_path+'.valid', and loaded from there on later
+                      runs instead of being rebuilt, as long as the feature files (path, size,
+                      modification time), labels, scale, split and dataset_params are unchanged
+                      (see chunks_fingerprint). Spooled chunks are new files, so an iterable
+                      of chunks always rebuilds the Dataset
+        dataset_params: LightGBM Dataset parameters, e.g. {'max_bin': 63}
+        
+        Example:
+        
+        > gbdt = GBDTWrapper.from_chunks(feature_files, labels, dataset_path='../data/train.bin')
+        > gbdt.train()
+        '''
+        from sklearn.preprocessing import StandardScaler
+        lgb = _lightgbm()
+        self = cls.__new__(cls)
+        self._trained = False
+        self.x = self.X = self.Y = None
+        self.x_labels = x_labels
+        self.random_state = random_state
+        self.test_size = test_size
+        
+        if y is None:
+            paths, y = spool_chunks(chunks, spool_dir or tempfile.mkdtemp(prefix='gbdt_chunks_'))
+        else:
+            paths = list(chunks)
+        y = np.asarray(y)
+        fingerprint = chunks_fingerprint(paths, y, scale, test_size, random_state, dataset_params)
+        
+        valid_path = dataset_path+'.valid' if dataset_path is not None else None
+        meta_path = dataset_path+'.meta.pkl' if dataset_path is not None else None
+        meta = None
+        if dataset_path is not None and os.path.exists(meta_path):
+            with open(meta_path, 'rb') as f:
+                meta = pickle.load(f)
+            if meta.get('fingerprint')!=fingerprint:
+                inst.log('gbdt.dataset', "Rebuilding {}, its inputs have changed".format(dataset_path))
+                meta = None
+        
+        if meta is not None:
+            self._scaler = meta['scaler']
+            test_rows = meta['test_rows']
+        else:
+            self._scaler = None
+            if scale:
+                self._scaler = StandardScaler()
+                for p in paths:
+                    self._scaler.partial_fit(np.load(p, mmap_mode='r'))
+            
+            # Same split sizes as train_test_split
+            n = len(y)
+            n_test = int(np.ceil(test_size*n))
+            perm = np.random.RandomState(random_state).permutation(n)
+            test_rows = np.sort(perm[:n_test])
+        
+        train_mask = np.ones(FeatureChunks(paths).offsets[-1], dtype=bool)
+        train_mask[test_rows] = False
+        self.X_train = FeatureChunks(paths, np.flatnonzero(train_mask), self._scaler, batch_size)
+        self.X_test = FeatureChunks(paths, test_rows, self._scaler, batch_size)
         
+        if meta is not None:
+            self.lgb_dataset = lgb.Dataset(dataset_path, params=dataset_params).construct()
+            self.lgb_valid = lgb.Dataset(valid_path, reference=self.lgb_dataset,
+                                         params=dataset_params).construct()
+            self.y_train = self.lgb_dataset.get_label()
+            self.y_test = self.lgb_valid.get_label()
+            return self
+        
+        self.y_train = y[train_mask]
+        self.y_test = y[test_rows]
+        self.lgb_dataset = lgb.Dataset(self.X_train, label=self.y_train, params=dataset_params,
+                                       feature_name=x_labels if x_labels is not None else 'auto',
+                                       free_raw_data=True)
+        self.lgb_valid = lgb.Dataset(self.X_test, label=self.y_test, reference=self.lgb_dataset,
+                                     params=dataset_params, free_raw_data=True)
+        if dataset_path is not None:
+            # LightGBM doesn't overwrite existing binary files
+            for p in (meta_path, dataset_path, valid_path):
+                if os.path.exists(p):
+                    os.remove(p)
+            self.lgb_dataset.construct().save_binary(dataset_path)
+            self.lgb_valid.construct().save_binary(valid_path)
+            # Written last, so a dataset is only reused once it has been saved completely
+            with open(meta_path, 'wb') as f:
+                pickle.dump({'scaler': self._scaler, 'test_rows': test_rows, 'paths': paths,
+                             'fingerprint': fingerprint}, f)
+        return self
+    
+    def _predict(self, X, batch_size=65536, num_threads=0):
+        '''
+        Predicts (already scaled) rows in batches, so X can be a FeatureChunks of files
+        '''
+        if not isinstance(X, FeatureChunks) and len(X)<=batch_size:
+            return self._predictBatch(X, num_threads)
+        return np.concatenate([self._predictBatch(X[i:i+batch_size], num_threads)
+                               for i in range(0, len(X), batch_size)])
     
-    def train(self, epochs=10000, params=None, random_state=0):
+    def _predictBatch(self, X, num_threads=0):
+        if getattr(self, '_predictor', None) is not None:
+            import tl2cgen
+            return self._predictor.predict(tl2cgen.DMatrix(np.asarray(X, dtype=np.float32))).ravel()
+        return self.model.predict(X, num_threads=num_threads)
+    
+    def train(self, epochs=10000, params=None, random_state=0, early_stopping_rounds=200,
+              num_threads=0, max_bin=None, min_data_in_bin=None, histogram_pool_size=None,
+              force_col_wise=None, trim=True, monitor_train=False):
+        '''
+        Trains for up to (epochs) rounds, stopping once the metric on the held-out split
+        hasn't improved for early_stopping_rounds rounds (None to disable)
+        
+        num_threads: LightGBM threads, 0 uses all cores
+        max_bin, min_data_in_bin: feature binning, only used if the Dataset hasn't been
+                                  built yet (not for datasets loaded from a .bin file)
+        histogram_pool_size: MB of cached histograms, -1 for no limit
+        force_col_wise: True/False forces column/row-wise histogram building, None lets LightGBM choose
+        trim: keep only the trees up to the best iteration, so prediction is faster
+        monitor_train: also record the metric on the training set (slower)
+        
+        After training:
+        self.evals_result: metric curves, e.g. self.evals_result['valid']['auc']
+        self.iteration_times: seconds taken by each boosting round
+        self.best_iteration: number of trees kept
+        '''
+        lgb = _lightgbm()
         if params is None:
             params={
             "objective" : "binary",
@@ -52,23 +281,146 @@ class GBDTWrapper():
             "verbosity" : 1,
             "seed": random_state
             }
+        params = dict(params)
+        params['num_threads'] = num_threads
+        for k, v in [('max_bin', max_bin), ('min_data_in_bin', min_data_in_bin),
+                     ('histogram_pool_size', histogram_pool_size), ('force_col_wise', force_col_wise)]:
+            if v is not None:
+                params[k] = v
+        if force_col_wise is False:
+            params['force_row_wise'] = True
         self.params = params
         
-        print('Training GBDT . . .')
-        self.model = lgb.train(self.params, self.lgb_dataset, epochs)
+        valid_sets = [self.lgb_valid]
+        valid_names = ['valid']
+        if monitor_train:
+            valid_sets.insert(0, self.lgb_dataset)
+            valid_names.insert(0, 'train')
+        
+        self.evals_result = {}
+        self.iteration_times = []
+        last = [perf_counter()]
+        def timer(env):
+            now = perf_counter()
+            self.iteration_times.append(now - last[0])
+            last[0] = now
+        
+        callbacks = [lgb.record_evaluation(self.evals_result), timer]
+        if early_stopping_rounds is not None:
+            callbacks.append(lgb.early_stopping(early_stopping_rounds, verbose=params.get('verbosity', 1)>0))
+        
+        inst.log('gbdt.train', 'Training GBDT . . .')
+        t0 = perf_counter()
+        self.model = lgb.train(self.params, self.lgb_dataset, epochs, valid_sets=valid_sets,
+                               valid_names=valid_names, callbacks=callbacks)
+        self.train_time = perf_counter() - t0
+        self.best_iteration = self.model.best_iteration or self.model.current_iteration()
+        if trim and self.best_iteration<self.model.current_iteration():
+            self.model = lgb.Booster(model_str=self.model.model_to_string(num_iteration=self.best_iteration))
         self._trained = True
-        print('Done!')
+        inst.record('gbdt.train', self.train_time, trees=self.best_iteration,
+                    rounds=len(self.iteration_times))
+        inst.count('gbdt.train_rows', self.lgb_dataset.num_data())
         
         
+    def predict_proba(self, features, batch_size=65536, num_threads=0):
+        '''
+        Scores new particles with the trained model
+        
+        features: NxM array of features, or a list of .npy files of consecutive rows,
+                  which are memory-mapped and read batch_size rows at a time
+        num_threads: LightGBM threads per batch, 0 uses all cores
+        
+        Returns a length N array of probabilities of the positive class
+        '''
+        if not self._trained:
+            raise ValueError("Need to train model first")
+        if isinstance(features, (list, tuple)):
+            features = FeatureChunks(features, scaler=self._scaler, batch_size=batch_size)
+        else:
+            features = np.asarray(features)
+            if self._scaler is not None:
+                # Scaled per batch, so the scaled copy is never the size of the whole matrix
+                scores = np.empty(len(features))
+                for i in range(0, len(features), batch_size):
+                    batch = self._scaler.transform(features[i:i+batch_size])
+                    scores[i:i+batch_size] = self._predictBatch(batch, num_threads)
+                return scores
+        return self._predict(features, batch_size, num_threads)
+    
+    def save(self, path, compile=False):
+        '''
+        Saves everything needed to score new particles to folder (path):
+        the model (model.txt), the fitted scaler (scaler.pkl) and the feature labels (gbdt.json),
+        and with compile=True also a compiled shared library of the trees (see export_library)
+        '''
+        if not self._trained:
+            raise ValueError("Need to train model first")
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.model.save_model(os.path.join(path, 'model.txt'))
+        with open(os.path.join(path, 'scaler.pkl'), 'wb') as f:
+            pickle.dump(self._scaler, f)
+        meta = {
+            'x_labels': list(self.x_labels) if self.x_labels is not None else None,
+            'best_iteration': int(self.model.current_iteration()),
+            'params': getattr(self, 'params', None),
+            'compiled': bool(compile),
+        }
+        with open(os.path.join(path, 'gbdt.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        if compile:
+            self.export_library(os.path.join(path, 'model.so'))
+    
+    @classmethod
+    def load(cls, path, compiled=None):
+        '''
+        Loads a model saved with save() for prediction, using its compiled library if
+        it was saved with one (or compiled is True)
+        '''
+        with open(os.path.join(path, 'gbdt.json'), 'r') as f:
+            meta = json.load(f)
+        self = cls.__new__(cls)
+        self.x = self.X = self.Y = None
+        self.x_labels = meta['x_labels']
+        self.params = meta['params']
+        self.model = _lightgbm().Booster(model_file=os.path.join(path, 'model.txt'))
+        with open(os.path.join(path, 'scaler.pkl'), 'rb') as f:
+            self._scaler = pickle.load(f)
+        self._predictor = None
+        if compiled if compiled is not None else meta['compiled']:
+            import tl2cgen
+            self._predictor = tl2cgen.Predictor(os.path.join(path, 'model.so'))
+        self._trained = True
+        return self
+    
+    def export_library(self, libpath, toolchain='gcc', parallel_comp=8):
+        '''
+        Compiles the trees into a shared library (libpath) with treelite and tl2cgen,
+        which are optional dependencies, for lower latency scoring than the LightGBM runtime
+        '''
+        try:
+            import treelite
+            import tl2cgen
+        except ImportError:
+            raise ImportError("Exporting a compiled model needs treelite and tl2cgen: "
+                              "pip install treelite tl2cgen")
+        model = treelite.frontend.from_lightgbm(self.model)
+        tl2cgen.export_lib(model, toolchain=toolchain, libpath=libpath,
+                           params={'parallel_comp': parallel_comp})
+        return libpath
+    
     def plotROC(self):
         if not self._trained:
             raise ValueError("Need to train model first")
+        from sklearn.metrics import roc_auc_score, roc_curve
+        from matplotlib import pyplot as plt
         
         # generate a no skill prediction (majority class)
         ns_probs = [0 for _ in range(len(self.y_test))]
 
         # predict probabilities
-        lr_probs = self.model.predict(self.X_test)
+        lr_probs = self._predict(self.X_test)
 
         # calculate scores
         ns_auc = roc_auc_score(self.y_test, ns_probs)
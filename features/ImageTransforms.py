@@ -1,10 +1,113 @@
+import hashlib
 import numpy as np
-from skimage import filters
-import cv2
-from scipy import fftpack, ndimage
+
+import instrumentation as inst
+
+# Number of images cv2.resize handles per call as channels of one image,
+# kept well below the channel limit of all OpenCV versions
+CV_MAX_CHANNELS = 128
+
+
+def as_stack(data):
+    '''
+    Returns data (a list of equally-sized arrays, an (N, H, W) array or a
+    ParticleStack/ParticleStore) as an (N, H, W) array, without copying arrays
+    '''
+    if isinstance(data, np.ndarray):
+        return data
+    if hasattr(data, 'take') and hasattr(data, 'frame_shape'):
+        return data[:]
+    return np.stack(data, axis=0)
+
+
+class UnkeyableError(ValueError):
+    '''
+    Raised by callable_key for functions that use values it can't identify safely
+    '''
+
+
+# Values identified by their repr
+_REPR_TYPES = (type(None), type(Ellipsis), bool, int, float, complex, str, bytes, slice, range,
+               np.generic, np.dtype)
+
+
+def _value_key(v, seen):
+    '''
+    Stable description of a value used by a function, for callable_key
+    '''
+    if isinstance(v, _REPR_TYPES):
+        return repr(v)
+    if isinstance(v, np.ndarray):
+        return 'ndarray{}{}:{}'.format(v.shape, v.dtype.str,
+                                       hashlib.blake2b(np.ascontiguousarray(v).data, digest_size=20).hexdigest())
+    if isinstance(v, type(np)):
+        return 'module:'+v.__name__
+    if isinstance(v, type):
+        return 'class:'+v.__module__+'.'+v.__qualname__
+    if isinstance(v, ImageTransform):
+        return 'transform:'+repr(v.params())
+    if hasattr(v, 'co_code'):
+        return 'code:'+_code_key(v, {}, seen)
+    if callable(v):
+        return 'callable:'+callable_key(v, seen)
+    if isinstance(v, (list, tuple)):
+        return type(v).__name__+repr([_value_key(x, seen) for x in v])
+    if isinstance(v, (set, frozenset)):
+        return type(v).__name__+repr(sorted(_value_key(x, seen) for x in v))
+    if isinstance(v, dict):
+        return 'dict'+repr(sorted((repr(k), _value_key(x, seen)) for k, x in v.items()))
+    raise UnkeyableError("Can't identify a value of type {} used by a function".format(type(v).__name__))
+
+
+def _code_key(code, globals_, seen):
+    '''
+    Bytecode, constants and the values of the globals that a code object and those nested in it refer to
+    '''
+    consts = [_code_key(c, globals_, seen) if hasattr(c, 'co_code') else _value_key(c, seen)
+              for c in code.co_consts]
+    # co_names also holds attribute names, only those that are globals of the function are looked up
+    names = [(n, _value_key(globals_[n], seen)) for n in code.co_names if n in globals_]
+    return repr((code.co_code, consts, names))
+
+
+def callable_key(func, seen=()):
+    '''
+    Identifies a function by its name together with a hash of its bytecode, constants,
+    defaults, closure values, the globals it reads and the object it is bound to, so that
+    different lambdas or closures with the same name get different keys, and changing a
+    module-level value a function reads changes its key.
+    Raises UnkeyableError if one of those values can't be identified safely
+    '''
+    name = (getattr(func, '__module__', None) or '')+'.'+getattr(func, '__qualname__', type(func).__qualname__)
+    if id(func) in seen:
+        # A recursive closure refers to itself
+        return name
+    seen = seen+(id(func),)
+    
+    if hasattr(func, 'func') and hasattr(func, 'args') and hasattr(func, 'keywords'):
+        # functools.partial
+        parts = [callable_key(func.func, seen), _value_key(func.args, seen), _value_key(func.keywords, seen)]
+    elif hasattr(func, '__code__'):
+        parts = [_code_key(func.__code__, getattr(func, '__globals__', {}), seen),
+                 _value_key(func.__defaults__, seen), _value_key(func.__kwdefaults__, seen),
+                 [_value_key(c.cell_contents, seen) for c in (func.__closure__ or ())]]
+    elif type(func).__module__ in ('builtins', 'numpy'):
+        # Builtins and ufuncs are identified by their name
+        parts = []
+    else:
+        raise UnkeyableError("Can't identify callable {} of type {}".format(name, type(func).__name__))
+    bound = getattr(func, '__self__', None)
+    if bound is not None and not isinstance(bound, type(np)):
+        parts.append(_value_key(bound, seen))
+    if not parts:
+        return name
+    return '{}:{}'.format(name, hashlib.blake2b(repr(parts).encode(), digest_size=20).hexdigest())
 
 
 class ImageTransform():
+    # Whether transform_batch(stack, out=stack) is safe, i.e. the output can overwrite the input
+    inplace = False
+
     def __init__(self):
         self.name = None
 
@@ -14,9 +117,50 @@ class ImageTransform():
         '''
         return arr
 
+    def params(self):
+        '''
+        Returns the class and parameters that determine the output of the transform,
+        used to key cached results
+        '''
+        params = {}
+        for k, v in sorted(vars(self).items()):
+            if k.startswith('_') or k=='name':
+                continue
+            if isinstance(v, ImageTransform):
+                v = v.params()
+            elif isinstance(v, (list, tuple)) and v and all(isinstance(x, ImageTransform) for x in v):
+                v = [x.params() for x in v]
+            elif callable(v):
+                # Raises UnkeyableError if the function can't be identified
+                v = callable_key(v)
+            params[k] = v
+        return {'class': type(self).__module__+'.'+type(self).__qualname__, 'params': params}
+
+    def transform_batch(self, stack, out=None):
+        '''
+        Apply transform to an (N, H, W) array, returning one contiguous (N, ...) array
+        If given, the result is written into (out) instead of a new array
+        Subclasses override this with a vectorised version, by default transform is
+        called on each image
+        '''
+        stack = np.asarray(stack)
+        if len(stack)==0:
+            return stack.copy() if out is None else out
+        first = self.transform(stack[0])
+        if out is None:
+            out = np.empty((len(stack),)+first.shape, dtype=first.dtype)
+        out[0] = first
+        for i in range(1, len(stack)):
+            out[i] = self.transform(stack[i])
+        return out
+
     def apply(self, data):
-        print("Applying transform: "+self.name)
-        return [self.transform(x) for x in data]
+        inst.log('transform', "Applying transform: "+self.name)
+        stack = as_stack(data)
+        with inst.timer('transform.'+self.name, particles=len(stack)):
+            out = self.transform_batch(stack)
+        inst.count('transform.particles', len(stack))
+        return out
 
 
 class IdentityTransform(ImageTransform):
@@ -25,12 +169,29 @@ class IdentityTransform(ImageTransform):
         self.name = "Identity"
         self.resized_shape = resized_shape
 
+    inplace = True
+
+    def transform_batch(self, stack, out=None):
+        if out is None:
+            return np.asarray(stack)
+        if out is not stack:
+            np.copyto(out, stack)
+        return out
+
 
 class FuncTransform(ImageTransform):
-    def __init__(self, func=None, ):
+    def __init__(self, func=None, name="Func"):
+        '''
+        Wraps a function of a single array (func), which is called on each image
+        '''
         super().__init__()
-        self.name = "Identity"
-        self.resized_shape = resized_shape
+        self.name = name
+        self.func = func
+
+    def transform(self, arr):
+        if self.func is None:
+            return arr
+        return self.func(arr)
 
 class RobertsTransform(ImageTransform):
     def __init__(self, resized_shape=(28,28)):
@@ -39,27 +200,102 @@ class RobertsTransform(ImageTransform):
         self.resized_shape = resized_shape
 
     def transform(self, arr):
+        import cv2
+        from skimage import filters
+        
         # Resize
         res = cv2.resize(arr, dsize=self.resized_shape, interpolation=cv2.INTER_LINEAR)
 
         # Filter
         return filters.roberts(res)
 
+    def transform_batch(self, stack, out=None):
+        stack = np.asarray(stack)
+        if stack.dtype.kind=='f':
+            stack = stack.astype(np.float64 if stack.dtype.itemsize>4 else np.float32, copy=False)
+        else:
+            from skimage import util
+            stack = util.img_as_float(stack)
+        res = resize_batch(stack, self.resized_shape)
+        return roberts_batch(res, out=out, overwrite=True)
+
+
+def roberts_batch(stack, out=None, overwrite=False):
+    '''
+    Roberts cross edge magnitude of every image in a float (N, H, W) array, matching
+    skimage.filters.roberts per image, whose 'reflect' boundary repeats the last row and column
+    overwrite: (stack) may be used as scratch space
+    '''
+    p = np.pad(stack, ((0, 0), (0, 1), (0, 1)), mode='edge')
+    pos = np.subtract(p[:, 1:, 1:], p[:, :-1, :-1], out=out)
+    neg = np.subtract(p[:, 1:, :-1], p[:, :-1, 1:], out=stack if overwrite else None)
+    np.square(pos, out=pos)
+    np.square(neg, out=neg)
+    pos += neg
+    np.sqrt(pos, out=pos)
+    pos /= np.sqrt(2)
+    return pos
+
+
+def resize_batch(stack, dsize, interpolation=None):
+    '''
+    cv2.resize of every image in an (N, H, W) array to dsize=(width, height),
+    done CV_MAX_CHANNELS images at a time by treating them as channels
+    interpolation defaults to cv2.INTER_LINEAR
+    '''
+    import cv2
+    if interpolation is None:
+        interpolation = cv2.INTER_LINEAR
+    N = stack.shape[0]
+    out = np.empty((N, dsize[1], dsize[0]), dtype=stack.dtype)
+    for start in range(0, N, CV_MAX_CHANNELS):
+        chunk = np.ascontiguousarray(stack[start:start+CV_MAX_CHANNELS].transpose(1, 2, 0))
+        res = cv2.resize(chunk, dsize=dsize, interpolation=interpolation)
+        out[start:start+CV_MAX_CHANNELS] = res.reshape(dsize[1], dsize[0], -1).transpose(2, 0, 1)
+    return out
+
 
 class FFT2Transform(ImageTransform):
     def __init__(self, central_width=50):
+        '''
+        Magnitude of the centred 2D FFT, cropped to its central (central_width, central_width)
+        block, or to the whole spectrum along an axis shorter than central_width
+        '''
         super().__init__()
         self.name = "FFT2"
         self.central_width = central_width
 
+    def _crop(self, H, W):
+        '''
+        First row, first column and size of the central crop of an (H, W) spectrum
+        '''
+        CH, CW = min(self.central_width, H), min(self.central_width, W)
+        return int((H-CH)/2), int((W-CW)/2), CH, CW
+
     def transform(self, arr):
         # Get absolute values of 2D FFT, with centrally shifting
+        from scipy import fftpack
         fft2 = np.fft.fftshift(np.abs(fftpack.fft2(arr)))
 
         # Get center crop
-        H, W = fft2.shape
-        C = self.central_width
-        return fft2[int((H-C)/2):int((H-C)/2)+C, int((W-C)/2):int((W-C)/2)+C]
+        top, left, CH, CW = self._crop(*fft2.shape)
+        return fft2[top:top+CH, left:left+CW]
+
+    def transform_batch(self, stack, out=None):
+        stack = np.asarray(stack)
+        from scipy import fft
+        fft2 = fft.fft2(stack, axes=(-2, -1), workers=-1)
+
+        # Take the centre crop of the shifted spectrum by indexing, instead of
+        # shifting the whole spectrum, so only the kept centre is copied
+        _, H, W = fft2.shape
+        top, left, CH, CW = self._crop(H, W)
+        rows = (np.arange(top, top+CH) - H//2) % H
+        cols = (np.arange(left, left+CW) - W//2) % W
+        crop = fft2[:, rows[:, None], cols[None, :]]
+        if out is None:
+            out = np.empty(crop.shape, dtype=crop.real.dtype)
+        return np.abs(crop, out=out)
     
 class AutoCorrelation(ImageTransform):
     def __init__(self, mode="same", method="fft"):
@@ -69,11 +305,38 @@ class AutoCorrelation(ImageTransform):
         self.method = method
         
     def transform(self, arr):
+        from scipy import signal
         return signal.correlate(arr, arr, mode=self.mode, method=self.method)
+
+    def transform_batch(self, stack, out=None):
+        from scipy import fft
+        stack = np.asarray(stack)
+        if self.method=="direct" or stack.dtype.kind=='c':
+            return super().transform_batch(stack, out=out)
+        # Correlation with itself is convolution with the flipped image,
+        # done as one batched real FFT over the stack
+        _, H, W = stack.shape
+        full = (2*H-1, 2*W-1)
+        fshape = (fft.next_fast_len(full[0], True), fft.next_fast_len(full[1], True))
+        F = fft.rfft2(stack, s=fshape, axes=(-2, -1), workers=-1)
+        G = fft.rfft2(stack[:, ::-1, ::-1], s=fshape, axes=(-2, -1), workers=-1)
+        F *= G
+        corr = fft.irfft2(F, s=fshape, axes=(-2, -1), workers=-1)[:, :full[0], :full[1]]
+        if self.mode=="same":
+            corr = corr[:, (H-1)//2:(H-1)//2+H, (W-1)//2:(W-1)//2+W]
+        elif self.mode=="valid":
+            corr = corr[:, H-1:H, W-1:W]
+        if out is None:
+            return np.ascontiguousarray(corr)
+        np.copyto(out, corr)
+        return out
     
     
 class MultiTransform(ImageTransform):
     def __init__(self, transforms):
+        '''
+        Chains (transforms), the output of each is the input of the next
+        '''
         super().__init__()
         self.transforms = transforms
         self.name = '+'.join([x.name for x in self.transforms])
@@ -81,6 +344,134 @@ class MultiTransform(ImageTransform):
     def transform(self, arr):
         
         for t in self.transforms:
-            arr = t.transform(t)
+            arr = t.transform(arr)
             
-        return arr
\ No newline at end of file
+        return arr
+
+    def transform_batch(self, stack, out=None):
+        for t in self.transforms[:-1]:
+            stack = t.transform_batch(stack)
+        return self.transforms[-1].transform_batch(stack, out=out)
+
+
+class TransformPipeline(MultiTransform):
+    def __init__(self, transforms, chunk_size=4096):
+        '''
+        Chains (transforms) like MultiTransform, but streams the data through all of them
+        chunk_size particles at a time
+        
+        Each stage writes into a buffer of chunk_size particles that is allocated once and
+        reused for every chunk, and a stage whose output has the same shape as its input
+        reuses a free buffer of the stages before it (or the input itself if the transform
+        is in-place), so peak memory is bounded by chunk_size and not the dataset size
+        
+        Example:
+        
+        > pipeline = TransformPipeline([RobertsTransform(), FFT2Transform(20)], chunk_size=8192)
+        > features = pipeline.run(ParticleStack(paths))
+        > store = pipeline.run(ParticleStore(path_in), path_out=path_out)
+        '''
+        super().__init__(transforms)
+        self.chunk_size = chunk_size
+        self._layout = None
+        self._buffers = {}
+
+    def params(self):
+        # Chunking does not change the output, so it is not part of the cache key
+        params = super().params()
+        params['params'].pop('chunk_size', None)
+        return params
+
+    def output_layout(self, frame_shape, dtype):
+        '''
+        Returns the list of (shape, dtype) of a single image after each stage,
+        found by running the stages on one blank image
+        '''
+        key = (tuple(frame_shape), np.dtype(dtype))
+        if self._layout is None or self._layout[0]!=key:
+            arr = np.zeros((1,)+tuple(frame_shape), dtype=dtype)
+            layout = []
+            for t in self.transforms:
+                arr = t.transform_batch(arr)
+                layout.append((arr.shape[1:], arr.dtype))
+            self._layout = (key, layout)
+            self._buffers = {}
+        return self._layout[1]
+
+    def transform_batch(self, stack, out=None):
+        stack = np.asarray(stack)
+        layout = self.output_layout(stack.shape[1:], stack.dtype)
+        if out is None:
+            shape, dtype = layout[-1]
+            out = np.empty((len(stack),)+shape, dtype=dtype)
+        for start in range(0, len(stack), self.chunk_size):
+            self._transformChunk(stack[start:start+self.chunk_size], layout,
+                                 out=out[start:start+self.chunk_size])
+        return out
+
+    def _transformChunk(self, chunk, layout, out=None):
+        n = len(chunk)
+        owner = None
+        for i, t in enumerate(self.transforms):
+            shape, dtype = layout[i]
+            if i==len(self.transforms)-1 and out is not None:
+                buf = out
+            elif t.inplace and owner is not None and self._buffers[owner].shape[1:]==shape \
+                    and self._buffers[owner].dtype==dtype:
+                buf = self._buffers[owner][:n]
+            else:
+                # Up to two buffers per (shape, dtype), so consecutive stages of the
+                # same shape alternate between them instead of allocating
+                key = (shape, dtype, 0)
+                if owner==key:
+                    key = (shape, dtype, 1)
+                if key not in self._buffers:
+                    self._buffers[key] = np.empty((self.chunk_size,)+shape, dtype=dtype)
+                buf = self._buffers[key][:n]
+                owner = key
+            chunk = t.transform_batch(chunk, out=buf)
+        return chunk
+
+    def run(self, source, path_out=None, shard_size=None, compress=False, shard_bytes=256*2**20):
+        '''
+        Streams (source), an (N, H, W) array, ParticleStack or ParticleStore, through the pipeline
+        
+        Without path_out the result is returned as one (N, ...) array. With path_out it is
+        written chunk by chunk to a ParticleStore (carrying over labels and provenance
+        if source is a ParticleStore) which is returned, so the result never has to fit in memory
+        '''
+        layout = self.output_layout(source.shape[1:], source.dtype)
+        shape, dtype = layout[-1]
+        
+        if path_out is None:
+            out = np.empty((len(source),)+shape, dtype=dtype)
+            for start in range(0, len(source), self.chunk_size):
+                chunk = source[start:start+self.chunk_size]
+                self._transformChunk(chunk, layout, out=out[start:start+len(chunk)])
+            return out
+        
+        from particle_store import ParticleStoreWriter, ParticleStore
+        writer = ParticleStoreWriter(path_out, shape, dtype=dtype, shard_size=shard_size,
+                                     compress=compress, classes=getattr(source, 'classes', None),
+                                     shard_bytes=shard_bytes)
+        result = np.empty((self.chunk_size,)+shape, dtype=dtype)
+        # Provenance is looked up per chunk from these, never built for the whole source
+        if isinstance(source, ParticleStore):
+            source_files = np.asarray(source.source_files, dtype=object)
+        elif hasattr(source, 'paths'):
+            source_files = np.asarray(source.paths, dtype=object)
+        with writer:
+            for start in range(0, len(source), self.chunk_size):
+                chunk = source[start:start+self.chunk_size]
+                stop = start+len(chunk)
+                res = self._transformChunk(chunk, layout, out=result[:len(chunk)])
+                if isinstance(source, ParticleStore):
+                    writer.append(res, label=source.labels[start:stop],
+                                  source=source_files[source.source_idx[start:stop]],
+                                  frames=source.frame_idx[start:stop])
+                elif hasattr(source, 'paths'):
+                    file_idx, frames = source.locate(np.arange(start, stop))
+                    writer.append(res, source=source_files[file_idx], frames=frames)
+                else:
+                    writer.append(res, frames=np.arange(start, stop))
+        return ParticleStore(path_out)
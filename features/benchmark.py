@@ -0,0 +1,426 @@
+'''
+Benchmarks of the load -> transform -> featurize -> classify path on synthetic data
+
+Each stage is timed separately, in its own process so its peak memory is its own,
+and end to end with cryofilter.score_particles. Results are written to a JSON file,
+which compare mode checks against a stored baseline
+
+Example:
+
+> python benchmark.py run --particles 100000 --size 64 --out results.json
+> python benchmark.py compare results.json baseline.json --tolerance 0.1
+> python benchmark.py imports --budget 0.5
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+import numpy as np
+import mrcfile
+
+from instrumentation import peak_rss_mb
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+
+# Order the stages run in, later stages use the models fitted by earlier ones
+STAGES = ['star', 'load', 'transform', 'featurize_fit', 'featurize', 'classify_fit', 'classify', 'end_to_end']
+
+# Modules that must import on NumPy and mrcfile alone, quickly enough for workers and short jobs
+CORE_MODULES = ['mrcs_loader', 'particle_store', 'ImageTransforms', 'Featurizer', 'transform_cache',
+                'instrumentation', 'shared_batch', 'evaluator', 'GBDT', 'gbdt_search', 'cryofilter',
+                'cnn_inference']
+
+# Optional dependencies that are only imported when used
+HEAVY_MODULES = ['matplotlib', 'cv2', 'lightgbm', 'pandas', 'tqdm', 'sklearn', 'skimage', 'scipy', 'tensorflow',
+                 'threadpoolctl']
+
+
+def synthetic_particles(n, size, rng):
+    '''
+    Returns (n, size, size) float32 particles and their labels: half are a centred
+    disk-like blob (1) and half an off-centre blob (0), both in heavy noise
+    '''
+    labels = (rng.rand(n)<0.5).astype(np.int32)
+    y, x = np.mgrid[:size, :size] - (size - 1)/2
+    centre = np.where(labels[:, None], 0, size/4)*rng.choice([-1, 1], size=(n, 2))
+    r2 = (x[None] - centre[:, 0, None, None])**2 + (y[None] - centre[:, 1, None, None])**2
+    imgs = np.exp(-r2/(2*(size/8)**2)).astype(np.float32)
+    imgs += rng.normal(scale=1.0, size=imgs.shape).astype(np.float32)
+    return imgs, labels
+
+
+def generate(path, n_particles=10000, size=64, n_files=10, seed=0, chunk_size=4096):
+    '''
+    Writes n_particles synthetic particles of size x size to n_files .mrcs stacks in folder (path),
+    with a RELION-style particles.star listing them and labels.npy, chunk_size particles at a time
+
+    The data only depend on the arguments, and generating is skipped if (path)
+    already holds data generated with the same arguments
+    '''
+    config = {'particles': n_particles, 'size': size, 'files': n_files, 'seed': seed}
+    config_path = os.path.join(path, 'data.json')
+    if os.path.exists(config_path):
+        with open(config_path, 'r') as f:
+            if json.load(f)==config:
+                return
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    from star import StarBlock, write_star
+
+    rng = np.random.RandomState(seed)
+    counts = np.diff(np.linspace(0, n_particles, n_files + 1).astype(int))
+    labels = []
+    names = []
+    micrographs = []
+    for f, count in enumerate(counts):
+        fname = 'stack_{:04d}.mrcs'.format(f)
+        with mrcfile.new_mmap(os.path.join(path, fname), shape=(count, size, size),
+                              mrc_mode=2, overwrite=True) as mrc:
+            mrc.set_image_stack()
+            for start in range(0, count, chunk_size):
+                imgs, lbl = synthetic_particles(min(chunk_size, count - start), size, rng)
+                mrc.data[start:start+len(imgs)] = imgs
+                labels.append(lbl)
+        names.extend('{:06d}@{}'.format(i + 1, fname) for i in range(count))
+        micrographs.extend(['micrograph_{:04d}.mrc'.format(f)]*count)
+
+    labels = np.concatenate(labels) if labels else np.empty(0, dtype=np.int32)
+    np.save(os.path.join(path, 'labels.npy'), labels)
+    columns = {
+        '_rlnCoordinateX': rng.uniform(0, 4096, n_particles),
+        '_rlnCoordinateY': rng.uniform(0, 4096, n_particles),
+        '_rlnImageName': np.array(names, dtype=object),
+        '_rlnMicrographName': np.array(micrographs, dtype=object),
+        '_rlnClassNumber': labels + 1,
+    }
+    write_star(os.path.join(path, 'particles.star'), StarBlock('particles', columns))
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+
+def make_transforms(names):
+    from ImageTransforms import IdentityTransform, RobertsTransform, FFT2Transform
+    available = {'identity': IdentityTransform, 'roberts': RobertsTransform, 'fft': FFT2Transform}
+    return [available[name]() for name in names]
+
+
+def percentiles(times):
+    times = np.asarray(times)*1000
+    if len(times)==0:
+        return {}
+    return {'p50_ms': float(np.percentile(times, 50)), 'p90_ms': float(np.percentile(times, 90)),
+            'p99_ms': float(np.percentile(times, 99)), 'max_ms': float(times.max())}
+
+
+def _stack(cfg):
+    from mrcs_loader import ParticleStack
+    data = cfg['data_dir']
+    return ParticleStack(sorted(os.path.join(data, f) for f in os.listdir(data) if f.endswith('.mrcs')))
+
+
+def _timed_batches(stack, batch_size, func):
+    '''
+    Calls func on each batch of (stack), returns the time taken by each call
+    '''
+    times = []
+    for start, batch in stack.iter_batches(batch_size):
+        t0 = perf_counter()
+        func(batch)
+        times.append(perf_counter() - t0)
+    return times
+
+
+def run_stage(name, cfg):
+    '''
+    Runs one stage, returns (particles processed, per-batch times or None)
+    '''
+    work = cfg['work_dir']
+    batch_size = cfg['batch_size']
+    if name=='star':
+        from star import read_star
+        blocks = read_star(os.path.join(cfg['data_dir'], 'particles.star'))
+        return len(blocks['particles']), None
+
+    stack = _stack(cfg)
+    n_fit = min(cfg['fit_samples'], len(stack))
+    if name=='load':
+        return len(stack), _timed_batches(stack, batch_size, np.array)
+
+    if name=='transform':
+        transforms = make_transforms(cfg['transforms'])
+        return len(stack), _timed_batches(stack, batch_size,
+                                          lambda batch: [t.transform_batch(batch) for t in transforms])
+
+    from Featurizer import FeatureEnsembler
+    if name=='featurize_fit':
+        E = FeatureEnsembler(np.asarray(stack[:n_fit]), make_transforms(cfg['transforms']),
+                             n_components=cfg['n_components'], chunk_size=batch_size)
+        E.fit()
+        E.save(os.path.join(work, 'ensembler'))
+        np.save(os.path.join(work, 'fit_features.npy'), E.feature_coeffs)
+        return n_fit, None
+
+    ensembler = FeatureEnsembler.load(os.path.join(work, 'ensembler'))
+    if name=='featurize':
+        return len(stack), _timed_batches(stack, batch_size,
+                                          lambda batch: ensembler.transform(batch, chunk_size=batch_size))
+
+    from GBDT import GBDTWrapper
+    if name=='classify_fit':
+        labels = np.load(os.path.join(cfg['data_dir'], 'labels.npy'))[:n_fit]
+        gbdt = GBDTWrapper(np.load(os.path.join(work, 'fit_features.npy')), labels,
+                           random_state=cfg['seed'])
+        gbdt.train(epochs=cfg['epochs'], params={'objective': 'binary', 'metric': 'auc',
+                                                  'learning_rate': 0.1, 'verbosity': -1,
+                                                  'seed': cfg['seed']},
+                   early_stopping_rounds=20)
+        gbdt.save(os.path.join(work, 'gbdt'))
+        return n_fit, None
+
+    gbdt = GBDTWrapper.load(os.path.join(work, 'gbdt'))
+    if name=='classify':
+        features = ensembler.transform(stack[:], chunk_size=batch_size)
+        times = []
+        for start in range(0, len(features), batch_size):
+            t0 = perf_counter()
+            gbdt.predict_proba(features[start:start+batch_size])
+            times.append(perf_counter() - t0)
+        return len(stack), times
+
+    if name=='end_to_end':
+        from cryofilter import Classifier, score_particles
+        score_particles(stack, ensembler, Classifier(gbdt), os.path.join(work, 'scored'),
+                        chunk_size=batch_size)
+        return len(stack), None
+
+    raise ValueError('Unknown stage {}'.format(name))
+
+
+def _measure(name, cfg):
+    t0 = perf_counter()
+    n, times = run_stage(name, cfg)
+    wall_seconds = perf_counter() - t0
+    # Timed batches exclude the stage's setup, e.g. loading models
+    seconds = sum(times) if times is not None else wall_seconds
+    result = {
+        'particles': n,
+        'seconds': seconds,
+        'wall_seconds': wall_seconds,
+        'particles_per_second': n/seconds if seconds>0 else float('nan'),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if times is not None:
+        result['batches'] = len(times)
+        result.update(percentiles(times))
+    return result
+
+
+def run(cfg, stages=STAGES, isolate=True):
+    '''
+    Generates the data if needed and runs the stages, each in a new process if isolate is True
+    Returns the results dict written by main, in which a stage that raised has only an 'error'
+    '''
+    print("Generating data in {} . . .".format(cfg['data_dir']))
+    t0 = perf_counter()
+    generate(cfg['data_dir'], cfg['particles'], cfg['size'], cfg['files'], cfg['seed'])
+    generate_seconds = perf_counter() - t0
+
+    print("Timing imports . . .")
+    imports = import_times()
+
+    results = {}
+    for name in stages:
+        print("Running {} . . .".format(name))
+        try:
+            if isolate:
+                with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+                    results[name] = pool.submit(_measure, name, cfg).result()
+            else:
+                results[name] = _measure(name, cfg)
+        except Exception as e:
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            print("\tFAILED " + results[name]['error'])
+            continue
+        print("\t{particles} particles in {seconds:.2f}s ({particles_per_second:.0f}/s, "
+              "peak RSS {peak_rss_mb:.0f} MB)".format(**results[name]))
+
+    return {
+        'config': cfg,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'generate_seconds': generate_seconds,
+        'imports': imports,
+        'stages': results,
+    }
+
+
+def import_times(modules=CORE_MODULES):
+    '''
+    Imports each module in a fresh interpreter, returns a dict of module ->
+    {'seconds': import time, 'heavy': optional dependencies it pulled in}
+    '''
+    code = ("import json, sys, time\n"
+            "t0 = time.perf_counter()\n"
+            "import {module}\n"
+            "seconds = time.perf_counter() - t0\n"
+            "print(json.dumps({{'seconds': seconds, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        out = subprocess.run([sys.executable, '-c', code.format(module=module, heavy=HEAVY_MODULES)],
+                             cwd=here, check=True, capture_output=True, text=True).stdout
+        results[module] = json.loads(out.strip().splitlines()[-1])
+    return results
+
+
+def check_imports(results, budget=None):
+    '''
+    Returns a list of modules that took longer than budget seconds to import
+    (not checked if budget is None), or imported optional dependencies
+    '''
+    failures = []
+    for module, r in results.items():
+        if budget is not None and r['seconds']>budget:
+            failures.append('{} took {:.3f}s to import, budget {:.3f}s'.format(module, r['seconds'], budget))
+        if r['heavy']:
+            failures.append('{} imported {}'.format(module, ', '.join(r['heavy'])))
+    return failures
+
+
+def compare(current, baseline, tolerance=0.1):
+    '''
+    Returns a list of regressions of (current) results relative to (baseline): stages whose
+    throughput fell, or whose p99 latency or peak memory rose, by more than tolerance
+    '''
+    regressions = []
+    checks = [('particles_per_second', -1), ('p99_ms', 1), ('peak_rss_mb', 1)]
+    for stage, base in baseline['stages'].items():
+        cur = current['stages'].get(stage)
+        if cur is None:
+            continue
+        if 'error' in cur:
+            regressions.append('{} failed: {}'.format(stage, cur['error']))
+            continue
+        for key, direction in checks:
+            if key not in cur or key not in base or not base[key]:
+                continue
+            change = (cur[key] - base[key])/base[key]
+            if direction*change>tolerance:
+                regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.1%})'.format(
+                    stage, key, base[key], cur[key], change))
+    
+    for module, base in baseline.get('imports', {}).items():
+        cur = current.get('imports', {}).get(module)
+        if cur is None:
+            continue
+        new = sorted(set(cur['heavy']) - set(base['heavy']))
+        if new:
+            regressions.append('import {} now imports {}'.format(module, ', '.join(new)))
+        # Differences of a few ms are noise
+        if cur['seconds'] - base['seconds']>max(tolerance*base['seconds'], 0.02):
+            regressions.append('import {}: {:.3f}s -> {:.3f}s'.format(module, base['seconds'], cur['seconds']))
+    return regressions
+
+
+def _report(current, baseline, tolerance):
+    if current['config'].get('particles')!=baseline['config'].get('particles') or \
+       current['config'].get('size')!=baseline['config'].get('size'):
+        print("Warning: results were run with different data sizes")
+    regressions = compare(current, baseline, tolerance)
+    for r in regressions:
+        print("REGRESSION " + r)
+    if not regressions:
+        print("No regressions beyond {:.0%}".format(tolerance))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark', description='CryoFilter benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('run', help='generate synthetic data and time each stage')
+    p.add_argument('--particles', type=int, default=10000)
+    p.add_argument('--size', type=int, default=64, help='particle width and height')
+    p.add_argument('--files', type=int, default=10, help='number of .mrcs stacks')
+    p.add_argument('--batch-size', type=int, default=4096)
+    p.add_argument('--fit-samples', type=int, default=20000, help='particles the models are fitted on')
+    p.add_argument('--n-components', type=int, default=9)
+    p.add_argument('--epochs', type=int, default=200, help='maximum GBDT rounds')
+    p.add_argument('--transforms', default='identity,roberts', help='of identity, roberts, fft')
+    p.add_argument('--stages', default=','.join(STAGES))
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--data-dir', default=None, help='where the data is generated, reused if it matches')
+    p.add_argument('--work-dir', default=None, help='where fitted models are written')
+    p.add_argument('--no-isolate', action='store_true', help='run stages in this process')
+    p.add_argument('--out', default='benchmark.json')
+    p.add_argument('--baseline', default=None, help='results to compare against')
+    p.add_argument('--tolerance', type=float, default=0.1)
+
+    p = commands.add_parser('imports', help='check the import time and dependencies of the core modules')
+    p.add_argument('--budget', type=float, default=0.5, help='maximum seconds to import each module')
+
+    p = commands.add_parser('compare', help='compare results against a baseline')
+    p.add_argument('current')
+    p.add_argument('baseline')
+    p.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    if args.command=='imports':
+        results = import_times()
+        for module, r in results.items():
+            print("{:20s} {:.3f}s".format(module, r['seconds']))
+        failures = check_imports(results, args.budget)
+        for f in failures:
+            print("FAIL " + f)
+        return 1 if failures else 0
+
+    if args.command=='compare':
+        with open(args.current, 'r') as f:
+            current = json.load(f)
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        return _report(current, baseline, args.tolerance)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='cryofilter_bench_')
+    cfg = {
+        'particles': args.particles,
+        'size': args.size,
+        'files': args.files,
+        'batch_size': args.batch_size,
+        'fit_samples': args.fit_samples,
+        'n_components': args.n_components,
+        'epochs': args.epochs,
+        'transforms': args.transforms.split(','),
+        'seed': args.seed,
+        'data_dir': args.data_dir or os.path.join(work_dir, 'data'),
+        'work_dir': work_dir,
+    }
+    results = run(cfg, args.stages.split(','), isolate=not args.no_isolate)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print("Results written to " + args.out)
+    status = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            status = _report(results, json.load(f), args.tolerance)
+    failed = [name for name, r in results['stages'].items() if 'error' in r]
+    if failed:
+        print("FAILED stages: " + ', '.join(failed))
+        return 1
+    return status
+
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,407 @@
+'''
+Batched CPU inference with the particle CNN trained in
+models/CNN_28x28_Classifier_Multi_Input_Normal+Robert+Good_Top.ipynb
+
+The notebook saved the weights of a two input model, one input being the blurred and
+resized particle and the other its Roberts edges, each standardised per image.
+CNNInference rebuilds that model, loads the weights once and scores particle stacks
+in fixed-size batches, preprocessing the next batches in a thread while the current
+one runs through the network
+
+Example:
+
+> cnn = CNNInference(batch_size=256, intra_threads=4)
+> scores = cnn.predict(ParticleStack(paths))
+> cnn.export('../models/cnn.onnx')                  # needs tf2onnx
+> scores = CNNInference('../models/cnn.onnx').predict(stack)
+
+> python cnn_inference.py score --out scores.csv ../data/raw/job028/micrographs
+'''
+import argparse
+import os
+import queue
+import threading
+from time import perf_counter
+import numpy as np
+
+import instrumentation as inst
+from ImageTransforms import roberts_batch
+
+DEFAULT_WEIGHTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models',
+                               'roberts_original_top_val_acc_90.h5')
+
+# Names of the model inputs, kept by the exported models
+INPUT_NAMES = ('image', 'roberts')
+
+
+def _tensorflow(intra_threads=None, inter_threads=None):
+    '''
+    Imports tensorflow with the GPU hidden and its thread pools sized, which
+    only takes effect if tensorflow has not run anything yet
+    '''
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+    import tensorflow as tf
+    try:
+        tf.config.set_visible_devices([], 'GPU')
+        if intra_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+        if inter_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    except RuntimeError:
+        inst.log('cnn', "Tensorflow is already initialised, device and thread settings are unchanged")
+    return tf
+
+
+def build_model(size=28):
+    '''
+    The two input network of the notebook, with the blurred image and its
+    Roberts edges as (size, size, 1) inputs, and the particle score as output
+    '''
+    _tensorflow()
+    from tensorflow import keras
+    from tensorflow.keras import layers
+
+    def branch(x):
+        for _ in range(3):
+            x = layers.Conv2D(32, 3, activation="relu", strides=1, padding="same")(x)
+            x = layers.Conv2D(32, 3, activation="relu", strides=1, padding="same")(x)
+            x = layers.AveragePooling2D()(x)
+        return layers.Flatten()(x)
+
+    inputs = [keras.Input(shape=(size, size, 1), name=name) for name in INPUT_NAMES]
+    x = layers.Concatenate()([branch(i) for i in inputs])
+    output = layers.Dense(1, activation="sigmoid")(x)
+    return keras.Model(inputs, [output], name="classifer")
+
+
+def standardise(stack):
+    '''
+    In place (x - mean)/std of each image in an (N, H, W) array, leaving constant images at 0
+    '''
+    mean = stack.mean(axis=(1, 2), keepdims=True)
+    std = stack.std(axis=(1, 2), keepdims=True)
+    std[std==0] = 1
+    stack -= mean
+    stack /= std
+    return stack
+
+
+def preprocess_batch(stack, size=28, sigma=3):
+    '''
+    The notebook's per particle preprocessing, applied to a whole (N, H, W) batch:
+    gaussian blur (sigma), resize to (size, size) with anti-aliasing, then the
+    standardised image and standardised Roberts edges as two float32 (N, size, size, 1) arrays
+    '''
+    from scipy import ndimage
+    from skimage import transform, util
+
+    stack = np.asarray(stack)
+    if stack.dtype.kind=='f':
+        stack = stack.astype(np.float32, copy=False)
+    else:
+        stack = util.img_as_float32(stack)
+
+    # Same as skimage.filters.gaussian on each image, with no blurring across the batch
+    blurred = ndimage.gaussian_filter(stack, sigma=(0, sigma, sigma), mode='nearest', truncate=4.0)
+    # The batch axis keeps its size, so is neither interpolated nor smoothed
+    res = transform.resize(blurred, (len(stack), size, size), order=1, mode='reflect',
+                           anti_aliasing=True).astype(np.float32, copy=False)
+
+    edges = roberts_batch(res)
+    return standardise(res)[..., None], standardise(edges)[..., None]
+
+
+def _iter_batches(source, batch_size):
+    '''
+    (start, batch) pairs of a ParticleStack, or of an (N, H, W) array
+    '''
+    if hasattr(source, 'iter_batches'):
+        return source.iter_batches(batch_size)
+    return ((start, source[start:start+batch_size]) for start in range(0, len(source), batch_size))
+
+
+class _KerasRunner():
+    def __init__(self, path, batch_size, size, intra_threads, inter_threads):
+        '''
+        Runs the rebuilt Keras model with the weights in (path), as one traced graph
+        for the fixed batch shape
+        '''
+        tf = _tensorflow(intra_threads, inter_threads)
+        self.model = build_model(size)
+        self.model.load_weights(path)
+        spec = tf.TensorSpec((batch_size, size, size, 1), tf.float32)
+        self._predict = tf.function(lambda image, edges: self.model([image, edges], training=False),
+                                    input_signature=[spec, spec])
+
+    def __call__(self, image, edges):
+        return self._predict(image, edges).numpy()[:, 0]
+
+
+class _TFLiteRunner():
+    def __init__(self, path, batch_size, size, intra_threads, inter_threads):
+        '''
+        Runs a model exported with CNNInference.export(.., fmt='tflite'), using
+        tflite_runtime if it is installed rather than the whole of tensorflow
+        '''
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = _tensorflow().lite.Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=intra_threads)
+        details = self.interpreter.get_input_details()
+        # Exported inputs are named after the Keras inputs, e.g. serving_default_roberts:0
+        self._inputs = [next(d['index'] for d in details if name in d['name']) for name in INPUT_NAMES]
+        for index in self._inputs:
+            self.interpreter.resize_tensor_input(index, (batch_size, size, size, 1))
+        self.interpreter.allocate_tensors()
+        self._output = self.interpreter.get_output_details()[0]['index']
+
+    def __call__(self, image, edges):
+        for index, x in zip(self._inputs, (image, edges)):
+            self.interpreter.set_tensor(index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output)[:, 0].copy()
+
+
+class _ONNXRunner():
+    def __init__(self, path, batch_size, size, intra_threads, inter_threads):
+        '''
+        Runs a model exported with CNNInference.export(.., fmt='onnx') with onnxruntime on the CPU
+        '''
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("Running an ONNX model needs onnxruntime: pip install onnxruntime")
+        options = ort.SessionOptions()
+        if intra_threads is not None:
+            options.intra_op_num_threads = intra_threads
+        if inter_threads is not None:
+            options.inter_op_num_threads = inter_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, image, edges):
+        return self.session.run(None, dict(zip(INPUT_NAMES, (image, edges))))[0][:, 0]
+
+
+RUNNERS = {'.h5': _KerasRunner, '.tflite': _TFLiteRunner, '.onnx': _ONNXRunner}
+
+
+class CNNInference():
+    def __init__(self, model_path=DEFAULT_WEIGHTS, batch_size=256, intra_threads=None, inter_threads=None,
+                 queue_size=4, size=28, sigma=3):
+        '''
+        Scores particles on the CPU with the notebook's CNN, from the Keras weights (.h5) or a
+        model exported by export() (.tflite or .onnx), which is loaded on first use
+
+        batch_size: particles per call of the network, the last batch is padded to this size
+                    so every call has the same shape
+        intra_threads, inter_threads: threads used within and across operations of the network
+                                      (None leaves the runtime's default). Preprocessing runs in
+                                      one more thread alongside them
+        queue_size: preprocessed batches that can wait for the network
+        size, sigma: input size of the network and blur of the preprocessing it was trained with
+        '''
+        ext = os.path.splitext(model_path)[1].lower()
+        if ext not in RUNNERS:
+            raise ValueError("Unknown model format {}, expected one of {}".format(ext, ', '.join(RUNNERS)))
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.intra_threads = intra_threads
+        self.inter_threads = inter_threads
+        self.queue_size = queue_size
+        self.size = size
+        self.sigma = sigma
+        self.stats = None
+        self._runner = None
+
+    def _getRunner(self):
+        if self._runner is None:
+            with inst.timer('cnn.load'):
+                self._runner = RUNNERS[os.path.splitext(self.model_path)[1].lower()](
+                    self.model_path, self.batch_size, self.size, self.intra_threads, self.inter_threads)
+        return self._runner
+
+    def _prepare(self, batch):
+        '''
+        Preprocessed network inputs of a batch of raw particles, padded to batch_size
+        '''
+        t0 = perf_counter()
+        inputs = []
+        for x in preprocess_batch(batch, self.size, self.sigma):
+            if len(x)<self.batch_size:
+                x = np.concatenate([x, np.zeros((self.batch_size-len(x),)+x.shape[1:], dtype=x.dtype)])
+            inputs.append(x)
+        inst.record('cnn.preprocess', perf_counter()-t0, detail=True)
+        return inputs
+
+    def predict_batch(self, batch):
+        '''
+        Scores of one (n, H, W) batch of at most batch_size particles
+        '''
+        if len(batch)>self.batch_size:
+            raise ValueError("Batch of {} particles is larger than batch_size {}".format(len(batch), self.batch_size))
+        runner = self._getRunner()
+        return runner(*self._prepare(batch))[:len(batch)]
+
+    def _produce(self, source, batches, stop):
+        '''
+        Preprocessing thread, queueing (start, n, image, edges) for each batch of (source),
+        then an exception if one was raised and finally None
+        '''
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for start, batch in _iter_batches(source, self.batch_size):
+                if not put((start, len(batch)) + tuple(self._prepare(batch))):
+                    return
+        except BaseException as e:
+            put(e)
+        put(None)
+
+    def iter_predict(self, source):
+        '''
+        Yields (start, scores) for consecutive batches of (source), a ParticleStack or
+        (N, H, W) array, preprocessing ahead of the network in a background thread
+        '''
+        runner = self._getRunner()
+        batches = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(source, batches, stop), daemon=True)
+
+        n = 0
+        t0 = perf_counter()
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                start, n_batch, image, edges = item
+                with inst.timer('cnn.infer', detail=True):
+                    scores = runner(image, edges)[:n_batch]
+                inst.count('cnn.particles', n_batch)
+                n += n_batch
+                yield start, scores
+        finally:
+            stop.set()
+            producer.join()
+
+        seconds = perf_counter() - t0
+        self.stats = {
+            'particles': n,
+            'seconds': seconds,
+            'particles_per_second': n/seconds if seconds>0 else float('nan'),
+        }
+        inst.record('cnn.predict', seconds, particles=n,
+                    particles_per_second=self.stats['particles_per_second'])
+
+    def predict(self, source):
+        '''
+        Scores of every particle in (source), a ParticleStack or (N, H, W) array
+        '''
+        scores = np.empty(len(source), dtype=np.float32)
+        for start, s in self.iter_predict(source):
+            scores[start:start+len(s)] = s
+        return scores
+
+    def export(self, path, fmt=None, quantize=False):
+        '''
+        Converts the Keras model to TFLite or ONNX (needs tf2onnx) at (path), which
+        CNNInference can then run with less overhead per batch than Keras
+        fmt: 'tflite' or 'onnx', taken from the extension of path by default
+        quantize: TFLite only, store weights as 8 bit integers
+        '''
+        if not isinstance(self._getRunner(), _KerasRunner):
+            raise ValueError("Only a model loaded from Keras weights (.h5) can be exported")
+        fmt = fmt if fmt is not None else os.path.splitext(path)[1].lstrip('.').lower()
+        tf = _tensorflow()
+        model = self._runner.model
+
+        with inst.timer('cnn.export', fmt=fmt):
+            if fmt=='tflite':
+                converter = tf.lite.TFLiteConverter.from_keras_model(model)
+                if quantize:
+                    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+                with open(path, 'wb') as f:
+                    f.write(converter.convert())
+            elif fmt=='onnx':
+                try:
+                    import tf2onnx
+                except ImportError:
+                    raise ImportError("Exporting to ONNX needs tf2onnx: pip install tf2onnx onnxruntime")
+                spec = [tf.TensorSpec((None, self.size, self.size, 1), tf.float32, name=name)
+                        for name in INPUT_NAMES]
+                tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=path)
+            else:
+                raise ValueError("Unknown export format {}".format(fmt))
+        return path
+
+
+def score(args):
+    from cryofilter import find_stacks
+    from mrcs_loader import ParticleStack
+
+    stack = ParticleStack(find_stacks(args.inputs, args.ext))
+    cnn = CNNInference(args.model, batch_size=args.batch_size, intra_threads=args.intra_threads,
+                       inter_threads=args.inter_threads, queue_size=args.queue_size)
+    inst.log('cnn', "Scoring {} particles from {} stacks . . .".format(len(stack), len(stack.paths)))
+    with open(args.out, 'w') as f:
+        f.write('index,source,frame,score\n')
+        for start, scores in cnn.iter_predict(stack):
+            file_idx, frames = stack.locate(np.arange(start, start+len(scores)))
+            f.write(''.join('{},{},{},{:.6f}\n'.format(start+i, stack.paths[file_idx[i]], frames[i], s)
+                            for i, s in enumerate(scores)))
+    stack.close()
+    inst.log('cnn', "Scored {particles} particles in {seconds:.1f}s "
+             "({particles_per_second:.0f} particles/s)".format(**cnn.stats), **cnn.stats)
+
+
+def export(args):
+    cnn = CNNInference(args.model, batch_size=args.batch_size)
+    cnn.export(args.out, quantize=args.quantize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cnn_inference', description='CPU inference with the particle CNN')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('score', help='score particle stacks with the CNN')
+    p.add_argument('inputs', nargs='+', help='.mrcs files or folders of them')
+    p.add_argument('--out', required=True, help='CSV file of the scores')
+    p.add_argument('--ext', default='.mrcs', help='extension of stacks in input folders')
+    p.add_argument('--intra-threads', type=int, default=None, help='threads within each operation')
+    p.add_argument('--inter-threads', type=int, default=None, help='operations run at once')
+    p.add_argument('--queue-size', type=int, default=4, help='preprocessed batches waiting for the network')
+    p.set_defaults(func=score)
+
+    p = commands.add_parser('export', help='export the Keras model to .tflite or .onnx')
+    p.add_argument('out', help='path of the exported model, its extension sets the format')
+    p.add_argument('--quantize', action='store_true', help='8 bit weights (TFLite only)')
+    p.set_defaults(func=export)
+
+    for p in commands.choices.values():
+        p.add_argument('--model', default=DEFAULT_WEIGHTS, help='Keras weights (.h5), .tflite or .onnx model')
+        p.add_argument('--batch-size', type=int, default=256, help='particles per call of the network')
+        p.add_argument('--quiet', action='store_true', help='no progress output')
+        p.add_argument('--metrics', default=None, help='write timings and counters of the run to this JSON file')
+
+    args = parser.parse_args(argv)
+    inst.verbose(not args.quiet)
+    args.func(args)
+    if args.metrics is not None:
+        inst.export(args.metrics)
+
+
+if __name__=='__main__':
+    main()
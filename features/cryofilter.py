@@ -0,0 +1,270 @@
+'''
+Command line entry point
+
+Example:
+
+> python cryofilter.py score --featurizer ../models/featurizer --classifier ../models/gbdt.txt \
+>     --out ../data/scored ../data/raw/job028/micrographs
+'''
+import argparse
+import os
+import pickle
+import sys
+from collections import OrderedDict
+from time import time
+import numpy as np
+import mrcfile
+
+import instrumentation as inst
+from instrumentation import peak_rss_mb
+from mrcs_loader import ParticleStack, get_files_of_type_from_path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'preprocessing'))
+
+
+def find_stacks(inputs, fext='.mrcs'):
+    '''
+    Expands a list of .mrcs files and folders of them into a sorted list of files
+    '''
+    paths = []
+    for p in inputs:
+        if os.path.isdir(p):
+            paths.extend(get_files_of_type_from_path(p, fext))
+        else:
+            paths.append(p)
+    return sorted(paths)
+
+
+class Classifier():
+    def __init__(self, model, scaler=None):
+        '''
+        A fitted classifier, either a GBDTWrapper (which scales its own features) or
+        one with a predict(X) returning scores, such as a lightgbm Booster,
+        and the scaler its features were normalised with
+        '''
+        self.model = model
+        self.scaler = scaler
+
+    @classmethod
+    def load(cls, path, scaler_path=None):
+        '''
+        Loads a folder saved by GBDTWrapper.save, or a LightGBM model file
+        '''
+        if os.path.isdir(path):
+            from GBDT import GBDTWrapper
+            return cls(GBDTWrapper.load(path))
+        
+        import lightgbm as lgb
+        scaler = None
+        if scaler_path is not None:
+            with open(scaler_path, 'rb') as f:
+                scaler = pickle.load(f)
+        return cls(lgb.Booster(model_file=path), scaler)
+
+    def predict(self, features):
+        if hasattr(self.model, 'predict_proba'):
+            return self.model.predict_proba(features)
+        if self.scaler is not None:
+            features = self.scaler.transform(features)
+        return self.model.predict(features)
+
+
+class FilteredStackWriter():
+    def __init__(self, path, frame_shape, dtype):
+        '''
+        Writes the kept particles to a .mrcs file (path) without knowing their number up front,
+        by appending them to a raw temporary file and converting it on close()
+        '''
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        self._tmp_path = path+'.raw.tmp'
+        self._tmp = open(self._tmp_path, 'wb')
+
+    def append(self, imgs):
+        imgs = np.ascontiguousarray(imgs, dtype=self.dtype)
+        self._tmp.write(imgs.data)
+        self.n += len(imgs)
+
+    def close(self, chunk_size=4096):
+        self._tmp.close()
+        with mrcfile.new_mmap(self.path, shape=(self.n,)+self.frame_shape,
+                              mrc_mode=mrcfile.utils.mode_from_dtype(self.dtype), overwrite=True) as mrc:
+            mrc.set_image_stack()
+            if self.n:
+                raw = np.memmap(self._tmp_path, dtype=self.dtype, mode='r',
+                                shape=(self.n,)+self.frame_shape)
+                for start in range(0, self.n, chunk_size):
+                    mrc.data[start:start+chunk_size] = raw[start:start+chunk_size]
+                del raw
+        os.remove(self._tmp_path)
+
+
+def star_rows(block, paths, file_idx, frames):
+    '''
+    Rows of a particles StarBlock listing the particles at (frames) (0-based) of the stacks
+    paths[file_idx], or -1 for particles it doesn't list. The stacks in _rlnImageName
+    (frame@stack, relative to the RELION project) are matched to paths by their trailing
+    path components
+    '''
+    by_name = {}
+    for i, path in enumerate(paths):
+        by_name.setdefault(os.path.basename(path), []).append(i)
+    
+    stack_idx = {}
+    lookup = {}
+    for row, image_name in enumerate(block['_rlnImageName']):
+        frame, star_path = image_name.split('@', 1)
+        if star_path not in stack_idx:
+            norm = os.path.normpath(star_path)
+            matches = [i for i in by_name.get(os.path.basename(norm), [])
+                       if os.path.normpath(os.path.abspath(paths[i])).endswith(os.sep+norm.lstrip(os.sep))]
+            stack_idx[star_path] = matches[0] if len(matches)==1 else -1
+        lookup[(stack_idx[star_path], int(frame)-1)] = row
+    return np.array([lookup.get(key, -1) for key in zip(file_idx.tolist(), frames.tolist())], dtype=np.int64)
+
+
+def score_particles(stack, ensembler, classifier, out_dir, threshold=0.5, chunk_size=4096,
+                    name='particles', star=None):
+    '''
+    Streams a ParticleStack through the transform -> featurize -> classify pipeline,
+    chunk_size particles at a time, so memory does not grow with the size of the dataset
+
+    star: optional particles STAR file the stacks were extracted with, whose rows
+          (and other blocks, such as optics) are carried over to <name>_kept.star
+
+    Writes to out_dir:
+        <name>_scores.csv: source file, frame and score of every particle
+        <name>_kept.mrcs: stack of the particles scoring at least threshold
+        <name>_kept.star: STAR file of the kept particles, with _rlnImageName pointing into
+                          <name>_kept.mrcs and the original image in _rlnOriginalParticleName
+
+    Returns a dict of statistics, including throughput and peak memory
+    '''
+    from star import StarBlock, read_star, write_star
+
+    if star is not None:
+        blocks = read_star(star)
+        particles_block = 'particles' if 'particles' in blocks else \
+            next((k for k, b in blocks.items() if '_rlnImageName' in b), None)
+        if particles_block is None:
+            raise ValueError('No block with _rlnImageName in {}'.format(star))
+        block_rows = star_rows(blocks[particles_block], stack.paths, *stack.locate(np.arange(len(stack))))
+        if np.any(block_rows<0):
+            raise ValueError('{} of the {} particles are not listed in {}'.format(
+                int(np.sum(block_rows<0)), len(stack), star))
+    
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    kept_name = name+'_kept.mrcs'
+    stack_writer = FilteredStackWriter(os.path.join(out_dir, kept_name), stack.frame_shape, stack.dtype)
+    kept_idx = []
+    original_names = []
+
+    t0 = time()
+    with open(os.path.join(out_dir, name+'_scores.csv'), 'w') as scores_file:
+        scores_file.write('index,source,frame,score,kept\n')
+
+        for start, batch in stack.iter_batches(chunk_size):
+            with inst.timer('score.featurize', detail=True):
+                features = ensembler.transform(batch, chunk_size=chunk_size)
+            with inst.timer('score.classify', detail=True):
+                scores = classifier.predict(features)
+            kept = scores>=threshold
+            inst.count('score.particles', len(batch))
+            inst.count('score.kept', int(kept.sum()))
+
+            file_idx, frames = stack.locate(np.arange(start, start+len(batch)))
+            rows = []
+            for i in range(len(batch)):
+                rows.append('{},{},{},{:.6f},{}\n'.format(start+i, stack.paths[file_idx[i]], frames[i],
+                                                          scores[i], int(kept[i])))
+            scores_file.write(''.join(rows))
+
+            # RELION image names are 1-based frame@stack
+            for i in np.flatnonzero(kept):
+                kept_idx.append(start+i)
+                original_names.append('{:06d}@{}'.format(frames[i]+1, stack.paths[file_idx[i]]))
+            stack_writer.append(batch[kept])
+    stack_writer.close()
+    
+    n_kept = len(kept_idx)
+    image_names = np.array(['{:06d}@{}'.format(i+1, kept_name) for i in range(n_kept)], dtype=object)
+    if star is not None:
+        particles = blocks[particles_block].take(block_rows[np.array(kept_idx, dtype=np.int64)])
+    else:
+        blocks = OrderedDict()
+        particles_block = 'particles'
+        particles = StarBlock(particles_block, OrderedDict([('_rlnImageName', image_names)]))
+    if '_rlnOriginalParticleName' not in particles:
+        particles.columns['_rlnOriginalParticleName'] = np.array(original_names, dtype=object)
+    particles.columns['_rlnImageName'] = image_names
+    blocks[particles_block] = particles
+    write_star(os.path.join(out_dir, name+'_kept.star'), blocks)
+
+    elapsed = time() - t0
+    return {
+        'particles': len(stack),
+        'kept': n_kept,
+        'seconds': elapsed,
+        'particles_per_second': len(stack)/elapsed if elapsed>0 else float('nan'),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def score(args):
+    from Featurizer import FeatureEnsembler
+
+    stack = ParticleStack(find_stacks(args.inputs, args.ext))
+    inst.log('score', "Scoring {} particles from {} stacks . . .".format(len(stack), len(stack.paths)))
+    with inst.timer('score.load_models'):
+        ensembler = FeatureEnsembler.load(args.featurizer)
+        classifier = Classifier.load(args.classifier, args.scaler)
+    with inst.timer('score'):
+        stats = score_particles(stack, ensembler, classifier, args.out, threshold=args.threshold,
+                                chunk_size=args.chunk_size, name=args.name, star=args.star)
+    stack.close()
+    inst.log('score', "Kept {kept} of {particles} particles in {seconds:.1f}s "
+             "({particles_per_second:.0f} particles/s, peak RSS {peak_rss_mb:.0f} MB)".format(**stats), **stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cryofilter', description='CryoFilter particle filtering')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('score', help='score particle stacks and write the kept particles')
+    p.add_argument('inputs', nargs='+', help='.mrcs files or folders of them')
+    p.add_argument('--featurizer', required=True, help='folder of a saved FeatureEnsembler')
+    p.add_argument('--classifier', required=True, help='folder of a saved GBDTWrapper, or a LightGBM model file')
+    p.add_argument('--scaler', default=None, help='pickled scaler the classifier features were normalised with')
+    p.add_argument('--out', required=True, help='output folder')
+    p.add_argument('--name', default='particles', help='prefix of the output files')
+    p.add_argument('--threshold', type=float, default=0.5, help='keep particles scoring at least this')
+    p.add_argument('--chunk-size', type=int, default=4096, help='particles processed at a time')
+    p.add_argument('--ext', default='.mrcs', help='extension of stacks in input folders')
+    p.add_argument('--star', default=None,
+                   help='particles STAR file of the stacks, whose rows and other blocks are kept in <name>_kept.star')
+    p.set_defaults(func=score)
+
+    for p in commands.choices.values():
+        p.add_argument('--quiet', action='store_true', help='no progress output')
+        p.add_argument('--metrics', default=None, help='write timings and counters of the run to this JSON file')
+        p.add_argument('--profile', default=None,
+                       help="comma-separated stages to profile (e.g. score.featurize), or '*' for all")
+        p.add_argument('--profile-dir', default='profiles', help='where profiles are written')
+        p.add_argument('--profiler', default='cprofile', choices=['cprofile', 'pyinstrument'])
+
+    args = parser.parse_args(argv)
+    inst.verbose(not args.quiet)
+    if args.profile is not None:
+        inst.profile(args.profile if args.profile=='*' else args.profile.split(','),
+                     args.profile_dir, args.profiler)
+    args.func(args)
+    if args.metrics is not None:
+        inst.export(args.metrics)
+
+
+if __name__=='__main__':
+    main()
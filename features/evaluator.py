@@ -1,11 +1,84 @@
 import multiprocessing as mp
 import os
+from collections import deque
+import numpy as np
+
+from shared_batch import SharedBatchPool, attached, start_tracker
+
+# State of each worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(dataset, model, featurizer, loader):
+    '''
+    Runs once in each worker, so the dataset handle, model and featurizer are sent
+    (or loaded by loader) once per worker instead of once per task
+    '''
+    if loader is not None:
+        model, featurizer = loader()
+    _worker['dataset'] = dataset
+    _worker['model'] = model
+    _worker['featurizer'] = featurizer
+
+
+def _evaluate_chunk(bounds):
+    '''
+    Scores particles start:stop of the worker's dataset, only the scores are sent back
+    '''
+    start, stop = bounds
+    batch = _worker['dataset'][start:stop]
+    return start, np.asarray(_worker['model'](_worker['featurizer'](batch)))
+
+
+def _evaluate_shared(args):
+    '''
+    Scores the first n particles of a shared memory batch, read in place
+    '''
+    spec, n, start = args
+    batch = attached(spec)[:n]
+    return start, np.asarray(_worker['model'](_worker['featurizer'](batch)))
+
 
 class Evaluator():
-    def __init__(self, dataset, model, featurizer):
+    def __init__(self, dataset, model=None, featurizer=None, batch_size=1024, workers=None, loader=None,
+                 shared_memory=False):
+        '''
+        Batch inference engine scoring every particle of (dataset) as model(featurizer(batch))
+        
+        dataset: (N, H, W) array, or preferably a memory-mapped ParticleStack/ParticleStore,
+                 which workers reopen themselves so particles are never pickled
+        model, featurizer: callables on a batch, sent to each worker once when the pool starts
+        loader: alternatively, a picklable function returning (model, featurizer), called once
+                in each worker, e.g. to load saved models there
+        batch_size: particles per task
+        workers: number of worker processes (default os.cpu_count()), 0 evaluates in this process
+        shared_memory: if True, batches are read here into a few reused shared memory buffers
+                       that workers read in place, for datasets that can't be reopened by
+                       workers (e.g. in-memory arrays) or slow storage best read by one process
+        
+        The pool (and with shared_memory its buffers) is started on the first evaluate()
+        and reused until close()
+        
+        Example:
+        
+        > with Evaluator(ParticleStack(paths), model, featurizer, batch_size=4096) as E:
+        >     scores = E.evaluate()
+        '''
         self.model = model
         self.dataset = dataset
         self.featurizer = featurizer
+        self.loader = loader
+        self.batch_size = batch_size
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.shared_memory = shared_memory
+        self._pool = None
+        self._slots = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def updater(self, key, value):
         return {
@@ -15,12 +88,99 @@ class Evaluator():
 
     def unit(self, row):
         return self.updater(
+            row,
             self.model(
             self.featurizer(row)
-            ), row
+            )
         )
 
+    def _chunks(self):
+        n = len(self.dataset)
+        return [(start, min(start+self.batch_size, n)) for start in range(0, n, self.batch_size)]
+
+    def _getPool(self):
+        if self._pool is None:
+            # With shared memory the workers never touch the dataset
+            dataset = None if self.shared_memory else self.dataset
+            if self.shared_memory:
+                start_tracker()
+            self._pool = mp.Pool(self.workers, initializer=_init_worker,
+                                 initargs=(dataset, self.model, self.featurizer, self.loader))
+        return self._pool
+
+    def iterEvaluate(self):
+        '''
+        Yields (start, scores) for consecutive batches as they are scored, in order
+        '''
+        if self.workers==0:
+            _init_worker(self.dataset, self.model, self.featurizer, self.loader)
+            for bounds in self._chunks():
+                yield _evaluate_chunk(bounds)
+            return
+        
+        if self.shared_memory:
+            for result in self._iterShared():
+                yield result
+            return
+        
+        for result in self._getPool().imap(_evaluate_chunk, self._chunks()):
+            yield result
+
+    def _getSlots(self):
+        '''
+        Shared memory slots for two batches per worker, created once so workers,
+        which keep the segments they attach to mapped, see the same segments every call
+        '''
+        if self._slots is None:
+            sample = np.asarray(self.dataset[0:1])
+            self._slots = SharedBatchPool((self.batch_size,)+sample.shape[1:], sample.dtype,
+                                          n_slots=2*self.workers)
+        return self._slots
+
+    def _iterShared(self):
+        '''
+        Keeps up to two batches per worker in flight in shared memory slots,
+        refilling each slot once its batch has been scored
+        '''
+        chunks = deque(self._chunks())
+        if not chunks:
+            return
+        pool = self._getPool()
+        slots = self._getSlots()
+        free = list(range(len(slots)))
+        pending = deque()
+        try:
+            while chunks or pending:
+                while chunks and free:
+                    slot = free.pop()
+                    start, stop = chunks.popleft()
+                    slots[slot][:stop-start] = self.dataset[start:stop]
+                    pending.append((slot, pool.apply_async(_evaluate_shared,
+                                                           ((slots.spec(slot), stop-start, start),))))
+                slot, result = pending.popleft()
+                yield result.get()
+                free.append(slot)
+        finally:
+            # Slots are reused by the next call, so wait for any tasks still reading them
+            for _, result in pending:
+                result.wait()
+
     def evaluate(self):
-        pool = mp.Pool()
-        result = pool.map(self.unit, self.dataset)
-        return result
\ No newline at end of file
+        '''
+        Returns the scores of all particles as one array
+        '''
+        scores = None
+        for start, batch_scores in self.iterEvaluate():
+            if scores is None:
+                scores = np.empty((len(self.dataset),)+batch_scores.shape[1:], dtype=batch_scores.dtype)
+            scores[start:start+len(batch_scores)] = batch_scores
+        return scores if scores is not None else np.empty(0)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._slots is not None:
+            self._slots.close()
+            self._slots = None
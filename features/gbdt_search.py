@@ -0,0 +1,284 @@
+'''
+Hyperparameter search for GBDTWrapper
+
+Example:
+
+> search = GBDTSearch(gbdt, n_jobs=4, threads_per_trial=2)
+> board = search.grid({'learning_rate': [0.03, 0.1], 'num_leaves': [15, 31, 63]})
+> search.save('../models/search')
+'''
+import csv
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from time import perf_counter
+import numpy as np
+
+import instrumentation as inst
+
+# The shared Dataset of each worker process, loaded once by _init_worker
+_worker = {}
+
+# Bins are not pre-filtered for the base min_data_in_leaf, so candidates can lower it
+DATASET_PARAMS = {'verbosity': -1, 'feature_pre_filter': False}
+
+
+def _init_worker(dataset_path, dataset_params):
+    import lightgbm as lgb
+    _worker['dataset'] = lgb.Dataset(dataset_path, params=dataset_params).construct()
+
+
+def median_curve(curves):
+    '''
+    Median over trials of the metric after each round, using the trials that ran that long
+    '''
+    if not curves:
+        return None
+    n = max(len(c) for c in curves)
+    return [float(np.median([c[i] for c in curves if len(c)>i])) for i in range(n)]
+
+
+def _pruner(reference, metric, higher_better, warmup, interval, state):
+    '''
+    Callback stopping a trial whose mean CV metric is worse than the median of the
+    finished trials (reference) at the same round
+    '''
+    import lightgbm as lgb
+    sign = 1 if higher_better else -1
+    def callback(env):
+        for result in env.evaluation_result_list:
+            if result[1]==metric:
+                score = result[2]
+                break
+        else:
+            return
+        if state['best'] is None or sign*score>sign*state['best']:
+            state['best'] = score
+            state['best_iteration'] = env.iteration
+        rounds = env.iteration + 1
+        if reference is None or rounds<warmup or rounds%interval or rounds>len(reference):
+            return
+        if sign*score<sign*reference[rounds-1]:
+            state['pruned'] = True
+            raise lgb.callback.EarlyStopException(state['best_iteration'], env.evaluation_result_list)
+    return callback
+
+
+def _run_trial(args):
+    '''
+    Worker running k-fold CV of one parameter set on the worker's shared Dataset
+    '''
+    import lightgbm as lgb
+    trial, params, reference, settings = args
+    metric = params['metric']
+    state = {'best': None, 'best_iteration': 0, 'pruned': False}
+    callbacks = [_pruner(reference, metric, settings['higher_better'], settings['prune_warmup'],
+                         settings['prune_interval'], state)]
+    if settings['early_stopping_rounds'] is not None:
+        callbacks.append(lgb.early_stopping(settings['early_stopping_rounds'], verbose=False))
+
+    dataset = _worker['dataset']
+    t0 = perf_counter()
+    results = lgb.cv(params, dataset, num_boost_round=settings['num_boost_round'],
+                     nfold=settings['nfold'], stratified=settings['stratified'],
+                     seed=settings['seed'], callbacks=callbacks)
+    seconds = perf_counter() - t0
+
+    curve = results['valid {}-mean'.format(metric)]
+    stdv = results['valid {}-stdv'.format(metric)]
+    best = int(np.argmax(curve) if settings['higher_better'] else np.argmin(curve))
+    # Each round trains on (k-1)/k of the rows in each of the k folds
+    rows = dataset.num_data()*(settings['nfold']-1)*len(curve)
+    return {
+        'trial': trial,
+        'params': params,
+        metric: float(curve[best]),
+        metric+'_std': float(stdv[best]),
+        'best_iteration': best + 1,
+        'rounds': len(curve),
+        'pruned': state['pruned'],
+        'seconds': seconds,
+        'rows_per_second': rows/seconds if seconds>0 else float('nan'),
+        'curve': [float(x) for x in curve],
+    }
+
+
+class GBDTSearch():
+    def __init__(self, gbdt, params=None, nfold=5, n_jobs=None, threads_per_trial=1,
+                 num_boost_round=2000, early_stopping_rounds=100, prune_warmup=50, prune_interval=25,
+                 stratified=True, random_state=0, work_dir=None):
+        '''
+        Parallel k-fold cross-validated search over GBDT parameters, on the training split
+        of (gbdt), a GBDTWrapper
+
+        The LightGBM Dataset is binned once and saved to work_dir, each worker process loads
+        it once and runs trials with threads_per_trial threads, so n_jobs*threads_per_trial
+        should not exceed the number of cores. Binning parameters (e.g. max_bin) are fixed by
+        this shared Dataset and should be given to the GBDTWrapper, not searched over.
+
+        params: base parameters that each candidate updates, defaults to GBDTWrapper.train's
+        n_jobs: number of trials run at once (default os.cpu_count()//threads_per_trial)
+        prune_warmup, prune_interval: after prune_warmup rounds and then every prune_interval
+                                      rounds, a trial is stopped if its CV metric is worse
+                                      than the median of the finished trials at that round
+        '''
+        self.gbdt = gbdt
+        self.params = params if params is not None else {
+            "objective" : "binary",
+            "metric" : "auc",
+            "boosting": 'gbdt',
+            "max_depth" : -1,
+            "learning_rate" : 0.01,
+            "verbosity" : -1,
+            "seed": random_state
+        }
+        self.metric = self.params.get('metric', 'auc')
+        self.higher_better = self.metric in ('auc', 'average_precision', 'ndcg', 'map', 'auc_mu')
+        self.nfold = nfold
+        self.threads_per_trial = threads_per_trial
+        self.n_jobs = n_jobs if n_jobs is not None else max(1, (os.cpu_count() or 1)//threads_per_trial)
+        self.num_boost_round = num_boost_round
+        self.early_stopping_rounds = early_stopping_rounds
+        self.prune_warmup = prune_warmup
+        self.prune_interval = prune_interval
+        self.stratified = stratified
+        self.random_state = random_state
+        self.work_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix='gbdt_search_')
+        self.leaderboard = []
+        self._dataset_path = None
+
+    def _sharedDataset(self):
+        '''
+        Bins the training split once and saves it where the workers load it from
+        '''
+        if self._dataset_path is None:
+            if not os.path.exists(self.work_dir):
+                os.makedirs(self.work_dir)
+            self._dataset_path = os.path.join(self.work_dir, 'search.bin')
+            dataset = self.gbdt.lgb_dataset
+            if dataset._handle is None:
+                # Not binned yet (a Dataset loaded from a .bin file keeps its own bins)
+                dataset.params = dict(dataset.params or {}, **DATASET_PARAMS)
+            dataset.construct().save_binary(self._dataset_path)
+        return self._dataset_path
+
+    def _settings(self):
+        return {
+            'nfold': self.nfold,
+            'num_boost_round': self.num_boost_round,
+            'early_stopping_rounds': self.early_stopping_rounds,
+            'prune_warmup': self.prune_warmup,
+            'prune_interval': self.prune_interval,
+            'stratified': self.stratified,
+            'seed': self.random_state,
+            'higher_better': self.higher_better,
+        }
+
+    def grid(self, grid):
+        '''
+        Tries every combination of a dict of parameter name -> list of values
+        '''
+        from sklearn.model_selection import ParameterGrid
+        return self.run(list(ParameterGrid(grid)))
+
+    def random(self, distributions, n_iter=20):
+        '''
+        Tries n_iter samples of a dict of parameter name -> list of values or scipy.stats distribution
+        '''
+        from sklearn.model_selection import ParameterSampler
+        return self.run(list(ParameterSampler(distributions, n_iter, random_state=self.random_state)))
+
+    def run(self, candidates):
+        '''
+        Runs a trial for each dict of parameters in (candidates), n_jobs at a time,
+        and returns the leaderboard of all trials run so far, best first
+        A trial that raises is recorded with its exception in 'error', after the others
+        '''
+        dataset_path = self._sharedDataset()
+        settings = self._settings()
+        todo = list(enumerate(candidates, start=len(self.leaderboard)))
+        finished = [r['curve'] for r in self.leaderboard if not r['pruned']]
+
+        inst.log('gbdt_search', "Running {} trials, {} at a time . . .".format(len(todo), self.n_jobs))
+        with ProcessPoolExecutor(self.n_jobs, initializer=_init_worker,
+                                 initargs=(dataset_path, DATASET_PARAMS)) as pool:
+            running = {}
+            while todo or running:
+                while todo and len(running)<self.n_jobs:
+                    trial, candidate = todo.pop(0)
+                    params = dict(self.params)
+                    params.update(candidate)
+                    params['metric'] = self.metric
+                    params['num_threads'] = self.threads_per_trial
+                    # Trials are compared to the finished ones when they start
+                    future = pool.submit(_run_trial, (trial, params, median_curve(finished), settings))
+                    running[future] = (trial, params)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial, params = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. parameters LightGBM rejects, the other trials carry on
+                        inst.log('gbdt_search', "Trial {} failed: {!r}".format(trial, e))
+                        inst.count('gbdt_search.failed')
+                        self.leaderboard.append(self._failed(trial, params, e))
+                        continue
+                    result['error'] = None
+                    self.leaderboard.append(result)
+                    if not result['pruned']:
+                        finished.append(result['curve'])
+                    inst.count('gbdt_search.pruned' if result['pruned'] else 'gbdt_search.completed')
+                    inst.record('gbdt_search.trial', result['seconds'], trial=result['trial'],
+                                score=result[self.metric], rounds=result['rounds'], pruned=result['pruned'])
+
+        sign = -1 if self.higher_better else 1
+        # Failed trials last
+        self.leaderboard.sort(key=lambda r: (r['error'] is not None, r['pruned'], sign*r[self.metric]))
+        return self.leaderboard
+
+    def _failed(self, trial, params, error):
+        '''
+        Leaderboard row of a trial that raised (error)
+        '''
+        return {
+            'trial': trial,
+            'params': params,
+            self.metric: float('nan'),
+            self.metric+'_std': float('nan'),
+            'best_iteration': 0,
+            'rounds': 0,
+            'pruned': False,
+            'seconds': float('nan'),
+            'rows_per_second': float('nan'),
+            'curve': [],
+            # On one line, for the CSV
+            'error': '{}: {}'.format(type(error).__name__, ' '.join(str(error).split())),
+        }
+
+    @property
+    def best_params(self):
+        if not self.leaderboard or self.leaderboard[0]['error'] is not None:
+            return None
+        return self.leaderboard[0]['params']
+
+    def save(self, path):
+        '''
+        Writes the leaderboard to folder (path) as leaderboard.json (with metric curves)
+        and leaderboard.csv (one row per trial, parameters as columns), failed trials
+        have a nan metric and their exception in the error column
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'leaderboard.json'), 'w') as f:
+            json.dump(self.leaderboard, f, indent=1)
+
+        param_names = sorted({k for r in self.leaderboard for k in r['params']})
+        columns = ['trial', self.metric, self.metric+'_std', 'best_iteration', 'rounds', 'pruned',
+                   'seconds', 'rows_per_second', 'error']
+        with open(os.path.join(path, 'leaderboard.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns + param_names)
+            for r in self.leaderboard:
+                writer.writerow([r[c] for c in columns] + [r['params'].get(k, '') for k in param_names])
@@ -0,0 +1,273 @@
+'''
+Timers, counters and memory high-water marks for the processing stages
+
+Library code records into the module's recorder and is silent unless verbose() is called.
+Batch jobs can export everything recorded during a run as JSON, and run chosen
+stages under a profiler
+
+Example:
+
+> import instrumentation as inst
+> inst.verbose()                                  # print progress as before
+> inst.profile(['featurizer.estimators'], 'prof') # dump cProfile stats of a stage
+> E.fit()
+> inst.export('metrics.json')
+'''
+import cProfile
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def _windows_peak_rss():
+    '''
+    Peak working set of this process in bytes, from GetProcessMemoryInfo
+    '''
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        raise OSError('GetProcessMemoryInfo failed')
+    return counters.PeakWorkingSetSize
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process in MB, or nan where it can't be measured
+    '''
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kB elsewhere
+        return rss/2**20 if sys.platform=='darwin' else rss/2**10
+    try:
+        return _windows_peak_rss()/2**20
+    except (AttributeError, OSError):
+        return float('nan')
+
+
+def rss_mb():
+    '''
+    Current resident memory of this process in MB, or None where /proc isn't available
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Recorder():
+    def __init__(self, max_events=100000):
+        '''
+        Collects timers (count, total and max seconds per name), counters, the peak memory
+        seen at the end of each timed stage and a list of structured events, which are
+        also passed to any listeners (see verbose())
+        '''
+        self.max_events = max_events
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._profile = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+            self.memory = {}
+            self.events = []
+            self._profiled = {}
+            self._start = time()
+
+    def emit(self, event):
+        event['t'] = time() - self._start
+        with self._lock:
+            if len(self.events)<self.max_events:
+                self.events.append(event)
+        for listener in self.listeners:
+            listener(event)
+
+    def record(self, name, seconds, detail=False, **fields):
+        '''
+        Records a duration measured by the caller, e.g. in a worker thread
+        detail: the event is recorded but not printed, for stages timed many times per run
+        '''
+        peak = peak_rss_mb()
+        with self._lock:
+            t = self.timers.setdefault(name, {'count': 0, 'seconds': 0., 'max_seconds': 0.})
+            t['count'] += 1
+            t['seconds'] += seconds
+            t['max_seconds'] = max(t['max_seconds'], seconds)
+            self.memory[name] = max(self.memory.get(name, 0.), peak)
+        event = {'type': 'timer', 'name': name, 'seconds': seconds, 'rss_mb': rss_mb(), 'peak_rss_mb': peak}
+        if detail:
+            event['detail'] = True
+        event.update(fields)
+        self.emit(event)
+
+    @contextmanager
+    def timer(self, name, detail=False, **fields):
+        '''
+        Times the body of a with block as stage (name), running it under the profiler
+        if profile() selected it
+        '''
+        profiler = self._startProfiler(name)
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - t0
+            if profiler is not None:
+                self._stopProfiler(name, profiler)
+            self.record(name, seconds, detail, **fields)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def log(self, name, message, **fields):
+        '''
+        A progress message, only shown by listeners
+        '''
+        event = {'type': 'log', 'name': name, 'message': message}
+        event.update(fields)
+        self.emit(event)
+
+    def progress(self, iterable, name, total=None):
+        '''
+        Wraps an iterable, counting its items as (name), with a tqdm bar if verbose
+        '''
+        if any(getattr(listener, 'progress_bars', False) for listener in self.listeners):
+            try:
+                from tqdm import tqdm
+                iterable = tqdm(iterable, total=total, desc=name)
+            except ImportError:
+                pass
+        for item in iterable:
+            self.count(name)
+            yield item
+
+    def profile(self, stages, path='.', sampler='cprofile'):
+        '''
+        Runs the timed stages named in (stages) under a profiler, dumping its results to
+        folder (path) as <stage>.<n>.prof (cProfile, for pstats/snakeviz) or, with
+        sampler='pyinstrument', <stage>.<n>.txt from the pyinstrument sampling profiler.
+        stages='*' profiles every stage, None turns profiling off
+        '''
+        if stages is None:
+            self._profile = None
+            return
+        if sampler not in ('cprofile', 'pyinstrument'):
+            raise ValueError("Unknown profiler {}".format(sampler))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._profile = {'stages': stages if stages=='*' else set(stages), 'path': path,
+                         'sampler': sampler, 'active': False}
+
+    def _startProfiler(self, name):
+        p = self._profile
+        # Only one profiler runs at a time, so nested stages are part of the outer profile
+        if p is None or p['active'] or (p['stages']!='*' and name not in p['stages']):
+            return None
+        p['active'] = True
+        if p['sampler']=='pyinstrument':
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stopProfiler(self, name, profiler):
+        p = self._profile
+        with self._lock:
+            n = self._profiled.get(name, 0)
+            self._profiled[name] = n + 1
+        fname = os.path.join(p['path'], '{}.{}'.format(name, n))
+        if p['sampler']=='pyinstrument':
+            profiler.stop()
+            with open(fname+'.txt', 'w') as f:
+                f.write(profiler.output_text())
+        else:
+            profiler.disable()
+            profiler.dump_stats(fname+'.prof')
+        p['active'] = False
+
+    def summary(self, events=True):
+        with self._lock:
+            summary = {
+                'timers': {k: dict(v) for k, v in self.timers.items()},
+                'counters': dict(self.counters),
+                'peak_rss_mb': dict(self.memory),
+                'process_peak_rss_mb': peak_rss_mb(),
+            }
+            if events:
+                summary['events'] = list(self.events)
+        return summary
+
+    def export(self, path, events=True):
+        '''
+        Writes everything recorded since the last reset() to a JSON file (path)
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.summary(events), f, indent=1, default=repr)
+
+
+class ConsoleListener():
+    # Whether Recorder.progress shows tqdm bars
+    progress_bars = True
+
+    def __init__(self, stream=None):
+        '''
+        Prints events in the style of the old progress prints
+        '''
+        self.stream = stream
+
+    def __call__(self, event):
+        stream = self.stream if self.stream is not None else sys.stdout
+        if event['type']=='log':
+            stream.write(event['message']+'\n')
+        elif event['type']=='timer' and not event.get('detail', False):
+            extra = ''.join(', {}={}'.format(k, v) for k, v in event.items()
+                            if k not in ('type', 'name', 'seconds', 'rss_mb', 'peak_rss_mb', 't'))
+            stream.write("\t{} time taken = {:0.3f}s{}\n".format(event['name'], event['seconds'], extra))
+
+
+# The recorder used by all modules
+recorder = Recorder()
+
+timer = recorder.timer
+record = recorder.record
+count = recorder.count
+log = recorder.log
+progress = recorder.progress
+profile = recorder.profile
+export = recorder.export
+reset = recorder.reset
+
+
+def verbose(enabled=True, stream=None):
+    '''
+    Turns printing of progress, timings and progress bars on or off
+    '''
+    recorder.listeners = [l for l in recorder.listeners if not isinstance(l, ConsoleListener)]
+    if enabled:
+        recorder.listeners.append(ConsoleListener(stream))
@@ -1,8 +1,10 @@
 import mrcfile
 import os
-from tqdm import tqdm
+from collections import OrderedDict
 import numpy as np
 
+import instrumentation as inst
+
 def get_files_of_type_from_path(fpath, fext):
     '''
     Gets a list of all paths with a particular extension (fext) given a path (fpath)
@@ -37,7 +39,8 @@ def get_all_imgs_from_mrcs(fname):
 def get_all_imgs_from_paths(flist):
     '''
     Given a list of paths to .mrcs files (flist), produces a list of numpy arrays of images
-    Note that this is creating an in-memory list, so don't use it with a large list of images
+    Note that this is creating an in-memory list, so don't use it with a large list of images,
+    use ParticleStack instead
     '''
     all_imgs = []
     
@@ -48,6 +51,167 @@ def get_all_imgs_from_paths(flist):
     return all_imgs
 
 
+class StackIndex():
+    '''
+    Indexing over a sequence of (n, H, W) arrays that behaves like one (N, H, W) array
+    
+    Subclasses set counts, offsets, frame_shape and dtype and implement frames(i),
+    which returns the i-th array. Integer indices and slices that fall inside a single
+    array return views, anything else is copied into a new contiguous array
+    '''
+    def _setCounts(self, counts, frame_shape, dtype):
+        self.counts = np.array(counts, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)]).astype(np.int64)
+        self.frame_shape = tuple(frame_shape) if frame_shape is not None else (0, 0)
+        self.dtype = np.dtype(dtype) if dtype is not None else np.dtype(np.float32)
+        
+    def frames(self, file_idx):
+        raise NotImplementedError
+        
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]),) + tuple(self.frame_shape)
+    
+    def __len__(self):
+        return int(self.offsets[-1])
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+        
+    def close(self):
+        pass
+    
+    def __getstate__(self):
+        # Open files are not sent to other processes, they are reopened on first access there
+        state = self.__dict__.copy()
+        if '_open' in state:
+            state['_open'] = OrderedDict()
+        return state
+    
+    def locate(self, idx):
+        '''
+        Maps global particle indices (idx) to (file index, frame index) pairs,
+        works on scalars and arrays
+        '''
+        idx = np.asarray(idx, dtype=np.int64)
+        n = len(self)
+        idx = np.where(idx<0, idx+n, idx)
+        if np.any((idx<0) | (idx>=n)):
+            raise IndexError('Particle index out of range for stack of {} particles'.format(n))
+        file_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        return file_idx, idx - self.offsets[file_idx]
+    
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            file_idx, frame = self.locate(key)
+            return self.frames(int(file_idx))[int(frame)]
+        
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step==1 and stop>start:
+                file_idx, frame = self.locate([start, stop-1])
+                if file_idx[0]==file_idx[1]:
+                    return self.frames(int(file_idx[0]))[frame[0]:frame[1]+1]
+            return self.take(np.arange(start, stop, step))
+        
+        return self.take(key)
+    
+    def take(self, indices, out=None):
+        '''
+        Copies the particles at global indices (indices) into a contiguous (len(indices), H, W) array,
+        reading each file once. If given, (out) is filled in place
+        '''
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if out is None:
+            out = np.empty((len(indices),)+tuple(self.frame_shape), dtype=self.dtype)
+        if len(indices)==0:
+            return out
+        
+        file_idx, frame = self.locate(indices)
+        for f in np.unique(file_idx):
+            mask = file_idx==f
+            out[mask] = self.frames(int(f))[frame[mask]]
+        return out
+    
+    def iter_batches(self, batch_size=1024, copy=False):
+        '''
+        Yields (start, batch) pairs of consecutive particles, batch being at most batch_size long
+        Batches are views into the underlying arrays unless they span a file boundary or copy is True
+        '''
+        for start in range(0, len(self), batch_size):
+            batch = self[start:start+batch_size]
+            if copy:
+                batch = np.array(batch)
+            inst.count('stack.particles', len(batch))
+            inst.count('stack.bytes', batch.nbytes)
+            yield start, batch
+
+
+class ParticleStack(StackIndex):
+    def __init__(self, paths, max_open=64):
+        '''
+        A read-only (N, H, W) view over all of the particles in a list of .mrcs files (paths)
+        
+        Only the headers are read on construction. Files are memory-mapped when first
+        indexed, so frames are not read from disk until they are touched and are not
+        copied until the caller asks for it (fancy indexing, batches that span files, copy=True)
+        At most max_open files are kept mapped at once, least recently used are closed first
+        
+        Example:
+        
+        > stack = ParticleStack(get_files_of_type_from_path(path, '.mrcs'))
+        > stack[0]                          # view into the first file
+        > stack[10:20]                      # view if the range sits in one file
+        > stack[[3, 1000, 7]]               # copied into a new (3, H, W) array
+        > for start, batch in stack.iter_batches(4096): ...
+        '''
+        self.paths = list(paths)
+        self.max_open = max_open
+        self._open = OrderedDict()
+        
+        counts = []
+        frame_shape = None
+        dtype = None
+        for fname in self.paths:
+            if os.path.splitext(fname)[1]!='.mrcs':
+                raise ValueError('File extension of {} is not .mrcs'.format(fname))
+            with mrcfile.open(fname, header_only=True) as mrc:
+                header = mrc.header
+                shape = (int(header.ny), int(header.nx))
+                if frame_shape is None:
+                    frame_shape = shape
+                    dtype = mrcfile.utils.data_dtype_from_header(header)
+                elif shape!=frame_shape:
+                    raise ValueError('Frames in {} have shape {}, expected {}'.format(fname, shape, frame_shape))
+                counts.append(int(header.nz))
+        
+        self._setCounts(counts, frame_shape, dtype)
+        
+    def close(self):
+        '''
+        Closes all mapped files. Views handed out before closing stay valid
+        '''
+        while self._open:
+            _, mrc = self._open.popitem(last=False)
+            mrc.close()
+    
+    def frames(self, file_idx):
+        '''
+        Returns the memory-mapped (n, H, W) array of a single file
+        '''
+        if file_idx in self._open:
+            self._open.move_to_end(file_idx)
+        else:
+            while len(self._open)>=self.max_open:
+                _, mrc = self._open.popitem(last=False)
+                mrc.close()
+            self._open[file_idx] = mrcfile.mmap(self.paths[file_idx], mode='r')
+        return self._open[file_idx].data.reshape(-1, *self.frame_shape)
+
+
 def create_dataset_from_mrcs(classes, paths_in, paths_out, fext='.mrcs'):
     '''
     Given class classes (classes),
@@ -66,7 +230,7 @@ def create_dataset_from_mrcs(classes, paths_in, paths_out, fext='.mrcs'):
         in_paths = get_files_of_type_from_path(paths_in[i], fext)
         
         # Loop
-        for fpath in tqdm(in_paths):
+        for fpath in inst.progress(in_paths, 'ingest.files'):
             # Get list of images
             imgs = get_all_imgs_from_mrcs(fpath)
             
@@ -0,0 +1,375 @@
+import json
+import multiprocessing as mp
+import os
+from collections import OrderedDict
+import numpy as np
+
+import instrumentation as inst
+from mrcs_loader import StackIndex, ParticleStack, get_files_of_type_from_path
+
+INDEX_FILE = 'index.json'
+
+# Default size of a shard, which bounds the memory a writer holds at once
+SHARD_BYTES = 256*2**20
+
+
+def shard_particles(frame_shape, dtype, shard_bytes=SHARD_BYTES):
+    '''
+    Number of particles of (frame_shape) and (dtype) that fit in shard_bytes, at least 1
+    '''
+    frame_bytes = int(np.prod(frame_shape))*np.dtype(dtype).itemsize
+    if frame_bytes==0:
+        raise ValueError('Cannot size shards for empty frames of shape {}'.format(tuple(frame_shape)))
+    return max(1, int(shard_bytes)//frame_bytes)
+
+
+class ParticleStoreWriter():
+    def __init__(self, path, frame_shape, dtype=np.float32, shard_size=None,
+                 compress=False, classes=None, shard_bytes=SHARD_BYTES):
+        '''
+        Packs particles into a directory (path) of large shards instead of one file per particle
+
+        Shards hold up to shard_size particles each, by default as many as fit in
+        shard_bytes, which is the memory the writer buffers. They are written as .npy files,
+        or as compressed .npz files if compress is True. Class labels and provenance
+        (source file and frame within it) are stored beside the images and an
+        index.json describing the store is written on close()
+
+        Example:
+
+        > with ParticleStoreWriter(path_out, (H, W), classes=['good', 'bad']) as writer:
+        >     writer.append(imgs, label=0, source=fname)
+        '''
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size if shard_size is not None else \
+            shard_particles(self.frame_shape, self.dtype, shard_bytes)
+        self.compress = compress
+        self.classes = list(classes) if classes is not None else None
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self._buffer = np.empty((self.shard_size,)+self.frame_shape, dtype=self.dtype)
+        self._n_buffered = 0
+        self._shards = []
+        self._labels = []
+        self._source_idx = []
+        self._frames = []
+        self.source_files = []
+        self._source_ids = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(self._shards) + self._n_buffered
+
+    def append(self, imgs, label=-1, source=None, frames=None):
+        '''
+        Appends an (n, H, W) array of particles (imgs)
+
+        label: class label of all particles, or length n array of labels
+        source: path of the file the particles were read from, or length n array of paths
+        frames: length n array of frame indices within source, defaults to 0..n-1
+        '''
+        imgs = np.asarray(imgs)
+        if imgs.ndim==2:
+            imgs = imgs[None]
+        if imgs.shape[1:]!=self.frame_shape:
+            raise ValueError('Particles have shape {}, expected {}'.format(imgs.shape[1:], self.frame_shape))
+        n = imgs.shape[0]
+
+        if source is None or isinstance(source, str):
+            sources, source_inv = [source], np.zeros(n, dtype=np.int32)
+        else:
+            sources, source_inv = np.unique(np.asarray(source, dtype=str), return_inverse=True)
+        for src in sources:
+            if src not in self._source_ids:
+                self._source_ids[src] = len(self.source_files)
+                self.source_files.append(src)
+        source_ids = np.array([self._source_ids[src] for src in sources], dtype=np.int32)
+        if frames is None:
+            frames = np.arange(n)
+        self._labels.append(np.broadcast_to(np.asarray(label, dtype=np.int32), (n,)))
+        self._source_idx.append(source_ids[source_inv.ravel()])
+        self._frames.append(np.asarray(frames, dtype=np.int32))
+
+        written = 0
+        while written<n:
+            k = min(n-written, self.shard_size-self._n_buffered)
+            self._buffer[self._n_buffered:self._n_buffered+k] = imgs[written:written+k]
+            self._n_buffered += k
+            written += k
+            if self._n_buffered==self.shard_size:
+                self._flush()
+
+    def _flush(self):
+        if self._n_buffered==0:
+            return
+        fname = os.path.join(self.path, shard_name(len(self._shards), self.compress))
+        save_shard(fname, self._buffer[:self._n_buffered], self.compress)
+        self._shards.append(self._n_buffered)
+        self._n_buffered = 0
+
+    def close(self):
+        '''
+        Writes the last partial shard, the labels/provenance arrays and the index
+        '''
+        if self._closed:
+            return
+        self._flush()
+
+        def cat(arrs):
+            return np.concatenate(arrs) if arrs else np.empty(0, dtype=np.int32)
+        write_index(self.path, self.frame_shape, self.dtype, self.shard_size, self.compress,
+                    self._shards, self.classes, self.source_files,
+                    cat(self._labels), cat(self._source_idx), cat(self._frames))
+        self._buffer = None
+        self._closed = True
+
+
+def shard_name(i, compress=False):
+    return 'shard_{:06d}.{}'.format(i, 'npz' if compress else 'npy')
+
+
+def save_shard(fname, data, compress=False):
+    '''
+    Writes a shard atomically, so a shard file that exists is always complete
+    '''
+    tmp = fname+'.tmp'
+    with open(tmp, 'wb') as f:
+        if compress:
+            np.savez_compressed(f, images=data)
+        else:
+            np.save(f, data)
+    os.replace(tmp, fname)
+
+
+def write_index(path, frame_shape, dtype, shard_size, compress, shards, classes, source_files,
+                labels, source_idx, frames):
+    '''
+    Writes the labels/provenance arrays and the index.json of a store,
+    the index is written last so a store without one is incomplete
+    '''
+    np.save(os.path.join(path, 'labels.npy'), np.asarray(labels, dtype=np.int32))
+    np.save(os.path.join(path, 'source_idx.npy'), np.asarray(source_idx, dtype=np.int32))
+    np.save(os.path.join(path, 'frames.npy'), np.asarray(frames, dtype=np.int32))
+
+    index = {
+        'frame_shape': list(frame_shape),
+        'dtype': np.dtype(dtype).str,
+        'shard_size': shard_size,
+        'compress': compress,
+        'shards': [int(x) for x in shards],
+        'classes': classes,
+        'source_files': source_files,
+    }
+    with open(os.path.join(path, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+class ParticleStore(StackIndex):
+    def __init__(self, path, max_open=4):
+        '''
+        Reads a store written by ParticleStoreWriter as one (N, H, W) array
+
+        Uncompressed shards are memory-mapped, so random access only reads the
+        touched particles and iter_batches streams each shard sequentially.
+        Compressed shards are decompressed whole on first access and the max_open
+        most recently used ones are kept in memory
+
+        store.labels, store.frame_idx: length N arrays
+        store.sources: length N array of paths of the file each particle came from
+        '''
+        self.path = path
+        self.max_open = max_open
+        self._open = OrderedDict()
+
+        with open(os.path.join(self.path, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        self.compress = self.index['compress']
+        self.classes = self.index['classes']
+        self.source_files = self.index['source_files']
+        self._setCounts(self.index['shards'], self.index['frame_shape'], self.index['dtype'])
+
+        self.labels = np.load(os.path.join(self.path, 'labels.npy'), mmap_mode='r')
+        self.frame_idx = np.load(os.path.join(self.path, 'frames.npy'), mmap_mode='r')
+        self.source_idx = np.load(os.path.join(self.path, 'source_idx.npy'), mmap_mode='r')
+
+    @property
+    def sources(self):
+        return np.asarray(self.source_files, dtype=object)[self.source_idx]
+
+    def close(self):
+        self._open.clear()
+
+    def frames(self, shard_idx):
+        '''
+        Returns the (n, H, W) array of a single shard
+        '''
+        if shard_idx in self._open:
+            self._open.move_to_end(shard_idx)
+        else:
+            while len(self._open)>=self.max_open:
+                self._open.popitem(last=False)
+            fname = os.path.join(self.path, shard_name(shard_idx, self.compress))
+            if self.compress:
+                with np.load(fname) as npz:
+                    self._open[shard_idx] = npz['images']
+            else:
+                self._open[shard_idx] = np.load(fname, mmap_mode='r')
+        return self._open[shard_idx]
+
+
+def create_store_from_mrcs(classes, paths_in, path_out, fext='.mrcs', shard_size=None, compress=False,
+                           shard_bytes=SHARD_BYTES):
+    '''
+    Given a list of classes (classes),
+    a list of paths to folders containing .mrcs files for each class (paths_in)
+    and a path to a folder where the store is written (path_out)
+    This packs all particles into a single ParticleStore, labelled with the index of their class
+    Classes without any stacks are skipped, but keep their index
+    '''
+    writer = None
+    for i, cl in enumerate(classes):
+        in_paths = sorted(get_files_of_type_from_path(paths_in[i], fext))
+        if not in_paths:
+            inst.log('ingest', "No {} files for class {} in {}".format(fext, cl, paths_in[i]))
+            continue
+        with ParticleStack(in_paths, max_open=1) as stack:
+            if writer is None:
+                writer = ParticleStoreWriter(path_out, stack.frame_shape, dtype=stack.dtype,
+                                             shard_size=shard_size, compress=compress, classes=classes,
+                                             shard_bytes=shard_bytes)
+            for f, fpath in enumerate(inst.progress(in_paths, 'ingest.files')):
+                frames = stack.frames(f)
+                writer.append(frames, label=i, source=fpath)
+                inst.count('ingest.particles', len(frames))
+                inst.count('ingest.bytes', frames.nbytes)
+    if writer is None:
+        raise ValueError('No {} files in any of {}'.format(fext, ', '.join(paths_in)))
+    writer.close()
+    return writer
+
+
+def plan_shards(counts, shard_size):
+    '''
+    Groups consecutive source files with (counts) particles each into shards of
+    roughly shard_size particles, never splitting a file across shards.
+    Returns a list of lists of source indices
+    '''
+    groups = []
+    current = []
+    n = 0
+    for i, c in enumerate(counts):
+        if current and n+c>shard_size:
+            groups.append(current)
+            current = []
+            n = 0
+        current.append(i)
+        n += c
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _ingest_shard(args):
+    '''
+    Worker for ingest_mrcs_parallel, reads the stacks of one shard and writes it
+    '''
+    fname, paths, n, frame_shape, dtype, compress = args
+    shape = (n,)+tuple(frame_shape)
+    with ParticleStack(paths, max_open=1) as stack:
+        if compress:
+            data = np.empty(shape, dtype=dtype)
+            for f in range(len(paths)):
+                data[stack.offsets[f]:stack.offsets[f+1]] = stack.frames(f)
+            save_shard(fname, data, compress)
+            return n
+        
+        # Written file by file through a memory map, so only one input stack is held at a time
+        tmp = fname+'.tmp'
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+        for f in range(len(paths)):
+            data[stack.offsets[f]:stack.offsets[f+1]] = stack.frames(f)
+        data.flush()
+        del data
+    os.replace(tmp, fname)
+    return n
+
+
+def ingest_mrcs_parallel(classes, paths_in, path_out, fext='.mrcs', n_workers=None,
+                         shard_size=None, compress=False, shard_bytes=SHARD_BYTES):
+    '''
+    Parallel version of create_store_from_mrcs
+    
+    The input stacks are sorted, grouped into shards up front from their headers and
+    each shard is read and written by one worker of a process pool, so reads and writes
+    of different shards overlap. Particle IDs only depend on the sorted inputs and
+    shard_size, not on n_workers or on the order workers finish in.
+    shard_size defaults to as many particles as fit in shard_bytes. Uncompressed shards
+    are written to disk file by file, compressed ones are built in memory by each worker
+    
+    Shards are written atomically, so rerunning after a crash skips the shards that
+    already exist and only ingests the rest. Returns the ParticleStore
+    '''
+    if not os.path.exists(path_out):
+        os.makedirs(path_out)
+    
+    source_files = []
+    source_labels = []
+    for i, cl in enumerate(classes):
+        in_paths = sorted(get_files_of_type_from_path(paths_in[i], fext))
+        source_files.extend(in_paths)
+        source_labels.extend([i]*len(in_paths))
+    if not source_files:
+        raise ValueError('No {} files in any of {}'.format(fext, ', '.join(paths_in)))
+    
+    # Headers only, to lay out shards and provenance before reading any data
+    stack = ParticleStack(source_files)
+    if shard_size is None:
+        shard_size = shard_particles(stack.frame_shape, stack.dtype, shard_bytes)
+    groups = plan_shards(stack.counts, shard_size)
+    
+    shards = [int(stack.counts[group].sum()) for group in groups]
+    
+    # Existing shards can only be reused if they were laid out the same way
+    plan = {'source_files': source_files, 'shards': shards, 'compress': compress}
+    plan_path = os.path.join(path_out, 'plan.json')
+    if os.path.exists(plan_path):
+        with open(plan_path, 'r') as f:
+            if json.load(f)!=plan:
+                raise ValueError('{} holds a partial store of different inputs'.format(path_out))
+    else:
+        with open(plan_path, 'w') as f:
+            json.dump(plan, f)
+    
+    tasks = []
+    for g, (group, n) in enumerate(zip(groups, shards)):
+        fname = os.path.join(path_out, shard_name(g, compress))
+        if not os.path.exists(fname):
+            tasks.append((fname, [source_files[j] for j in group], n,
+                          stack.frame_shape, stack.dtype, compress))
+    
+    if tasks:
+        inst.log('ingest', "Ingesting {} of {} shards . . .".format(len(tasks), len(groups)))
+        frame_bytes = int(np.prod(stack.frame_shape))*np.dtype(stack.dtype).itemsize
+        with inst.timer('ingest', shards=len(tasks)), mp.Pool(n_workers) as pool:
+            for n in inst.progress(pool.imap_unordered(_ingest_shard, tasks), 'ingest.shards',
+                                   total=len(tasks)):
+                inst.count('ingest.particles', n)
+                inst.count('ingest.bytes', n*frame_bytes)
+    
+    counts = stack.counts
+    write_index(path_out, stack.frame_shape, stack.dtype, shard_size, compress, shards, classes,
+                source_files,
+                labels=np.repeat(source_labels, counts),
+                source_idx=np.repeat(np.arange(len(source_files)), counts),
+                frames=np.concatenate([np.arange(c) for c in counts]) if len(counts) else [])
+    return ParticleStore(path_out)
@@ -0,0 +1,151 @@
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+
+class SharedArray():
+    def __init__(self, shape, dtype=np.float32, name=None):
+        '''
+        Numpy array in a multiprocessing.shared_memory segment, which other processes
+        attach to by name and read or write without copying
+
+        Creates a new segment if name is None (this object then owns it and must unlink() it),
+        otherwise attaches to the existing segment (name)
+
+        Example:
+
+        > owner = SharedArray((N, H, W))
+        > owner.array[:] = batch
+        > pool.map(work, [owner.spec])  # work() calls SharedArray.attach(spec).array
+        > owner.unlink()
+        '''
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(self.shape))*self.dtype.itemsize, 1)
+        self.owner = name is None
+        self._shm = shared_memory.SharedMemory(name=name, create=self.owner, size=nbytes if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def spec(self):
+        '''
+        Small picklable description of the segment, to send to workers instead of the data
+        '''
+        return (self.name, self.shape, self.dtype.str)
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
+
+    def close(self):
+        '''
+        Detaches this process from the segment, the array can no longer be used
+        '''
+        if self._shm is not None:
+            self.array = None
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        '''
+        Detaches and frees the segment, only the owner may do this
+        '''
+        if not self.owner:
+            raise ValueError('Only the process that created {} may unlink it'.format(self.name))
+        shm = self._shm
+        self.close()
+        if shm is not None:
+            shm.unlink()
+
+
+def start_tracker():
+    '''
+    Starts the resource tracker that unlinks leaked segments at exit, call it before
+    starting worker processes so that they share it with this process instead of each
+    starting their own, which would report the segments they attached to as leaked
+    '''
+    resource_tracker.ensure_running()
+
+
+# Segments attached by this (worker) process, so each is mapped once and not once per task
+_attached = {}
+
+
+def attached(spec):
+    '''
+    Returns the array of a segment created by another process, attaching to it on first use
+    '''
+    name = spec[0]
+    if name not in _attached:
+        _attached[name] = SharedArray.attach(spec)
+    return _attached[name].array
+
+
+def detach(name=None):
+    '''
+    Detaches this process from segment (name), or from all segments attached by attached()
+    '''
+    names = list(_attached) if name is None else [name]
+    for n in names:
+        seg = _attached.pop(n, None)
+        if seg is not None:
+            seg.close()
+
+
+def _release(segments):
+    for seg in segments:
+        if seg._shm is not None:
+            seg.unlink()
+
+
+class SharedBatchPool():
+    def __init__(self, batch_shape, dtype=np.float32, n_slots=2):
+        '''
+        A fixed set of (n_slots) shared memory buffers of batch_shape, e.g. (batch_size, H, W),
+        that the loader fills and workers read in place, reused batch after batch
+        
+        All segments are unlinked by close(), on leaving a with block, or at the latest when
+        the pool is garbage collected or the interpreter exits, so none are leaked
+        
+        Example:
+        
+        > with SharedBatchPool((4096, H, W), n_slots=4) as slots:
+        >     slots[0][:n] = batch
+        >     result = pool.apply_async(work, (slots.spec(0), n))
+        '''
+        self.batch_shape = tuple(batch_shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = [SharedArray(self.batch_shape, self.dtype) for _ in range(n_slots)]
+        self._finalizer = weakref.finalize(self, _release, list(self.slots))
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __getitem__(self, i):
+        return self.slots[i].array
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def spec(self, i):
+        return self.slots[i].spec
+
+    def close(self):
+        self._finalizer()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+import instrumentation as inst
+from ImageTransforms import MultiTransform, UnkeyableError, as_stack
+
+
+def fingerprint(data, block_size=1<<24):
+    '''
+    Returns a content hash of (data), a list of equally-sized arrays, an (N, H, W) array
+    or a ParticleStack/ParticleStore, covering its shape, dtype and values
+    Memory-mapped data is hashed in blocks of about block_size bytes
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    if not isinstance(data, np.ndarray) and not hasattr(data, 'frame_shape'):
+        data = as_stack(data)
+    h.update(repr((tuple(data.shape), np.dtype(data.dtype).str)).encode())
+    frame_bytes = max(int(np.prod(data.shape[1:]))*np.dtype(data.dtype).itemsize, 1)
+    step = max(block_size//frame_bytes, 1)
+    for start in range(0, len(data), step):
+        h.update(np.ascontiguousarray(data[start:start+step]).data)
+    return h.hexdigest()
+
+
+class TransformCache():
+    def __init__(self, path, max_bytes=10*2**30, mmap=True):
+        '''
+        On-disk cache of transformed stacks in a directory (path)
+        
+        Results are keyed by a fingerprint of the input together with the class and parameters
+        of the transform (ImageTransform.params), so changing a parameter only misses for the
+        transforms it belongs to. The stages of a MultiTransform are cached one by one and keyed
+        by the key of their input, so changing a later stage reuses the earlier ones.
+        Transforms whose functions can't be identified safely (see callable_key) are applied
+        uncached, as are the stages of a MultiTransform after one of them.
+        Once the cache holds more than max_bytes the least recently used results are evicted.
+        
+        Example:
+        
+        > cache = TransformCache('../data/cache')
+        > data_tf = cache.apply(RobertsTransform(), data)
+        
+        cache.hits, cache.misses: number of results read from and added to the cache
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mmap = mmap
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+    
+    def key(self, transform, input_fingerprint):
+        params = json.dumps([transform.params(), input_fingerprint], sort_keys=True, default=repr)
+        return hashlib.blake2b(params.encode(), digest_size=20).hexdigest()
+    
+    def _file(self, key):
+        return os.path.join(self.path, key+'.npy')
+    
+    def get(self, key):
+        '''
+        Returns the cached array for (key), or None
+        '''
+        fname = self._file(key)
+        try:
+            arr = np.load(fname, mmap_mode='r' if self.mmap else None)
+        except FileNotFoundError:
+            return None
+        # Modification time records the last use for LRU eviction
+        os.utime(fname)
+        return arr
+    
+    def put(self, key, arr):
+        fname = self._file(key)
+        tmp = fname+'.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(arr))
+        os.replace(tmp, fname)
+        self.evict()
+    
+    def apply(self, transform, data, input_fingerprint=None):
+        '''
+        Returns transform.apply(data), from the cache if it has been computed before
+        input_fingerprint can be passed to avoid rehashing data shared between calls
+        '''
+        if input_fingerprint is None:
+            input_fingerprint = fingerprint(data)
+        
+        if type(transform) is MultiTransform:
+            for i, t in enumerate(transform.transforms):
+                try:
+                    next_fingerprint = self.key(t, input_fingerprint)
+                except UnkeyableError:
+                    # Later stages are keyed by the output of this one
+                    inst.count('transform_cache.uncacheable')
+                    for t in transform.transforms[i:]:
+                        data = t.apply(data)
+                    return data
+                data = self.apply(t, data, input_fingerprint)
+                input_fingerprint = next_fingerprint
+            return data
+        
+        try:
+            key = self.key(transform, input_fingerprint)
+        except UnkeyableError:
+            inst.count('transform_cache.uncacheable')
+            return transform.apply(data)
+        arr = self.get(key)
+        if arr is not None:
+            self.hits += 1
+            inst.count('transform_cache.hits')
+            return arr
+        
+        self.misses += 1
+        inst.count('transform_cache.misses')
+        arr = transform.apply(data)
+        self.put(key, arr)
+        return arr
+    
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.path, f))
+                   for f in os.listdir(self.path) if f.endswith('.npy'))
+    
+    def evict(self, max_bytes=None):
+        '''
+        Deletes least recently used results until the cache holds at most max_bytes
+        '''
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = []
+        for f in os.listdir(self.path):
+            if f.endswith('.npy'):
+                st = os.stat(os.path.join(self.path, f))
+                entries.append((st.st_mtime, st.st_size, f))
+        total = sum(e[1] for e in entries)
+        for _, size, f in sorted(entries):
+            if total<=max_bytes:
+                break
+            os.remove(os.path.join(self.path, f))
+            total -= size
+    
+    def clear(self):
+        self.evict(0)
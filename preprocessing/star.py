@@ -0,0 +1,143 @@
+import io
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+class StarBlock():
+    def __init__(self, name, columns=None, pairs=None):
+        """
+        One data_ block of a STAR file.
+
+        columns - ordered dict of loop_ column label (e.g. '_rlnCoordinateX') -> length N array,
+                  numeric columns are int64/float64 arrays and the rest are object arrays of str
+        pairs - ordered dict of label -> value of the key/value pairs outside loop_
+        """
+        self.name = name
+        self.columns = columns if columns is not None else OrderedDict()
+        self.pairs = pairs if pairs is not None else OrderedDict()
+        self._indexes = {}
+
+    def __len__(self):
+        for v in self.columns.values():
+            return len(v)
+        return 0
+
+    def __getitem__(self, label):
+        return self.columns[label]
+
+    def __contains__(self, label):
+        return label in self.columns
+
+    def index(self, label='_rlnMicrographName'):
+        """
+        Row-range index of a column, computed once: returns (order, ranges) where ranges maps
+        each value to (start, stop) such that rows order[start:stop] hold that value.
+        order is the identity when rows are already grouped by value, as in RELION output.
+        """
+        if label not in self._indexes:
+            values = self.columns[label]
+            order = np.argsort(values, kind='stable')
+            keys, starts, counts = np.unique(values[order], return_index=True, return_counts=True)
+            if np.all(np.diff(order)>0):
+                order = np.arange(len(values))
+            ranges = {k: (int(s), int(s + c)) for k, s, c in zip(keys.tolist(), starts, counts)}
+            self._indexes[label] = (order, ranges)
+        return self._indexes[label]
+
+    def rows(self, label, value):
+        """ Indices of the rows where column label equals value. """
+        order, ranges = self.index(label)
+        start, stop = ranges.get(value, (0, 0))
+        return order[start:stop]
+
+    def take(self, rows):
+        """ New block with only the given rows (indices or boolean mask). """
+        columns = OrderedDict((k, v[rows]) for k, v in self.columns.items())
+        return StarBlock(self.name, columns, OrderedDict(self.pairs))
+
+
+def _nextLine(text, pos):
+    """ Returns (stripped line starting at pos, position of the next line). """
+    end = text.find(b'\n', pos)
+    if end<0:
+        end = len(text)
+    return text[pos:end].strip(), end + 1
+
+
+def _parseBlock(name, text, usecols=None):
+    """ Parse the text of a single data_ block, only keeping the loop columns in usecols if given. """
+    block = StarBlock(name)
+    pos = 0
+    while pos < len(text):
+        line, pos = _nextLine(text, pos)
+        if not line or line.startswith(b'#'):
+            continue
+        if line.startswith(b'loop_'):
+            labels = []
+            while pos < len(text):
+                header, nxt = _nextLine(text, pos)
+                if header and not header.startswith(b'_'):
+                    break
+                if header:
+                    labels.append(header.split()[0].decode())
+                pos = nxt
+            # Everything after the labels is the table, parsed in bulk
+            keep = labels if usecols is None else [x for x in labels if x in usecols]
+            table = pd.read_csv(io.BytesIO(text[pos:]), sep=r'\s+', header=None, names=labels,
+                                usecols=keep, comment='#', engine='c', skip_blank_lines=True)
+            for label in keep:
+                block.columns[label] = table[label].values
+            break
+        if line.startswith(b'_'):
+            parts = line.split(None, 1)
+            block.pairs[parts[0].decode()] = parts[1].decode().strip() if len(parts)>1 else ''
+    return block
+
+
+def read_star(path, columns=None):
+    """
+    Reads a STAR file into an ordered dict of block name -> StarBlock, keeping the
+    order of the blocks. Loop columns are found by their labels, not their position,
+    and if columns is given only those columns are parsed, which is much faster for
+    large particle files.
+    """
+    with open(path, 'rb') as f:
+        text = f.read()
+    
+    # Blocks start with data_<name> at the start of a line
+    starts = []
+    pos = 0 if text.startswith(b'data_') else text.find(b'\ndata_')
+    while pos>=0:
+        start = pos if text.startswith(b'data_', pos) else pos + 1
+        starts.append(start)
+        pos = text.find(b'\ndata_', start)
+    
+    blocks = OrderedDict()
+    for start, end in zip(starts, starts[1:] + [len(text)]):
+        header, bodyStart = _nextLine(text, start)
+        name = header.split()[0][len(b'data_'):].decode()
+        blocks[name] = _parseBlock(name, text[bodyStart:end], 
+                                   set(columns) if columns is not None else None)
+    return blocks
+
+
+def write_star(path, blocks, floatFormat='%.6f'):
+    """ Writes StarBlocks (an ordered dict of name -> block, or a list of blocks) to a STAR file. """
+    if isinstance(blocks, StarBlock):
+        blocks = [blocks]
+    elif isinstance(blocks, dict):
+        blocks = list(blocks.values())
+    with open(path, 'w') as f:
+        for block in blocks:
+            f.write('\ndata_{}\n\n'.format(block.name))
+            for k, v in block.pairs.items():
+                f.write('{} {}\n'.format(k, v))
+            if block.columns:
+                if block.pairs:
+                    f.write('\n')
+                f.write('loop_\n')
+                for i, label in enumerate(block.columns):
+                    f.write('{} #{}\n'.format(label, i + 1))
+                pd.DataFrame(block.columns).to_csv(f, sep='\t', header=False, index=False,
+                                                   float_format=floatFormat)
+            f.write('\n')
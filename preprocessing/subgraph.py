@@ -1,54 +1,287 @@
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import mrcfile
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.spatial import cKDTree
+
+from star import read_star
+
+MICROGRAPH_LABEL = '_rlnMicrographName'
+COORDINATE_LABELS = ['_rlnCoordinateX', '_rlnCoordinateY']
+
+
+def tile(data, sampleShape, stride=None, pad=False, padValue=0):
+    """ 
+    Tiles a 2D micrograph (data) into a (nH, nW, dimH, dimW) array, where [i, j]
+    is the tile starting at row i*strideH and column j*strideW.
+    
+    stride defaults to sampleShape (no overlap), smaller strides give overlapping tiles.
+    Without padding this is a strided view of data, no pixels are copied, and edge
+    pixels that do not fill a whole tile are dropped. With pad the micrograph is padded
+    with padValue so the last tiles cover the edges.
+    """
+    dimH, dimW = sampleShape
+    strideH, strideW = stride if stride is not None else sampleShape
+    if pad:
+        h, w = data.shape
+        nH, nW = gridShape((h, w), sampleShape, stride, pad=True)
+        padH = max((nH-1)*strideH + dimH - h, 0)
+        padW = max((nW-1)*strideW + dimW - w, 0)
+        data = np.pad(data, ((0, padH), (0, padW)), mode='constant', constant_values=padValue)
+    return sliding_window_view(data, (dimH, dimW))[::strideH, ::strideW]
+
+
+def micrographNumber(name):
+    """ Default micrograph key, the number after stack_ in its name (stack_0001_2x_dfpt.mrc -> 1) or else the name. """
+    match = re.search(r'stack_(\d+)', name)
+    return int(match.group(1)) if match else name
+
+
+def readMicrograph(path):
+    """ Read a whole micrograph into memory. """
+    with mrcfile.open(path, permissive=True) as mrc:
+        data = np.array(mrc.data)
+    return data
+
+
+class MicrographCache():
+    def __init__(self, load, maxBytes=2**31, prefetchWorkers=2):
+        """ 
+        LRU cache of micrographs loaded with load(key), holding at most maxBytes of data.
+        prefetch(keys) loads micrographs on a pool of prefetchWorkers background threads,
+        so reading the next micrographs overlaps with processing the current one.
+        Cached arrays are read-only, as they are shared between callers.
+        """
+        self.load = load
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(prefetchWorkers) if prefetchWorkers else None
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _insert(self, key, data):
+        data.flags.writeable = False
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = data
+                self.nbytes += data.nbytes
+            # Evict least recently used, but never the micrograph just loaded
+            while self.nbytes > self.maxBytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self.nbytes -= old.nbytes
+            self._pending.pop(key, None)
+        return data
+
+    def _loadAndInsert(self, key):
+        return self._insert(key, self.load(key))
+
+    def get(self, key):
+        """ Returns micrograph key, from the cache, a pending prefetch or by loading it. """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            # Popped so a failed prefetch is only raised once, later gets load it again
+            future = self._pending.pop(key, None)
+        if future is not None:
+            self.hits += 1
+            return future.result()
+        self.misses += 1
+        return self._loadAndInsert(key)
+
+    def prefetch(self, keys):
+        """ 
+        Starts loading the given micrographs in the background, if not cached or pending.
+        Those already cached are marked as recently used, so they are not evicted before use.
+        """
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                elif key not in self._pending and self._executor is not None:
+                    self._pending[key] = self._executor.submit(self._loadAndInsert, key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def gridShape(inputShape, sampleShape, stride=None, pad=False):
+    """ Number of tiles (nH, nW) that tile() cuts a micrograph of inputShape into. """
+    strideH, strideW = stride if stride is not None else sampleShape
+    grid = []
+    for n, dim, step in zip(inputShape, sampleShape, (strideH, strideW)):
+        if pad:
+            grid.append(max(-(-(n - dim)//step), 0) + 1)
+        else:
+            grid.append(max((n - dim)//step + 1, 0))
+    return tuple(grid)
+
+
 class SubgraphLoader():
     def __init__(self, 
                  inputShape, 
                  sampleShape, 
                  keys, 
                  keyToPath,
-                 labelFile):
+                 labelFile,
+                 stride=None,
+                 pad=False,
+                 micrographKey=micrographNumber,
+                 cacheBytes=2**31,
+                 prefetch=2):
+        """ 
+        inputShape - (h, w) of the micrographs
+        sampleShape - (dimH, dimW) of the subgraphs (tiles)
+        keys - micrograph keys, keyToPath maps a key to the path of its .mrc
+        labelFile - file of particle coordinates
+        stride - (strideH, strideW) between tiles, defaults to sampleShape (no overlap)
+        pad - if True, the micrographs are padded so the last tiles cover the edges
+        micrographKey - maps the _rlnMicrographName of a particle to its micrograph key
+        cacheBytes - size of the LRU cache of loaded micrographs
+        prefetch - number of micrographs after the requested one in keys to load in the background
+        """
         self.inputShape = inputShape
         self.sampleShape = sampleShape
         self.keys = keys
         self.keyToPath = keyToPath
+        self.stride = stride if stride is not None else sampleShape
+        self.pad = pad
+        self.micrographKey = micrographKey
+        self.prefetch = prefetch
+        # Position of each key in keys, for prefetching the ones after it
+        self._keyList = list(keys)
+        self._keyPositions = {}
+        for i, key in enumerate(self._keyList):
+            self._keyPositions.setdefault(key, i)
+        self.cache = MicrographCache(lambda key: readMicrograph(self.keyToPath(key)), 
+                                     maxBytes=cacheBytes, prefetchWorkers=min(prefetch, 4))
+        self._particleArrays = {}
         self.particles = self._parseParticles(labelFile)
+        self._trees = {}
     
     def getMicrograph(self, key):
-        """ Load micrograph. """
-        with mrcfile.open(self.keyToPath(key), permissive=True) as mrc:
-            data = mrc.data
+        """ Load micrograph, through the cache, and start prefetching the ones after it in keys. """
+        data = self.cache.get(key)
+        i = self._keyPositions.get(key)
+        if self.prefetch and i is not None:
+            self.cache.prefetch(self._keyList[i+1:i+1+self.prefetch])
         return data
     
-    def boxContains(point, sampleId):
+    def boxContains(self, point, sampleId):
+        """ Whether particle (x, y), x being the column and y the row, is in tile (idxh, idxw). """
         dimH, dimW = self.sampleShape 
+        strideH, strideW = self.stride
         x, y = point
-        cx, cy = sampleId
-        return (cx*dimW < x < cx*dimW + dimW) and (cy*dimH < y < cy*dimH + dimH)
+        idxh, idxw = sampleId
+        return (idxw*strideW <= x < idxw*strideW + dimW) and (idxh*strideH <= y < idxh*strideH + dimH)
+
+    def getParticleArray(self, micrograph):
+        """ (n, 2) array of the (x, y) coordinates of the particles of a micrograph. """
+        if micrograph not in self._particleArrays:
+            coords = np.asarray(self.particles.get(micrograph, []), dtype=np.float64).reshape(-1, 2)
+            self._particleArrays[micrograph] = coords
+        return self._particleArrays[micrograph]
+
+    def annotateTiles(self, micrograph):
+        """ 
+        Bins the particles of a micrograph into the tiles that contain them, in one vectorised pass.
+        
+        Returns (tiles, starts, particleIdx), where tiles is a (T, 2) array of the (idxh, idxw) of 
+        the non-empty tiles in row-major order and particleIdx[starts[t]:starts[t+1]] are the indices
+        (into getParticleArray) of the particles in tiles[t]. With overlapping tiles a particle is
+        listed under every tile that contains it.
+        """
+        coords = self.getParticleArray(micrograph)
+        dimH, dimW = self.sampleShape
+        strideH, strideW = self.stride
+        nH, nW = gridShape(self.inputShape, self.sampleShape, self.stride, self.pad)
+        x, y = coords[:, 0], coords[:, 1]
+        
+        # Candidate tiles per axis are the last one starting at or before the particle
+        # and the (dim-1)//stride before it, which overlap it when stride < dim
+        rows = np.floor(y/strideH).astype(np.int64)
+        cols = np.floor(x/strideW).astype(np.int64)
+        tileIdx = []
+        particleIdx = []
+        for dh in range(-(-dimH//strideH)):
+            for dw in range(-(-dimW//strideW)):
+                r = rows - dh
+                c = cols - dw
+                inside = ((r >= 0) & (r < nH) & (c >= 0) & (c < nW) 
+                          & (y < r*strideH + dimH) & (x < c*strideW + dimW))
+                tileIdx.append((r*nW + c)[inside])
+                particleIdx.append(np.flatnonzero(inside))
+        tileIdx = np.concatenate(tileIdx)
+        particleIdx = np.concatenate(particleIdx)
+        
+        order = np.lexsort((particleIdx, tileIdx))
+        tileIdx = tileIdx[order]
+        particleIdx = particleIdx[order]
+        flatTiles, starts = np.unique(tileIdx, return_index=True)
+        starts = np.append(starts, len(tileIdx))
+        tiles = np.stack(np.divmod(flatTiles, nW), axis=1)
+        return tiles, starts, particleIdx
+
+    def getParticlesWithin(self, micrograph, point, radius):
+        """ 
+        Indices (into getParticleArray) of the particles of a micrograph within radius pixels
+        of point (x, y), using a KD-tree built once per micrograph.
+        """
+        if micrograph not in self._trees:
+            self._trees[micrograph] = cKDTree(self.getParticleArray(micrograph))
+        return np.array(self._trees[micrograph].query_ball_point(point, radius), dtype=np.int64)
     
+    def getTiles(self, key):
+        """ (nH, nW, dimH, dimW) view of the tiles of a given micrograph. """
+        return tile(self.getMicrograph(key), self.sampleShape, self.stride, self.pad)
+
     def _generateSubgraph(self, key):
         """ Generate the subimages for a given micrograph. """
-        retDict = {}
-        h, w = self.inputShape
-        dimH, dimW = self.sampleShape
-        data = self.getMicrograph(key)
-        for idxh in range(int(h/dimH)):
-            for idxw in range(int(w/dimW)):
-                retDict[(idxh,idxw)] = data[idxh*dimH:idxh*dimH+dimH, 
-                                                  idxw*dimW:idxw*dimW+dimW]
-        return retDict
+        tiles = self.getTiles(key)
+        return {(idxh, idxw): tiles[idxh, idxw] 
+                for idxh in range(tiles.shape[0]) for idxw in range(tiles.shape[1])}
 
     def _parseParticles(self, file):
         """ 
-        Read in the particles for all micrographs. 
-        This will need to be edited if you change your key types. 
+        Read in the particles for all micrographs from a STAR file, as a dictionary of
+        micrograph key -> (n, 2) array of (x, y) coordinates. 
+        The block with the particle coordinates is kept in self.particleBlock, with
+        self.particleRows mapping each micrograph key to its rows, so filtered STAR files
+        can be written with particleBlock.take(rows) and star.write_star.
         """
-        with open(file, "r") as f:
-            particles = f.readlines()
-
-        particleData = [particle.split()[0:3] for particle in particles[17:-1]]
+        blocks = read_star(file)
+        self.particleBlock = next(b for b in blocks.values() 
+                                  if all(label in b for label in COORDINATE_LABELS))
+        coords = np.stack([self.particleBlock[label] for label in COORDINATE_LABELS], axis=1).astype(np.float64)
+        
         particleDict = {}
-        for x in particleData:
-            key = int(x[0][18:22])
-            value = tuple(map(float, x[1:]))
-            particleDict.setdefault(key, []).append(value)
+        self.particleRows = {}
+        order, ranges = self.particleBlock.index(MICROGRAPH_LABEL)
+        for name, (start, stop) in ranges.items():
+            key = self.micrographKey(name)
+            rows = order[start:stop]
+            if key in self.particleRows:
+                rows = np.sort(np.concatenate([self.particleRows[key], rows]))
+            self.particleRows[key] = rows
+            particleDict[key] = coords[rows]
+        self._particleArrays.update(particleDict)
         return particleDict
 
     def getSubgraphAnnotation(self, shift = True):
@@ -57,27 +290,20 @@ class SubgraphLoader():
                 
         (micrographKey, subgraphKey) -> [particles in subgraph]
 
-        subgraphKey - is the x,y position of a subgraph within the grid formed by the subgraphs over the micrograph.
+        subgraphKey - is the (idxh, idxw) position of a subgraph within the grid formed by the subgraphs over the micrograph.
         shift specifies if you want the absolute or relative posiotions.
+        Particles are (x, y) arrays, x being the column and y the row, and tiles without particles are left out.
         """
         subDict = {}
-        h, w = self.inputShape
-        dimH, dimW = self.sampleShape
+        strideH, strideW = self.stride
         for micrograph in self.keys:
-            for idxh in range(int(h/dimH)):
-                for idxw in range(int(w/dimW)):
-                    subgraph_particles = np.array(
-                        list(
-                            filter(
-                                lambda x : self.boxContains(x, (idxh, idxw), dimH, dimW), 
-                                self.particles[micrograph]
-                            )
-                        )
-                    )
-                    try:
-                        subDict[(micrograph, idxh, idxw)] = subgraph_particles - np.array([idxh*dimH, idxw*dimW])
-                    except:
-                        continue
+            coords = self.getParticleArray(micrograph)
+            tiles, starts, particleIdx = self.annotateTiles(micrograph)
+            for t, (idxh, idxw) in enumerate(tiles):
+                subgraph_particles = coords[particleIdx[starts[t]:starts[t+1]]]
+                if shift:
+                    subgraph_particles = subgraph_particles - np.array([idxw*strideW, idxh*strideH])
+                subDict[(micrograph, int(idxh), int(idxw))] = subgraph_particles
         return subDict
     
     def getSubgraphs(self):
@@ -86,4 +312,42 @@ class SubgraphLoader():
             subgraphs = self._generateSubgraph(micrograph)
             for k,v in subgraphs.items():
                 subDict[(micrograph, *k)] = v
-        return subDict
\ No newline at end of file
+        return subDict
+
+    def iterTileBatches(self, keys=None, batchSize=256):
+        """ 
+        Yields (tileKeys, batch) over the tiles of all micrographs (keys, default self.keys),
+        where batch is a contiguous (n, dimH, dimW) array of at most batchSize tiles, ready
+        for a classifier, and tileKeys is (micrographs, idxh, idxw): a length n list of the
+        micrograph key of each tile, which may be any key (e.g. a name or path), and two
+        length n int arrays of the tile's position in the grid.
+        """
+        keys = self.keys if keys is None else keys
+        dimH, dimW = self.sampleShape
+        batch = None
+        micrographs = []
+        idxh = np.empty(batchSize, dtype=np.int64)
+        idxw = np.empty(batchSize, dtype=np.int64)
+        n = 0
+        for key in keys:
+            tiles = self.getTiles(key)
+            nH, nW = tiles.shape[:2]
+            if batch is None:
+                batch = np.empty((batchSize, dimH, dimW), dtype=tiles.dtype)
+            pos = 0
+            while pos<nH*nW:
+                k = min(batchSize - n, nH*nW - pos)
+                # Copy through the (nH, nW) grid, so only the tiles in the batch are copied
+                rows, cols = np.divmod(np.arange(pos, pos + k), nW)
+                batch[n:n+k] = tiles[rows, cols]
+                micrographs.extend([key]*k)
+                idxh[n:n+k] = rows
+                idxw[n:n+k] = cols
+                n += k
+                pos += k
+                if n==batchSize:
+                    yield (micrographs, idxh.copy(), idxw.copy()), batch.copy()
+                    micrographs = []
+                    n = 0
+        if n:
+            yield (micrographs, idxh[:n].copy(), idxw[:n].copy()), batch[:n].copy()
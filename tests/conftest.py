@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules in features/ and preprocessing/ import each other by their flat names
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ('features', 'preprocessing'):
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from cnn_inference import preprocess_batch
+
+
+def notebook_preprocess(img, size=28, sigma=3):
+    '''
+    The per-image preprocessing of the training notebook
+    '''
+    from skimage import filters, transform
+    res = transform.resize(filters.gaussian(img, sigma=sigma), (size, size))
+    edges = filters.roberts(res)
+    return [(v - v.mean())/v.std() for v in (res, edges)]
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.int16])
+def test_preprocess_batch_matches_notebook(dtype):
+    rng = np.random.RandomState(0)
+    stack = rng.normal(scale=1000 if dtype==np.int16 else 1, size=(5, 64, 48)).astype(dtype)
+    image, edges = preprocess_batch(stack)
+    assert image.shape==edges.shape==(5, 28, 28, 1)
+    assert image.dtype==edges.dtype==np.float32
+    for i, img in enumerate(stack):
+        expected_image, expected_edges = notebook_preprocess(img)
+        np.testing.assert_allclose(image[i, ..., 0], expected_image, atol=1e-4)
+        np.testing.assert_allclose(edges[i, ..., 0], expected_edges, atol=1e-4)
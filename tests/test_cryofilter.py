@@ -0,0 +1,82 @@
+import os
+from collections import OrderedDict
+import mrcfile
+import numpy as np
+import pytest
+
+from cryofilter import score_particles
+from mrcs_loader import ParticleStack
+from star import StarBlock, read_star, write_star
+
+
+class MeanEnsembler():
+    def transform(self, batch, chunk_size=None):
+        return np.asarray(batch).mean(axis=(1, 2))[:, None]
+
+
+class SignClassifier():
+    def predict(self, features):
+        return (features[:, 0]>0).astype(np.float64)
+
+
+def stacks(tmp_path):
+    '''
+    Two stacks in Extract/ whose frames alternate between positive and negative means
+    '''
+    os.makedirs(str(tmp_path/'Extract'))
+    paths = []
+    for i, n in enumerate([3, 2]):
+        path = str(tmp_path/'Extract'/'mic{}.mrcs'.format(i))
+        signs = np.where(np.arange(n)%2==0, 1, -1)
+        with mrcfile.new(path) as mrc:
+            mrc.set_data((signs[:, None, None]*np.full((n, 4, 4), i+1)).astype(np.float32))
+        paths.append(path)
+    return paths
+
+
+def particles_star(path, rows):
+    optics = StarBlock('optics', OrderedDict([
+        ('_rlnOpticsGroup', np.array([1])), ('_rlnImagePixelSize', np.array([1.5]))]))
+    particles = StarBlock('particles', OrderedDict([
+        ('_rlnImageName', np.array(['{:06d}@Extract/mic{}.mrcs'.format(f, m) for m, f in rows], dtype=object)),
+        ('_rlnDefocusU', np.arange(len(rows), dtype=np.float64)*100)]))
+    write_star(path, OrderedDict([('optics', optics), ('particles', particles)]))
+
+
+def test_kept_star_carries_over_the_input_rows(tmp_path):
+    # Listed out of stack order
+    rows = [(1, 2), (0, 1), (1, 1), (0, 3), (0, 2)]
+    particles_star(str(tmp_path/'particles.star'), rows)
+    stack = ParticleStack(stacks(tmp_path))
+    stats = score_particles(stack, MeanEnsembler(), SignClassifier(), str(tmp_path/'out'),
+                            star=str(tmp_path/'particles.star'))
+    stack.close()
+    assert stats['kept']==3
+
+    blocks = read_star(str(tmp_path/'out'/'particles_kept.star'))
+    assert list(blocks)==['optics', 'particles']
+    np.testing.assert_array_equal(blocks['optics']['_rlnImagePixelSize'], [1.5])
+    kept = blocks['particles']
+    # Frames 1 and 3 of mic0 and frame 1 of mic1, in stack order
+    np.testing.assert_array_equal(kept['_rlnDefocusU'], [100, 300, 200])
+    np.testing.assert_array_equal(kept['_rlnImageName'],
+                                  ['00000{}@particles_kept.mrcs'.format(i) for i in (1, 2, 3)])
+    assert kept['_rlnOriginalParticleName'][0].startswith('000001@')
+
+
+def test_kept_star_without_input_star(tmp_path):
+    stack = ParticleStack(stacks(tmp_path))
+    score_particles(stack, MeanEnsembler(), SignClassifier(), str(tmp_path/'out'))
+    stack.close()
+    kept = read_star(str(tmp_path/'out'/'particles_kept.star'))['particles']
+    assert list(kept.columns)==['_rlnImageName', '_rlnOriginalParticleName']
+    assert len(kept)==3
+
+
+def test_particles_missing_from_star_raise(tmp_path):
+    particles_star(str(tmp_path/'particles.star'), [(0, 1), (0, 2)])
+    stack = ParticleStack(stacks(tmp_path))
+    with pytest.raises(ValueError, match='3 of the 5 particles'):
+        score_particles(stack, MeanEnsembler(), SignClassifier(), str(tmp_path/'out'),
+                        star=str(tmp_path/'particles.star'))
+    stack.close()
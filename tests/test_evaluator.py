@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import shared_batch
+from evaluator import Evaluator
+
+
+def featurize(batch):
+    return batch.reshape(len(batch), -1)
+
+
+def score(features):
+    return features.sum(axis=1)
+
+
+def n_attached(_):
+    return len(shared_batch._attached)
+
+
+def test_repeated_shared_memory_evaluate_reuses_segments():
+    data = np.random.RandomState(0).normal(size=(100, 4, 4)).astype(np.float32)
+    expected = data.reshape(100, -1).sum(axis=1)
+    with Evaluator(data, score, featurize, batch_size=16, workers=2, shared_memory=True) as E:
+        for _ in range(5):
+            np.testing.assert_allclose(E.evaluate(), expected, rtol=1e-5)
+        # Each worker maps at most the Evaluator's slots, however many calls were made
+        counts = E._getPool().map(n_attached, range(8), chunksize=1)
+        assert max(counts)<=2*E.workers
+        names = [slot.name for slot in E._slots.slots]
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_batch.SharedArray((1,), name=name)
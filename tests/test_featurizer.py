@@ -0,0 +1,66 @@
+import numpy as np
+
+from Featurizer import IncrementalFeaturizer, FeatureEnsembler
+from ImageTransforms import IdentityTransform, RobertsTransform
+
+
+def particles(n=300, size=12, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.normal(size=(n, size, size)).astype(np.float32)
+
+
+def test_incremental_featurizer_fits():
+    data = particles()
+    F = IncrementalFeaturizer(data, n_components=3, chunk_size=100)
+    F.fit()
+    assert F.feature_coeffs.shape==(len(data), 9)
+    assert np.all(np.isfinite(F.feature_coeffs))
+    np.testing.assert_allclose(F.transform(data), F.feature_coeffs, rtol=1e-3, atol=1e-3)
+
+
+def test_chunks_of_integer_data_match_the_whole_stack():
+    rng = np.random.RandomState(0)
+    data = rng.randint(-2000, 2000, size=(120, 12, 12)).astype(np.int16)
+    transform = RobertsTransform((8, 8))
+    F = IncrementalFeaturizer(data, n_components=2, chunk_size=50, transform=transform)
+    chunked = np.concatenate(list(F.iterChunks()))
+    assert chunked.dtype==np.float32
+    expected = transform.apply(data).astype(np.float32).reshape(len(data), -1)
+    np.testing.assert_allclose(chunked, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_feature_ensembler_fits_out_of_core():
+    data = particles()
+    E = FeatureEnsembler(data, [IdentityTransform((8, 8))], n_components=3, chunk_size=100)
+    E.fit()
+    assert E.transform(data[:10]).shape==(10, 9)
+
+
+def test_affine_map_matches_transform_of_each_estimator():
+    from sklearn import decomposition
+    from Featurizer import affine_map
+
+    X = particles(n=200, size=6).reshape(200, -1).astype(np.float64)
+    estimators = [
+        decomposition.PCA(n_components=4),
+        decomposition.PCA(n_components=4, whiten=True, svd_solver='randomized', random_state=0),
+        decomposition.IncrementalPCA(n_components=4),
+        decomposition.IncrementalPCA(n_components=4, whiten=True),
+        decomposition.FastICA(n_components=4, whiten='unit-variance', random_state=0),
+        decomposition.FactorAnalysis(n_components=4, max_iter=20, random_state=0),
+    ]
+    for estimator in estimators:
+        estimator.fit(X)
+        W, mean = affine_map(estimator)
+        np.testing.assert_allclose(np.matmul(X - mean, W), estimator.transform(X), atol=1e-6,
+                                   err_msg=type(estimator).__name__)
+
+
+def test_folded_transform_matches_fitted_coefficients():
+    from Featurizer import Featurizer
+
+    data = particles(n=200, size=6).astype(np.float64)
+    for shared_svd in (False, True):
+        F = Featurizer(data, n_components=3, shared_svd=shared_svd)
+        F.fit()
+        np.testing.assert_allclose(F.transform(data), F.feature_coeffs, atol=1e-6)
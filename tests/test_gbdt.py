@@ -0,0 +1,48 @@
+import os
+import numpy as np
+
+from GBDT import GBDTWrapper
+
+
+def feature_files(tmp_path, seed=0, n=200):
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(2):
+        path = str(tmp_path/'features_{}.npy'.format(i))
+        np.save(path, rng.normal(size=(n//2, 4)))
+        paths.append(path)
+    return paths, (rng.rand(n)>0.5).astype(np.float64)
+
+
+def test_saved_dataset_is_reused_until_its_inputs_change(tmp_path):
+    paths, y = feature_files(tmp_path)
+    dataset_path = str(tmp_path/'train.bin')
+    GBDTWrapper.from_chunks(paths, y, dataset_path=dataset_path, dataset_params={'verbose': -1})
+    built = os.stat(dataset_path).st_mtime_ns
+
+    gbdt = GBDTWrapper.from_chunks(paths, y, dataset_path=dataset_path, dataset_params={'verbose': -1})
+    assert os.stat(dataset_path).st_mtime_ns==built
+    np.testing.assert_array_equal(gbdt.y_train, y[gbdt.X_train.rows])
+
+    # New labels
+    gbdt = GBDTWrapper.from_chunks(paths, 1-y, dataset_path=dataset_path, dataset_params={'verbose': -1})
+    np.testing.assert_array_equal(gbdt.lgb_dataset.get_label(), gbdt.y_train)
+    np.testing.assert_array_equal(gbdt.y_test, (1-y)[gbdt.X_test.rows])
+
+    # New split
+    gbdt = GBDTWrapper.from_chunks(paths, 1-y, dataset_path=dataset_path, test_size=0.5,
+                                   dataset_params={'verbose': -1})
+    assert gbdt.lgb_dataset.num_data()==100
+
+    assert os.stat(dataset_path).st_mtime_ns!=built
+    gbdt = GBDTWrapper.from_chunks(paths, 1-y, dataset_path=dataset_path, test_size=0.5,
+                                   dataset_params={'verbose': -1})
+    assert gbdt.lgb_dataset.num_data()==100
+    np.testing.assert_array_equal(gbdt.y_train, (1-y)[gbdt.X_train.rows])
+
+    # Rewritten feature file
+    rebuilt = os.stat(dataset_path).st_mtime_ns
+    np.save(paths[0], np.zeros((100, 4)))
+    GBDTWrapper.from_chunks(paths, 1-y, dataset_path=dataset_path, test_size=0.5,
+                            dataset_params={'verbose': -1})
+    assert os.stat(dataset_path).st_mtime_ns!=rebuilt
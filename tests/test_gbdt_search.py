@@ -0,0 +1,23 @@
+import numpy as np
+
+from GBDT import GBDTWrapper
+from gbdt_search import GBDTSearch
+
+
+def test_search_lowers_min_data_in_leaf_and_records_failed_trials(tmp_path):
+    rng = np.random.RandomState(0)
+    x = rng.normal(size=(300, 4))
+    y = (x[:, 0] + 0.5*rng.normal(size=300)>0).astype(np.float64)
+    gbdt = GBDTWrapper(x, y, scale=False)
+    search = GBDTSearch(gbdt, nfold=3, n_jobs=1, num_boost_round=20, early_stopping_rounds=None,
+                        work_dir=str(tmp_path/'work'))
+    board = search.run([{'min_data_in_leaf': 5}, {'num_leaves': 1}, {'min_data_in_leaf': 30}])
+
+    assert [r['error'] is None for r in board]==[True, True, False]
+    assert board[-1]['params']['num_leaves']==1 and np.isnan(board[-1]['auc'])
+    assert {r['params'].get('min_data_in_leaf') for r in board[:2]}=={5, 30}
+    assert search.best_params is board[0]['params']
+
+    search.save(str(tmp_path/'search'))
+    rows = (tmp_path/'search'/'leaderboard.csv').read_text().splitlines()
+    assert len(rows)==4 and 'LightGBMError' in rows[-1]
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from ImageTransforms import FFT2Transform
+
+
+@pytest.mark.parametrize('shape, central_width', [((64, 64), 20), ((64, 64), 100), ((28, 28), 50),
+                                                  ((31, 40), 35), ((33, 33), 8)])
+def test_fft2_batch_matches_per_image(shape, central_width):
+    stack = np.random.RandomState(0).normal(size=(3,)+shape).astype(np.float32)
+    t = FFT2Transform(central_width)
+    per_image = np.stack([t.transform(x) for x in stack])
+    batch = t.transform_batch(stack)
+    expected = (min(central_width, shape[0]), min(central_width, shape[1]))
+    assert per_image.shape[1:]==expected
+    assert batch.shape==per_image.shape
+    np.testing.assert_allclose(batch, per_image, rtol=1e-4, atol=1e-3)
+
+
+def test_pipeline_run_keeps_store_provenance(tmp_path):
+    from ImageTransforms import IdentityTransform, TransformPipeline
+    from particle_store import ParticleStore, ParticleStoreWriter
+
+    data = np.random.RandomState(0).normal(size=(10, 16, 16)).astype(np.float32)
+    with ParticleStoreWriter(str(tmp_path/'in'), (16, 16), classes=['a', 'b']) as writer:
+        writer.append(data[:6], label=0, source='one.mrcs')
+        writer.append(data[6:], label=1, source='two.mrcs')
+    source = ParticleStore(str(tmp_path/'in'))
+
+    out = TransformPipeline([IdentityTransform()], chunk_size=4).run(source, str(tmp_path/'out'))
+    np.testing.assert_array_equal(out[:], data)
+    np.testing.assert_array_equal(out.labels, source.labels)
+    np.testing.assert_array_equal(out.frame_idx, source.frame_idx)
+    assert list(out.sources)==list(source.sources)
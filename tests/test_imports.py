@@ -0,0 +1,21 @@
+import os
+import pytest
+
+import benchmark
+
+
+@pytest.fixture(scope='module')
+def import_results():
+    # Each core module in a fresh interpreter
+    return benchmark.import_times()
+
+
+def test_core_modules_import_no_optional_dependencies(import_results):
+    assert benchmark.check_imports(import_results)==[]
+    assert not {'lightgbm', 'sklearn'} & set(import_results['gbdt_search']['heavy'])
+
+
+@pytest.mark.skipif('IMPORT_BUDGET' not in os.environ,
+                    reason='timing depends on the machine, set IMPORT_BUDGET=<seconds> to check it')
+def test_core_modules_import_within_budget(import_results):
+    assert benchmark.check_imports(import_results, float(os.environ['IMPORT_BUDGET']))==[]
@@ -0,0 +1,23 @@
+import os
+import subprocess
+import sys
+
+import instrumentation as inst
+
+FEATURES = os.path.dirname(os.path.abspath(inst.__file__))
+
+
+def test_peak_rss():
+    assert inst.peak_rss_mb()>0
+
+
+def test_imports_without_resource_module():
+    # As on Windows, where the resource module does not exist
+    code = ("import sys; sys.modules['resource'] = None\n"
+            "import instrumentation as inst\n"
+            "with inst.timer('stage'):\n"
+            "    pass\n"
+            "print(inst.peak_rss_mb())")
+    out = subprocess.run([sys.executable, '-c', code], cwd=FEATURES, check=True,
+                         capture_output=True, text=True).stdout
+    float(out)
@@ -0,0 +1,48 @@
+import os
+import mrcfile
+import numpy as np
+import pytest
+
+from particle_store import ParticleStore, create_store_from_mrcs, ingest_mrcs_parallel
+
+
+def class_folders(tmp_path, counts):
+    '''
+    A folder per class holding one stack of counts[i] particles, or no stack if it is 0
+    '''
+    paths = []
+    for i, n in enumerate(counts):
+        path = str(tmp_path/'class{}'.format(i))
+        os.makedirs(path)
+        if n:
+            with mrcfile.new(os.path.join(path, 'stack.mrcs')) as mrc:
+                mrc.set_data(np.full((n, 8, 8), i, dtype=np.float32))
+        paths.append(path)
+    return paths
+
+
+def test_store_skips_empty_first_class(tmp_path):
+    paths = class_folders(tmp_path, [0, 3])
+    create_store_from_mrcs(['empty', 'good'], paths, str(tmp_path/'store'))
+    store = ParticleStore(str(tmp_path/'store'))
+    assert len(store)==3
+    np.testing.assert_array_equal(store.labels, [1, 1, 1])
+
+
+def test_store_of_no_stacks_raises(tmp_path):
+    paths = class_folders(tmp_path, [0])
+    with pytest.raises(ValueError, match='No .mrcs files'):
+        create_store_from_mrcs(['empty'], paths, str(tmp_path/'store'))
+
+
+def test_parallel_ingest_skips_empty_first_class(tmp_path):
+    paths = class_folders(tmp_path, [0, 3, 2])
+    store = ingest_mrcs_parallel(['empty', 'a', 'b'], paths, str(tmp_path/'store'), n_workers=1)
+    np.testing.assert_array_equal(store.labels, [1, 1, 1, 2, 2])
+    np.testing.assert_array_equal(store[:][:, 0, 0], [1, 1, 1, 2, 2])
+
+
+def test_parallel_ingest_of_no_stacks_raises(tmp_path):
+    paths = class_folders(tmp_path, [0, 0])
+    with pytest.raises(ValueError, match='No .mrcs files'):
+        ingest_mrcs_parallel(['a', 'b'], paths, str(tmp_path/'store'), n_workers=1)
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import numpy as np
+
+from star import StarBlock, read_star, write_star
+
+
+RELION31 = '''
+# version 30001
+
+data_optics
+
+loop_
+_rlnOpticsGroupName #1
+_rlnOpticsGroup #2
+_rlnImagePixelSize #3
+opticsGroup1 1 1.350000
+opticsGroup2 2 1.100000
+
+
+# version 30001
+
+data_particles
+
+loop_
+_rlnCoordinateX #1
+_rlnCoordinateY #2
+_rlnImageName #3
+_rlnMicrographName #4
+_rlnOpticsGroup #5
+_rlnDefocusU #6
+1024.000000 512.000000 000001@Extract/mic1.mrcs MotionCorr/mic1.mrc 1 10000.500000
+ 900.000000 100.000000 000002@Extract/mic1.mrcs MotionCorr/mic1.mrc 1 10001.500000
+  12.000000  34.000000 000001@Extract/mic2.mrcs MotionCorr/mic2.mrc 2 20000.000000
+  56.000000  78.000000 000002@Extract/mic2.mrcs MotionCorr/mic2.mrc 2 20001.000000
+  90.000000  12.000000 000003@Extract/mic1.mrcs MotionCorr/mic1.mrc 1 10002.500000
+'''
+
+
+def assert_blocks_equal(a, b):
+    assert list(a)==list(b)
+    for name in a:
+        assert a[name].pairs==b[name].pairs
+        assert list(a[name].columns)==list(b[name].columns)
+        for label in a[name].columns:
+            np.testing.assert_array_equal(a[name][label], b[name][label])
+
+
+def test_relion31_round_trip(tmp_path):
+    path = tmp_path/'particles.star'
+    path.write_text(RELION31)
+    blocks = read_star(str(path))
+    assert list(blocks)==['optics', 'particles']
+    assert len(blocks['optics'])==2 and len(blocks['particles'])==5
+    np.testing.assert_array_equal(blocks['optics']['_rlnOpticsGroupName'], ['opticsGroup1', 'opticsGroup2'])
+    np.testing.assert_allclose(blocks['particles']['_rlnDefocusU'][:2], [10000.5, 10001.5])
+    assert blocks['particles']['_rlnOpticsGroup'].dtype.kind=='i'
+
+    write_star(str(tmp_path/'copy.star'), blocks)
+    assert_blocks_equal(read_star(str(tmp_path/'copy.star')), blocks)
+
+
+def test_only_requested_columns_are_read(tmp_path):
+    path = tmp_path/'particles.star'
+    path.write_text(RELION31)
+    particles = read_star(str(path), columns=['_rlnImageName', '_rlnDefocusU'])['particles']
+    assert list(particles.columns)==['_rlnImageName', '_rlnDefocusU']
+
+
+def test_pairs_and_empty_loop_round_trip(tmp_path):
+    general = StarBlock('general', pairs=OrderedDict([('_rlnImageSizeX', '64'), ('_rlnImageDimensionality', '2')]))
+    empty = StarBlock('particles', OrderedDict([('_rlnImageName', np.array([], dtype=object)),
+                                                ('_rlnDefocusU', np.array([], dtype=np.float64))]))
+    write_star(str(tmp_path/'empty.star'), [general, empty])
+    blocks = read_star(str(tmp_path/'empty.star'))
+    assert list(blocks)==['general', 'particles']
+    assert blocks['general'].pairs==general.pairs
+    assert list(blocks['particles'].columns)==['_rlnImageName', '_rlnDefocusU']
+    assert len(blocks['particles'])==0
+
+
+def test_take_and_index(tmp_path):
+    path = tmp_path/'particles.star'
+    path.write_text(RELION31)
+    particles = read_star(str(path))['particles']
+
+    order, ranges = particles.index('_rlnMicrographName')
+    assert ranges=={'MotionCorr/mic1.mrc': (0, 3), 'MotionCorr/mic2.mrc': (3, 5)}
+    np.testing.assert_array_equal(order, [0, 1, 4, 2, 3])
+    np.testing.assert_array_equal(particles.rows('_rlnMicrographName', 'MotionCorr/mic2.mrc'), [2, 3])
+    assert len(particles.rows('_rlnMicrographName', 'missing.mrc'))==0
+
+    mic1 = particles.take(particles.rows('_rlnMicrographName', 'MotionCorr/mic1.mrc'))
+    assert mic1.name=='particles' and len(mic1)==3
+    np.testing.assert_array_equal(mic1['_rlnDefocusU'], [10000.5, 10001.5, 10002.5])
+    # The index of a block with grouped rows is the identity
+    order, ranges = mic1.index('_rlnMicrographName')
+    np.testing.assert_array_equal(order, [0, 1, 2])
+
+    kept = particles.take(particles['_rlnOpticsGroup']==2)
+    write_star(str(tmp_path/'kept.star'), kept)
+    np.testing.assert_array_equal(read_star(str(tmp_path/'kept.star'))['particles']['_rlnImageName'],
+                                  ['000001@Extract/mic2.mrcs', '000002@Extract/mic2.mrcs'])
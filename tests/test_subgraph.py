@@ -0,0 +1,68 @@
+import os
+from collections import OrderedDict
+import mrcfile
+import numpy as np
+import pytest
+
+from star import StarBlock, write_star
+from subgraph import SubgraphLoader
+
+
+def write_micrographs(path, names, shape=(40, 60)):
+    rng = np.random.RandomState(0)
+    data = {}
+    for name in names:
+        data[name] = rng.normal(size=shape).astype(np.float32)
+        with mrcfile.new(os.path.join(path, name+'.mrc')) as mrc:
+            mrc.set_data(data[name])
+    columns = OrderedDict([
+        ('_rlnMicrographName', np.array([n+'.mrc' for n in names], dtype=object)),
+        ('_rlnCoordinateX', np.full(len(names), 15.)),
+        ('_rlnCoordinateY', np.full(len(names), 5.)),
+    ])
+    star = os.path.join(path, 'particles.star')
+    write_star(star, StarBlock('particles', columns))
+    return data, star
+
+
+def test_tile_batches_with_string_keys(tmp_path):
+    names = ['mic_a', 'mic_b', 'mic_c']
+    data, star = write_micrographs(str(tmp_path), names)
+    loader = SubgraphLoader((40, 60), (20, 20), names, lambda key: os.path.join(str(tmp_path), key+'.mrc'),
+                            star, micrographKey=lambda name: name[:-len('.mrc')], prefetch=1)
+
+    micrographs, idxh, idxw, tiles = [], [], [], []
+    for (keys, h, w), batch in loader.iterTileBatches(batchSize=4):
+        assert len(keys)==len(h)==len(w)==len(batch)<=4
+        micrographs.extend(keys)
+        idxh.append(h)
+        idxw.append(w)
+        tiles.append(batch)
+    idxh = np.concatenate(idxh)
+    idxw = np.concatenate(idxw)
+    tiles = np.concatenate(tiles)
+
+    # 2x3 tiles per micrograph
+    assert micrographs==[n for n in names for _ in range(6)]
+    assert idxh.dtype.kind=='i' and idxw.dtype.kind=='i'
+    for key, h, w, t in zip(micrographs, idxh, idxw, tiles):
+        np.testing.assert_array_equal(t, data[key][h*20:(h+1)*20, w*20:(w+1)*20])
+
+
+def test_failed_prefetch_is_retried():
+    from subgraph import MicrographCache
+
+    calls = []
+    def load(key):
+        calls.append(key)
+        if len(calls)==1:
+            raise IOError('read failed')
+        return np.zeros((4, 4))
+
+    cache = MicrographCache(load, prefetchWorkers=1)
+    cache.prefetch(['a'])
+    with pytest.raises(IOError):
+        cache.get('a')
+    assert cache.get('a').shape==(4, 4)
+    assert calls==['a', 'a']
+    cache.close()
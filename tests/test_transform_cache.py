@@ -0,0 +1,67 @@
+import numpy as np
+
+from ImageTransforms import FuncTransform, MultiTransform
+from transform_cache import TransformCache
+
+
+OFFSET = 1
+
+
+class Offset():
+    def __init__(self, value):
+        self.value = value
+
+
+def test_different_lambdas_are_cached_separately(tmp_path):
+    data = np.arange(2*4*4, dtype=np.float32).reshape(2, 4, 4)
+    cache = TransformCache(str(tmp_path))
+
+    add_one = FuncTransform(lambda x: x+1, name='f')
+    times_two = FuncTransform(lambda x: x*2, name='f')
+    assert add_one.params()!=times_two.params()
+
+    np.testing.assert_array_equal(cache.apply(add_one, data), data+1)
+    np.testing.assert_array_equal(cache.apply(times_two, data), data*2)
+    assert cache.misses==2
+
+    np.testing.assert_array_equal(cache.apply(FuncTransform(lambda x: x+1, name='f'), data), data+1)
+    assert cache.hits==1
+
+
+def test_closures_are_keyed_by_their_values(tmp_path):
+    def scale(c):
+        return FuncTransform(lambda x: x*c, name='scale')
+
+    data = np.ones((2, 4, 4), dtype=np.float32)
+    cache = TransformCache(str(tmp_path))
+    np.testing.assert_array_equal(cache.apply(scale(2), data), data*2)
+    np.testing.assert_array_equal(cache.apply(scale(3), data), data*3)
+    assert cache.misses==2
+
+
+def test_globals_are_keyed_by_their_values(tmp_path, monkeypatch):
+    data = np.zeros((2, 4, 4), dtype=np.float32)
+    cache = TransformCache(str(tmp_path))
+    add_offset = FuncTransform(lambda x: x+OFFSET, name='offset')
+    np.testing.assert_array_equal(cache.apply(add_offset, data), data+1)
+
+    monkeypatch.setitem(globals(), 'OFFSET', 2)
+    np.testing.assert_array_equal(cache.apply(add_offset, data), data+2)
+    assert cache.misses==2 and cache.hits==0
+
+
+def test_unkeyable_functions_are_not_cached(tmp_path):
+    offset = Offset(1)
+    data = np.zeros((2, 4, 4), dtype=np.float32)
+    cache = TransformCache(str(tmp_path))
+    add_offset = FuncTransform(lambda x: x+offset.value, name='offset')
+    np.testing.assert_array_equal(cache.apply(add_offset, data), data+1)
+
+    offset.value = 2
+    np.testing.assert_array_equal(cache.apply(add_offset, data), data+2)
+    # Stages after an unkeyable one are not cached either
+    chain = MultiTransform([FuncTransform(lambda x: x*2, name='double'), add_offset,
+                            FuncTransform(lambda x: x*3, name='triple')])
+    np.testing.assert_array_equal(cache.apply(chain, data), data+6)
+    assert cache.misses==1 and cache.hits==0
+    assert len(list(tmp_path.iterdir()))==1